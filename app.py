@@ -1,21 +1,95 @@
-import motor.motor_asyncio
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from starlette.middleware.cors import CORSMiddleware
 
+from cache import clear_all, invalidate_from_change
+from changestream import ChangeStreamWatcher
+from conditional import VERSIONS_COLLECTION, versions, versions_from_change, write_tracker
+from database import create_client, warm_up
+from indexes import reconcile_indexes
+from instrumentation import InstrumentationMiddleware, command_timer
 from routers.damage_routes import router as damage_router
+from routers.metrics_routes import router as metrics_router
 from routers.reservation_routes import router as reservation_router
 from routers.resource_routes import router as resource_router
 from routers.stock_item_routes import router as stock_item_router
 from routers.storage_routes import router as storage_router
+from services.reservation_views import wait_for_pending
+from services.search import reindex_from_change, reset_index
+from settings import get_settings
 
 origins = [
     "http://localhost:4200",  # Your Angular app's URL
     # Add other origins if needed
 ]
 
+
+async def reset_caches():
+    await clear_all()
+    await reset_index()
+
+
+async def reset_versions():
+    versions.reset()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    settings = get_settings()
+    listeners = [command_timer] if settings.instrumentation_enabled else []
+    if settings.http_caching_enabled:
+        listeners.append(write_tracker)
+    client = create_client(settings, event_listeners=listeners)
+    command_timer.attach(client, asyncio.get_running_loop())
+    try:
+        await warm_up(client, settings)
+        app.state.mongo_client = client
+        app.state.db = client[settings.database_name]
+        write_tracker.attach(app.state.db, asyncio.get_running_loop())
+        if settings.ensure_indexes_on_startup:
+            await reconcile_indexes(app.state.db)
+
+        watcher = version_watcher = None
+        if settings.change_streams_enabled:
+            watcher = ChangeStreamWatcher(
+                app.state.db,
+                name="reference-cache",
+                collections=["resources", "storages", "stock_items", "reservations", "damages"],
+                handlers=[invalidate_from_change, reindex_from_change],
+                on_reset=reset_caches,
+            )
+            watcher.start()
+        if settings.change_streams_enabled and settings.http_caching_enabled:
+            # Not resumed: the mirror starts empty and reads the current versions, which
+            # replayed events must not overwrite with older ones.
+            version_watcher = ChangeStreamWatcher(
+                app.state.db,
+                name="collection-versions",
+                collections=[VERSIONS_COLLECTION],
+                handlers=[versions_from_change],
+                on_reset=reset_versions,
+                resume=False,
+            )
+            version_watcher.start()
+        versions.watcher = version_watcher
+        app.state.change_stream = watcher
+        try:
+            yield
+        finally:
+            for running in (watcher, version_watcher):
+                if running is not None:
+                    await running.stop()
+            await wait_for_pending()
+    finally:
+        client.close()
+
+
 app = FastAPI(
     title="Rental Service API",
     summary="A sample application showing how to use FastAPI to add a ReST API to a MongoDB collection.",
+    lifespan=lifespan,
 )
 
 app.add_middleware(
@@ -25,10 +99,13 @@ app.add_middleware(
     allow_methods=["*"],  # Allow all methods (GET, POST, etc.)
     allow_headers=["*"],  # Allow all headers
 )
+if get_settings().instrumentation_enabled:
+    app.add_middleware(InstrumentationMiddleware)
 
 app.include_router(stock_item_router, prefix="/stock-items", tags=["stock_items"])
 app.include_router(damage_router, prefix="/damages", tags=["damages"])
 app.include_router(storage_router, prefix="/storages", tags=["storages"])
 app.include_router(resource_router, prefix="/resources", tags=["resources"])
 app.include_router(reservation_router, prefix="/reservations", tags=["reservations"])
+app.include_router(metrics_router, prefix="/metrics", tags=["metrics"])
 
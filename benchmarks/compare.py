@@ -0,0 +1,47 @@
+"""
+Compare two ``benchmarks.load`` result files, e.g. from before and after a change.
+
+Usage: python -m benchmarks.compare before.json after.json
+"""
+import argparse
+import json
+
+
+def _change(before, after) -> str:
+    if before is None or after is None or not before:
+        return "-"
+    return f"{(after - before) / before * 100:+.0f}%"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args(argv)
+
+    with open(args.before) as file:
+        before = json.load(file)
+    with open(args.after) as file:
+        after = json.load(file)
+
+    print(f"{before.get('commit')} -> {after.get('commit')} ({before['backend']} / {after['backend']})")
+    if before["dataset"] != after["dataset"]:
+        print(f"Warning: different datasets {before['dataset']} / {after['dataset']}")
+    previous = {result["name"]: result for result in before["results"]}
+    print(f"{'endpoint':<28}{'p50 ms':>18}{'p95 ms':>18}{'req/s':>18}{'trips/req':>12}")
+    for result in after["results"]:
+        old = previous.get(result["name"])
+        if old is None:
+            print(f"{result['name']:<28}  (new)")
+            continue
+        cells = []
+        for get in (lambda r: r["latency_ms"]["p50"], lambda r: r["latency_ms"]["p95"], lambda r: r["throughput_rps"]):
+            cells.append(f"{get(result):>9.2f} {_change(get(old), get(result)):>7}")
+        trips = result["db_round_trips_per_request"]
+        old_trips = old["db_round_trips_per_request"]
+        cells.append(f"{'-' if trips is None else trips:>6} {'' if old_trips is None else f'({old_trips})':>5}")
+        print(f"{result['name']:<28}" + " ".join(cells))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""
+Load test of every endpoint of the API.
+
+Seeds a synthetic dataset (see ``benchmarks.seed``) into a scratch database, then sends
+``--requests`` requests to each endpoint through an in-process ASGI client with
+``--concurrency`` requests in flight, one endpoint after the other. Reports, per endpoint,
+the latency percentiles, throughput, status codes and database commands per request, and
+writes them as JSON (``--output``) to compare runs across commits with ``benchmarks.compare``.
+
+Usage:
+    RENTAL_SEARCH_BACKEND=local python -m benchmarks.load --in-memory
+    MONGODB_URL=mongodb://localhost:27017 python -m benchmarks.load --database rental_benchmark --output run.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+from pymongo import monitoring
+
+from app import app
+from benchmarks.seed import START, DatasetSize, seed_database
+from database import create_client
+from indexes import reconcile_indexes
+from settings import get_settings
+
+
+class CommandCounter(monitoring.CommandListener):
+    """
+    Count the commands sent to the server, i.e. the database round trips.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+@dataclass
+class Scenario:
+    name: str
+    method: str
+    path: Callable[[int], str]
+    body: Optional[Callable[[int], Any]] = None
+    # Only answers with the Atlas search backend, which the in-memory stand-in lacks
+    atlas_only: bool = False
+
+
+def _percentile(ordered: List[float], percent: float) -> float:
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+
+def _scenarios(data: Dict[str, List[Dict]], rng: random.Random) -> List[Scenario]:
+    ids = {name: [str(document["_id"]) for document in documents] for name, documents in data.items()}
+    pick = lambda name: (lambda i: rng.choice(ids[name]))
+    future = datetime(2100, 1, 1)
+
+    def reservation(i: int) -> Dict:
+        booked = future + timedelta(days=2 * i)
+        return {
+            "stock_item_id": rng.choice(ids["stock_items"]),
+            "booking_date": booked.isoformat(),
+            "return_date": (booked + timedelta(days=1)).isoformat(),
+            "client_data": "Benchmark",
+        }
+
+    def bulk(factory, size=100):
+        return lambda i: [factory(i * size + j) for j in range(size)]
+
+    stock_item = lambda i: {"resource_id": rng.choice(ids["resources"]), "storage_id": rng.choice(ids["storages"])}
+    damage = lambda i: {
+        "stock_item_id": rng.choice(ids["stock_items"]),
+        "damage_type": "scratch",
+        "description": "Benchmark",
+        "repair_cost": "10.00",
+    }
+    storage = lambda i: {"name": f"Benchmark storage {i}", "address": "1 Bench Street", "contact_number": "+15550000000"}
+    resource = lambda i: {"name": f"Benchmark title {i}", "platform": "PC"}
+    period = lambda i: f"from={(future - timedelta(days=30)).isoformat()}&to={future.isoformat()}"
+    # The weeks of the seeded reservations
+    seeded_period = f"from={START.isoformat()}&to={(START + timedelta(days=70)).isoformat()}"
+
+    scenarios = [
+        Scenario("list resources", "GET", lambda i: "/resources/?limit=100"),
+        Scenario("get resource", "GET", lambda i: f"/resources/{pick('resources')(i)}"),
+        Scenario("search resources", "GET", lambda i: f"/resources/search?query={rng.choice(['legends', 'quest', 'rac'])}",
+                 atlas_only=True),
+        Scenario("resource availability", "GET", lambda i: f"/resources/{pick('resources')(i)}/availability?{period(i)}"),
+        Scenario("list storages", "GET", lambda i: "/storages/?limit=100"),
+        Scenario("get storage", "GET", lambda i: f"/storages/{pick('storages')(i)}"),
+        Scenario("storage summary", "GET", lambda i: "/storages/summary"),
+        Scenario("list stock items", "GET", lambda i: "/stock-items/?limit=100"),
+        Scenario("damaged stock items", "GET", lambda i: f"/stock-items/damaged/{pick('storages')(i)}"),
+        Scenario("list reservations", "GET", lambda i: "/reservations/?limit=100"),
+        Scenario("list reservations (1000)", "GET", lambda i: "/reservations/?limit=1000"),
+        Scenario("unreturned reservations", "GET", lambda i: f"/reservations/unreturned/{pick('storages')(i)}"),
+        Scenario("detailed reservations", "GET", lambda i: f"/reservations/detailed?storage_id={pick('storages')(i)}"),
+        Scenario("reservation stats", "GET",
+                 lambda i: f"/reservations/stats?group_by=resource&granularity=week&{seeded_period}"),
+        Scenario("list damages", "GET", lambda i: "/damages/?limit=100"),
+        Scenario("cache metrics", "GET", lambda i: "/metrics/cache"),
+        Scenario("create storage", "POST", lambda i: "/storages/", storage),
+        Scenario("update storage", "PUT", lambda i: f"/storages/{pick('storages')(i)}", lambda i: {"address": f"{i} Bench Road"}),
+        Scenario("create resource", "POST", lambda i: "/resources/", resource),
+        Scenario("update resource", "PUT", lambda i: f"/resources/{pick('resources')(i)}", lambda i: {"platform": "PC"}),
+        Scenario("create stock item", "POST", lambda i: "/stock-items/", stock_item),
+        Scenario("update stock item", "PUT", lambda i: f"/stock-items/{pick('stock_items')(i)}",
+                 lambda i: {"storage_id": rng.choice(ids["storages"])}),
+        Scenario("create reservation", "POST", lambda i: "/reservations/", reservation),
+        Scenario("update reservation", "PUT", lambda i: f"/reservations/{pick('reservations')(i)}",
+                 lambda i: {"notes": f"Benchmark {i}"}),
+        Scenario("create damage", "POST", lambda i: "/damages/", damage),
+        Scenario("update damage", "PUT", lambda i: f"/damages/{pick('damages')(i)}", lambda i: {"description": "Updated"}),
+        Scenario("bulk create stock items", "POST", lambda i: "/stock-items/bulk", bulk(stock_item)),
+        Scenario("bulk create reservations", "POST", lambda i: "/reservations/bulk",
+                 bulk(lambda j: reservation(100_000 + j))),
+        Scenario("bulk update reservations", "PATCH", lambda i: "/reservations/bulk",
+                 lambda i: [{"id": rng.choice(ids["reservations"]), "notes": "Bulk"} for _ in range(100)]),
+        Scenario("bulk create damages", "POST", lambda i: "/damages/bulk", bulk(damage)),
+        Scenario("bulk create resources", "POST", lambda i: "/resources/bulk", bulk(resource)),
+        Scenario("bulk create storages", "POST", lambda i: "/storages/bulk", bulk(storage, 10)),
+    ]
+    # Deletes last, each on its own slice of the seeded documents so every request deletes something.
+    for name, path in (("damages", "damages"), ("reservations", "reservations"), ("stock_items", "stock-items")):
+        victims = iter(ids[name][len(ids[name]) // 2:])
+        scenarios.append(Scenario(
+            f"bulk delete {name.replace('_', ' ')}", "DELETE", lambda i, path=path: f"/{path}/bulk",
+            lambda i, victims=victims: [next(victims, str(i)) for _ in range(10)],
+        ))
+    return scenarios
+
+
+async def _run_scenario(client: httpx.AsyncClient, scenario: Scenario, requests: int, concurrency: int,
+                        counter: Optional[CommandCounter], first: int = 0) -> Dict:
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    next_request = iter(range(first, first + requests))
+    commands_before = counter.count if counter else 0
+
+    async def worker():
+        for i in next_request:
+            body = scenario.body(i) if scenario.body else None
+            started = time.perf_counter()
+            response = await client.request(scenario.method, scenario.path(i), json=body)
+            await response.aread()
+            latencies.append((time.perf_counter() - started) * 1000)
+            statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "name": scenario.name,
+        "method": scenario.method,
+        "requests": requests,
+        "concurrency": concurrency,
+        "status_codes": statuses,
+        "errors": sum(count for status, count in statuses.items() if status.startswith("5")),
+        "latency_ms": {
+            "p50": round(_percentile(latencies, 50), 3),
+            "p95": round(_percentile(latencies, 95), 3),
+            "p99": round(_percentile(latencies, 99), 3),
+            "mean": round(sum(latencies) / len(latencies), 3),
+            "max": round(latencies[-1], 3),
+        },
+        "throughput_rps": round(requests / elapsed, 1),
+        "db_round_trips_per_request": round((counter.count - commands_before) / requests, 2) if counter else None,
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> Dict:
+    settings = get_settings()
+    counter = None
+    if args.in_memory:
+        from benchmarks.standin import in_memory_client
+
+        client = in_memory_client()
+    else:
+        counter = CommandCounter()
+        client = create_client(settings, event_listeners=[counter])
+    db = client[args.database]
+
+    size = DatasetSize(args.storages, args.resources, args.stock_items, args.reservations)
+    rng = random.Random(args.seed)
+    try:
+        print(f"Seeding {size.as_dict()} into {args.database}...", file=sys.stderr)
+        data = await seed_database(db, size, args.seed)
+        if not args.in_memory:
+            await reconcile_indexes(db)
+
+        app.state.mongo_client = client
+        app.state.db = db
+        app.state.change_stream = None
+        results = []
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as http:
+            for scenario in _scenarios(data, rng):
+                if args.only and not re.search(args.only, scenario.name):
+                    continue
+                if args.in_memory and scenario.atlas_only and settings.search_backend == "atlas":
+                    print(f"Skipping {scenario.name}: $search needs Atlas, set RENTAL_SEARCH_BACKEND=local",
+                          file=sys.stderr)
+                    continue
+                # Warm up caches and code paths; not measured.
+                await _run_scenario(http, scenario, args.concurrency, args.concurrency, None, first=args.requests)
+                result = await _run_scenario(http, scenario, args.requests, args.concurrency, counter)
+                results.append(result)
+                print(_format_row(result), file=sys.stderr)
+    finally:
+        if args.drop:
+            await client.drop_database(args.database)
+        client.close()
+
+    return {
+        "commit": _git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "backend": "in-memory" if args.in_memory else "mongod",
+        "python": platform.python_version(),
+        "dataset": size.as_dict(),
+        "seed": args.seed,
+        "settings": {
+            "fast_json_responses": settings.fast_json_responses,
+            "search_backend": settings.search_backend,
+            "cache_ttl_seconds": settings.cache_ttl_seconds,
+            "max_pool_size": settings.max_pool_size,
+        },
+        "results": results,
+    }
+
+
+def _format_row(result: Dict) -> str:
+    latency = result["latency_ms"]
+    round_trips = result["db_round_trips_per_request"]
+    return (
+        f"{result['name']:<28} p50 {latency['p50']:>8.2f}  p95 {latency['p95']:>8.2f}  p99 {latency['p99']:>8.2f} ms"
+        f"  {result['throughput_rps']:>8.1f} req/s"
+        f"  {'-' if round_trips is None else round_trips:>6} trips/req  {result['status_codes']}"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test every API endpoint against a synthetic dataset")
+    parser.add_argument("--in-memory", action="store_true", help="Use the in-memory stand-in instead of MONGODB_URL")
+    parser.add_argument("--database", default="rental_benchmark", help="Scratch database, replaced by the seed data")
+    parser.add_argument("--drop", action="store_true", help="Drop the scratch database afterwards")
+    parser.add_argument("--storages", type=int, default=DatasetSize.storages)
+    parser.add_argument("--resources", type=int, default=DatasetSize.resources)
+    parser.add_argument("--stock-items", type=int, default=DatasetSize.stock_items)
+    parser.add_argument("--reservations", type=int, default=DatasetSize.reservations)
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the dataset and the requests")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight")
+    parser.add_argument("--only", help="Only run the endpoints whose name matches this regular expression")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    if args.database == get_settings().database_name:
+        parser.error("--database must not be the application database, it is overwritten")
+
+    report = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Synthetic dataset for the benchmarks.
+
+Popularity is skewed the way real rental data is: a few resources account for most of the
+stock items, a few storages hold most of the stock and the popular stock items carry most
+of the reservations (Zipf-like weights). Reservations of one stock item never overlap, the
+latest one is sometimes still open, and a small share of them led to a damage report.
+"""
+import random
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from bson import ObjectId
+
+from services.availability import rebuild_availability
+from services.damaged import rebuild_damage_counts
+from services.reservation_stats import rebuild_reservation_stats
+from services.reservation_views import rebuild_reservation_views
+from services.summary import rebuild_summaries
+
+SKEW = 1.1
+OPEN_RESERVATION_SHARE = 0.1
+DAMAGE_SHARE = 0.05
+START = datetime(2020, 1, 1)
+INSERT_BATCH = 5000
+
+
+@dataclass
+class DatasetSize:
+    storages: int = 10
+    resources: int = 200
+    stock_items: int = 2000
+    reservations: int = 10_000
+
+    def as_dict(self) -> Dict[str, int]:
+        return asdict(self)
+
+
+def _zipf_weights(count: int) -> List[float]:
+    return [1 / (rank ** SKEW) for rank in range(1, count + 1)]
+
+
+def generate(size: DatasetSize, seed: int = 0) -> Dict[str, List[Dict]]:
+    rng = random.Random(seed)
+    storages = [
+        {"_id": ObjectId(), "name": f"Storage {i}", "address": f"{i} Main Street", "contact_number": f"+1555{i:07d}"}
+        for i in range(size.storages)
+    ]
+    platforms = ["Nintendo Switch", "PlayStation 5", "Xbox Series X", "PC"]
+    genres = ["Action", "Adventure", "Racing", "Puzzle", "Strategy", "Sports", "Open-world", "Platformer"]
+    resources = [
+        {
+            "_id": ObjectId(),
+            "name": f"Title {i} {rng.choice(['Legends', 'Quest', 'Racer', 'Chronicles', 'Party'])}",
+            "platform": rng.choice(platforms),
+            "release_date": (START - timedelta(days=rng.randrange(3650))).date().isoformat(),
+            "developer": f"Studio {rng.randrange(50)}",
+            "genre": rng.sample(genres, 2),
+        }
+        for i in range(size.resources)
+    ]
+
+    resource_picks = rng.choices(resources, weights=_zipf_weights(len(resources)), k=size.stock_items)
+    storage_picks = rng.choices(storages, weights=_zipf_weights(len(storages)), k=size.stock_items)
+    stock_items = [
+        {"_id": ObjectId(), "resource_id": resource["_id"], "storage_id": storage["_id"]}
+        for resource, storage in zip(resource_picks, storage_picks)
+    ]
+
+    # Reservations follow the stock item's popularity, which follows its resource's rank.
+    resource_rank = {resource["_id"]: rank for rank, resource in enumerate(resources, start=1)}
+    weights = [1 / (resource_rank[stock_item["resource_id"]] ** SKEW) for stock_item in stock_items]
+    per_stock_item: Dict = {}
+    for stock_item in rng.choices(stock_items, weights=weights, k=size.reservations):
+        per_stock_item[stock_item["_id"]] = per_stock_item.get(stock_item["_id"], 0) + 1
+
+    reservations, damages = [], []
+    for stock_item_id, count in per_stock_item.items():
+        booked = START + timedelta(hours=rng.randrange(24 * 30))
+        for i in range(count):
+            returned = booked + timedelta(hours=rng.randrange(12, 24 * 14))
+            is_open = i == count - 1 and rng.random() < OPEN_RESERVATION_SHARE
+            reservation = {
+                "_id": ObjectId(),
+                "stock_item_id": stock_item_id,
+                "booking_date": booked,
+                "client_data": f"Client {rng.randrange(10_000)}",
+                "return_date": None if is_open else returned,
+                "notes": None,
+            }
+            reservations.append(reservation)
+            if not is_open and rng.random() < DAMAGE_SHARE:
+                damages.append({
+                    "_id": ObjectId(),
+                    "stock_item_id": stock_item_id,
+                    "reservation_id": reservation["_id"],
+                    "damage_type": rng.choice(["scratch", "missing part", "broken case"]),
+                    "description": "Reported on return",
+                    "repair_cost": f"{rng.randrange(5, 80)}.00",
+                })
+            booked = returned + timedelta(hours=rng.randrange(1, 24 * 7))
+
+    return {
+        "storages": storages,
+        "resources": resources,
+        "stock_items": stock_items,
+        "reservations": reservations,
+        "damages": damages,
+    }
+
+
+async def seed_database(db, size: DatasetSize, seed: int = 0) -> Dict[str, List[Dict]]:
+    """
+    Replace the content of ``db`` with a generated dataset and build the derived collections.
+    """
+    data = generate(size, seed)
+    for name, documents in data.items():
+        await db[name].drop()
+        for start in range(0, len(documents), INSERT_BATCH):
+            await db[name].insert_many(documents[start:start + INSERT_BATCH])
+    await rebuild_summaries(db)
+    await rebuild_availability(db)
+    await rebuild_damage_counts(db)
+    await rebuild_reservation_views(db)
+    await rebuild_reservation_stats(db)
+    return data
@@ -0,0 +1,436 @@
+import json
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Type
+
+from bson import ObjectId
+from fastapi import HTTPException, Request
+from pydantic import BaseModel, ValidationError
+from pymongo import DeleteOne, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from models import BulkItemError, BulkWriteReport
+from pagination import NDJSON_MEDIA_TYPE
+from updates import VERSION_FIELD, UpdateSpec, update_spec
+
+# Called with the collection and the (before, after) pairs of the documents a batch wrote,
+# see services.summary.record_changes.
+OnChange = Optional[Callable[[Any, List[Tuple[Optional[Dict], Optional[Dict]]]], Awaitable[None]]]
+
+# Called with the same arguments before a batch is written; returns the reasons, keyed by
+# position in the list of changes, why some of them must not be written (see
+# services.availability.book_changes). The changes whose write then fails are passed to
+# the matching ``on_failure`` hook.
+BeforeWrite = Optional[Callable[[Any, List[Tuple[Optional[Dict], Optional[Dict]]]], Awaitable[Dict[int, str]]]]
+
+logger = logging.getLogger(__name__)
+
+# Rounds of a batch of updates or deletes with hooks, for the documents another request changed meanwhile
+_ATTEMPTS = 3
+
+
+def chain(*hooks: OnChange) -> OnChange:
+    """
+    Combine several write hooks into one that calls them in order.
+    """
+
+    async def on_change(collection, changes):
+        for hook in hooks:
+            await hook(collection, changes)
+
+    return on_change
+
+
+def bulk_openapi(item_schema: Dict) -> Dict:
+    """
+    ``openapi_extra`` describing a bulk body: a JSON array of ``item_schema`` or one item per NDJSON line.
+    """
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {"schema": {"type": "array", "items": item_schema}},
+                NDJSON_MEDIA_TYPE: {"schema": item_schema},
+            },
+        }
+    }
+
+
+async def iter_bulk_items(request: Request, report: BulkWriteReport) -> AsyncIterator[Tuple[int, Any]]:
+    """
+    Yield ``(index, item)`` for every item of a JSON array or NDJSON request body.
+
+    NDJSON bodies are decoded line by line as they arrive; lines that are not valid JSON are
+    recorded in ``report`` and skipped.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+
+    if content_type == NDJSON_MEDIA_TYPE:
+        index = 0
+        buffer = b""
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    try:
+                        yield index, json.loads(line)
+                    except ValueError as e:
+                        report.errors.append(BulkItemError(index=index, detail=f"Invalid JSON: {e}"))
+                    index += 1
+        if buffer.strip():
+            try:
+                yield index, json.loads(buffer)
+            except ValueError as e:
+                report.errors.append(BulkItemError(index=index, detail=f"Invalid JSON: {e}"))
+        return
+
+    try:
+        items = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Request body must be a JSON array or NDJSON")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Request body must be a JSON array or NDJSON")
+    for index, item in enumerate(items):
+        yield index, item
+
+
+def _validation_detail(error: ValidationError) -> Any:
+    return json.loads(error.json(include_url=False))
+
+
+def _object_id(item: Any) -> ObjectId:
+    value = item.get("id") if isinstance(item, dict) else item
+    if not isinstance(value, str) or not ObjectId.is_valid(value):
+        raise ValueError(f"{value!r} is not a valid id")
+    return ObjectId(value)
+
+
+def _record_write_errors(error: BulkWriteError, chunk: List[Tuple[int, Any]], report: BulkWriteReport) -> set:
+    failed = set()
+    for write_error in error.details["writeErrors"]:
+        failed.add(write_error["index"])
+        report.errors.append(BulkItemError(index=chunk[write_error["index"]][0], detail=write_error["errmsg"]))
+    return failed
+
+
+async def _insert_chunk(
+    collection,
+    chunk: List[Tuple[int, Dict]],
+    report: BulkWriteReport,
+    inserted: Dict[int, str],
+    on_change: OnChange,
+    before_write: BeforeWrite = None,
+    on_failure: OnChange = None,
+):
+    if before_write is not None:
+        rejected = await before_write(collection, [(None, document) for _, document in chunk])
+        for position, detail in rejected.items():
+            report.errors.append(BulkItemError(index=chunk[position][0], detail=detail))
+        chunk = [item for position, item in enumerate(chunk) if position not in rejected]
+        if not chunk:
+            return
+
+    failed = set()
+    try:
+        await collection.bulk_write([InsertOne(document) for _, document in chunk], ordered=False)
+    except BulkWriteError as e:
+        failed = _record_write_errors(e, chunk, report)
+        if on_failure is not None:
+            await on_failure(collection, [(None, chunk[position][1]) for position in failed])
+
+    written = [document for position, (_, document) in enumerate(chunk) if position not in failed]
+    for position, (index, document) in enumerate(chunk):
+        if position not in failed:
+            inserted[index] = str(document["_id"])
+    if on_change is not None and written:
+        await on_change(collection, [(None, document) for document in written])
+
+
+async def bulk_create(
+    collection,
+    request: Request,
+    model: Type[BaseModel],
+    chunk_size: int,
+    on_change: OnChange = None,
+    before_write: BeforeWrite = None,
+    on_failure: OnChange = None,
+) -> BulkWriteReport:
+    """
+    Validate every item with ``model`` and insert the valid ones in unordered batches of ``chunk_size``.
+    """
+    report = BulkWriteReport()
+    inserted: Dict[int, str] = {}
+    chunk: List[Tuple[int, Dict]] = []
+    count = 0
+
+    async for index, item in iter_bulk_items(request, report):
+        count = index + 1
+        try:
+            document = model.model_validate(item).model_dump(by_alias=True, exclude=["id", "version"])
+        except ValidationError as e:
+            report.errors.append(BulkItemError(index=index, detail=_validation_detail(e)))
+            continue
+        document["_id"] = ObjectId()
+        chunk.append((index, document))
+        if len(chunk) >= chunk_size:
+            await _insert_chunk(collection, chunk, report, inserted, on_change, before_write, on_failure)
+            chunk = []
+    if chunk:
+        await _insert_chunk(collection, chunk, report, inserted, on_change, before_write, on_failure)
+
+    count = max([count] + [error.index + 1 for error in report.errors])
+    report.inserted_ids = [inserted.get(index) for index in range(count)]
+    report.errors.sort(key=lambda error: error.index)
+    return report
+
+
+async def _by_id(collection, ids: List[ObjectId]) -> Dict[ObjectId, Dict]:
+    if not ids:
+        return {}
+    return {document["_id"]: document async for document in collection.find({"_id": {"$in": ids}})}
+
+
+def _guarded(document: Dict) -> Dict:
+    # Only the version that was read (and checked) may be written.
+    return {"_id": document["_id"], VERSION_FIELD: document.get(VERSION_FIELD)}
+
+
+async def _update_chunk(
+    collection,
+    chunk: List[Tuple[int, ObjectId, UpdateSpec]],
+    report: BulkWriteReport,
+    on_change: OnChange,
+    before_write: BeforeWrite = None,
+    on_failure: OnChange = None,
+):
+    if on_change is None and before_write is None:
+        await _bulk_update_chunk(collection, chunk, report)
+        return
+
+    # The hooks need the exact document each update changed: read them all, then update each
+    # one only if it is still at the version read. An update that no longer matches upserts,
+    # which fails on the existing _id (or creates a stand-in if the document was deleted), so
+    # the positions that did not match are known.
+    written, failed = [], []
+    pending = list(range(len(chunk)))
+    for _ in range(_ATTEMPTS):
+        previous = await _by_id(collection, [chunk[position][1] for position in pending])
+        changes: Dict[int, Tuple[Dict, Dict]] = {}
+        for position in pending:
+            index, _id, spec = chunk[position]
+            if _id in previous:
+                changes[position] = (previous[_id], spec.apply(previous[_id]))
+            else:
+                report.errors.append(BulkItemError(index=index, detail=f"{_id} not found"))
+        if before_write is not None and changes:
+            positions = list(changes)
+            rejected = await before_write(collection, [changes[position] for position in positions])
+            for position, detail in rejected.items():
+                report.errors.append(BulkItemError(index=chunk[positions[position]][0], detail=detail))
+                del changes[positions[position]]
+        pending = []
+        if not changes:
+            break
+
+        positions = list(changes)
+        requests = [
+            UpdateOne(_guarded(changes[position][0]), chunk[position][2].operations(), upsert=True)
+            for position in positions
+        ]
+        errors: Dict[int, Dict] = {}
+        try:
+            upserted = (await collection.bulk_write(requests, ordered=False)).upserted_ids
+        except BulkWriteError as e:
+            errors = {error["index"]: error for error in e.details["writeErrors"]}
+            upserted = {item["index"]: item["_id"] for item in e.details["upserted"]}
+        if upserted:
+            # Deleted since it was read: remove the stand-in again.
+            await collection.delete_many({"_id": {"$in": list(upserted.values())}})
+        current = await _by_id(collection, [chunk[positions[number]][1] for number in errors])
+
+        for number, position in enumerate(positions):
+            index, _id, _ = chunk[position]
+            before, after = changes[position]
+            if number not in errors and number not in upserted:
+                written.append((before, after))
+                continue
+            if number in upserted or _id not in current:
+                report.errors.append(BulkItemError(index=index, detail=f"{_id} not found"))
+            elif current[_id].get(VERSION_FIELD) == before.get(VERSION_FIELD):
+                report.errors.append(BulkItemError(index=index, detail=errors[number]["errmsg"]))
+                if before_write is not None:
+                    failed.append((before, after))
+                continue
+            elif before_write is None:
+                # Changed by another request meanwhile: read it again and retry.
+                pending.append(position)
+                continue
+            else:
+                report.errors.append(BulkItemError(index=index, detail=f"{_id} was changed concurrently, please retry"))
+            if before_write is not None:
+                # Whoever changed or deleted it has written their own state: only undo ours.
+                failed.append((None, after))
+        if not pending:
+            break
+    for position in pending:
+        index, _id, _ = chunk[position]
+        report.errors.append(BulkItemError(index=index, detail=f"{_id} was changed concurrently, please retry"))
+
+    # Every update increments the version, so every matched document is modified.
+    report.matched_count += len(written)
+    report.modified_count += len(written)
+
+    if on_failure is not None and failed:
+        await on_failure(collection, failed)
+    if on_change is not None and written:
+        await on_change(collection, written)
+
+
+async def _bulk_update_chunk(collection, chunk: List[Tuple[int, ObjectId, UpdateSpec]], report: BulkWriteReport):
+    requests = [UpdateOne({"_id": _id}, spec.operations()) for _, _id, spec in chunk]
+    failed = set()
+    try:
+        result = await collection.bulk_write(requests, ordered=False)
+        matched, modified = result.matched_count, result.modified_count
+    except BulkWriteError as e:
+        failed = _record_write_errors(e, [(index, None) for index, _, _ in chunk], report)
+        matched, modified = e.details["nMatched"], e.details["nModified"]
+    report.matched_count += matched
+    report.modified_count += modified
+
+    if matched + len(failed) < len(chunk):
+        ids = [_id for _, _id, _ in chunk]
+        existing = set(await collection.distinct("_id", {"_id": {"$in": ids}}))
+        for position, (index, _id, _) in enumerate(chunk):
+            if position not in failed and _id not in existing:
+                report.errors.append(BulkItemError(index=index, detail=f"{_id} not found"))
+
+
+async def bulk_update(
+    collection,
+    request: Request,
+    update_model: Type[BaseModel],
+    model: Type[BaseModel],
+    chunk_size: int,
+    on_change: OnChange = None,
+    before_write: BeforeWrite = None,
+    on_failure: OnChange = None,
+) -> BulkWriteReport:
+    """
+    Apply partial updates given as ``{"id": ..., <fields>}`` items to documents of ``model``, in
+    unordered batches of ``chunk_size``. Items are interpreted as by :func:`updates.update_spec`.
+    """
+    report = BulkWriteReport()
+    chunk: List[Tuple[int, ObjectId, UpdateSpec]] = []
+
+    async for index, item in iter_bulk_items(request, report):
+        try:
+            if not isinstance(item, dict):
+                raise ValueError("Expected an object with an id and the fields to update")
+            _id = _object_id(item)
+            fields = {k: v for k, v in item.items() if k != "id"}
+            spec = update_spec(update_model.model_validate(fields), model)
+        except ValueError as e:
+            # ValidationError is a ValueError too
+            detail = _validation_detail(e) if isinstance(e, ValidationError) else str(e)
+            report.errors.append(BulkItemError(index=index, detail=detail))
+            continue
+
+        if not spec:
+            report.errors.append(BulkItemError(index=index, detail="No fields to update"))
+            continue
+        chunk.append((index, _id, spec))
+        if len(chunk) >= chunk_size:
+            await _update_chunk(collection, chunk, report, on_change, before_write, on_failure)
+            chunk = []
+    if chunk:
+        await _update_chunk(collection, chunk, report, on_change, before_write, on_failure)
+
+    report.errors.sort(key=lambda error: error.index)
+    return report
+
+
+async def _delete_chunk(collection, chunk: List[Tuple[int, ObjectId]], report: BulkWriteReport, on_change: OnChange):
+    ids = [_id for _, _id in chunk]
+    if on_change is None:
+        existing = set(await collection.distinct("_id", {"_id": {"$in": ids}}))
+        if existing:
+            result = await collection.delete_many({"_id": {"$in": list(existing)}})
+            report.deleted_count += result.deleted_count
+        for index, _id in chunk:
+            if _id not in existing:
+                report.errors.append(BulkItemError(index=index, detail=f"{_id} not found"))
+        return
+
+    # Report exactly the documents this request deleted, as they were when deleted: read them
+    # all, then delete each one only if it is still at the version read.
+    deleted: List[Dict] = []
+    positions: Dict[ObjectId, int] = {}
+    for index, _id in chunk:
+        positions.setdefault(_id, index)
+    pending = list(dict.fromkeys(ids))
+    for _ in range(_ATTEMPTS):
+        previous = await _by_id(collection, pending)
+        for _id in pending:
+            if _id not in previous:
+                report.errors.append(BulkItemError(index=positions[_id], detail=f"{_id} not found"))
+        pending = []
+        if not previous:
+            break
+        result = await collection.bulk_write([DeleteOne(_guarded(document)) for document in previous.values()], ordered=False)
+        if result.deleted_count == len(previous):
+            deleted += previous.values()
+            break
+
+        # Some were changed (still there, retried) or deleted by another request meanwhile.
+        remaining = set(await collection.distinct("_id", {"_id": {"$in": list(previous)}}))
+        gone = [document for _id, document in previous.items() if _id not in remaining]
+        if len(gone) == result.deleted_count:
+            deleted += gone
+        else:
+            # Which of them this request deleted cannot be told: count none rather than some twice.
+            logger.warning("%d documents of %s deleted concurrently; rebuild the summaries", len(gone), collection.name)
+            for document in gone:
+                report.errors.append(BulkItemError(index=positions[document["_id"]], detail=f"{document['_id']} was deleted concurrently"))
+        pending = [_id for _id in previous if _id in remaining]
+    for _id in pending:
+        report.errors.append(BulkItemError(index=positions[_id], detail=f"{_id} was changed concurrently, please retry"))
+
+    report.deleted_count += len(deleted)
+    # Ids given twice are deleted once.
+    for index, _id in chunk:
+        if positions[_id] != index:
+            report.errors.append(BulkItemError(index=index, detail=f"{_id} not found"))
+    if deleted:
+        await on_change(collection, [(document, None) for document in deleted])
+
+
+async def iter_bulk_ids(request: Request, report: BulkWriteReport, chunk_size: int) -> AsyncIterator[List[Tuple[int, ObjectId]]]:
+    """
+    Yield the ``(index, id)`` of the ids given as strings (or ``{"id": ...}`` objects), in
+    chunks of ``chunk_size``; invalid ids are recorded in ``report`` and skipped.
+    """
+    chunk: List[Tuple[int, ObjectId]] = []
+    async for index, item in iter_bulk_items(request, report):
+        try:
+            chunk.append((index, _object_id(item)))
+        except ValueError as e:
+            report.errors.append(BulkItemError(index=index, detail=str(e)))
+            continue
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def bulk_delete(collection, request: Request, chunk_size: int, on_change: OnChange = None) -> BulkWriteReport:
+    """
+    Delete the documents whose ids are given as strings (or ``{"id": ...}`` objects), in batches of ``chunk_size``.
+    """
+    report = BulkWriteReport()
+    async for chunk in iter_bulk_ids(request, report, chunk_size):
+        await _delete_chunk(collection, chunk, report, on_change)
+
+    report.errors.sort(key=lambda error: error.index)
+    return report
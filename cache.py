@@ -0,0 +1,200 @@
+"""
+In-process read cache for reference data (resources and storages).
+
+Entries expire after ``RENTAL_CACHE_TTL_SECONDS`` and the least recently used ones are
+evicted beyond ``RENTAL_CACHE_MAX_ENTRIES``. Concurrent misses for the same key share a
+single database call, run as its own task so that a caller giving up (e.g. a client
+disconnecting) does not cancel it for the others. Writes made through this process invalidate the affected entries;
+writes made by other workers are picked up from the change stream (see ``changestream``),
+or after the TTL when change streams are not available.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from pagination import fetch_page
+from settings import get_settings
+
+_MISSING = object()
+
+
+class AsyncTTLCache:
+    """
+    Bounded mapping with a per-entry TTL, LRU eviction and per-key request collapsing.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._loading: Dict[Hashable, asyncio.Task] = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def peek(self, key: Hashable) -> Any:
+        """
+        Return the cached value (counting a hit) or ``_MISSING``, without loading anything.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return _MISSING
+        expires_at, value = entry
+        if expires_at <= self._clock():
+            del self._entries[key]
+            return _MISSING
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.ttl <= 0:
+            return
+        self._entries[key] = (self._clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        value = self.peek(key)
+        if value is not _MISSING:
+            return value
+
+        self.misses += 1
+        if (loading := self._loading.get(key)) is not None:
+            self.coalesced += 1
+        else:
+            loading = asyncio.ensure_future(self._load(key, loader))
+            # Retrieved even if every caller gave up on it.
+            loading.add_done_callback(lambda task: task.cancelled() or task.exception())
+            self._loading[key] = loading
+        return await asyncio.shield(loading)
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        generation = self._generation
+        try:
+            value = await loader()
+        finally:
+            self._loading.pop(key, None)
+
+        # Do not cache a value that was read before an invalidation that happened meanwhile.
+        if generation == self._generation:
+            self.put(key, value)
+        return value
+
+    def invalidate(self, key: Hashable) -> None:
+        self._generation += 1
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._generation += 1
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else None,
+        }
+
+
+class ReferenceCache:
+    """
+    Documents by id and list pages of one rarely changing collection.
+    """
+
+    def __init__(self, collection_name: str, maxsize: int, ttl: float):
+        self.collection_name = collection_name
+        self.documents = AsyncTTLCache(f"{collection_name}.documents", maxsize, ttl)
+        self.pages = AsyncTTLCache(f"{collection_name}.pages", maxsize, ttl)
+
+    async def get(self, collection, _id) -> Optional[Dict]:
+        return await self.documents.get_or_load(_id, lambda: collection.find_one({"_id": _id}))
+
+    async def get_many(self, collection, ids: Iterable) -> Dict[Any, Dict]:
+        """
+        Return the documents with the given ids, loading every miss with a single ``$in`` query.
+        """
+        found, missing = {}, []
+        for _id in set(ids):
+            value = self.documents.peek(_id)
+            if value is _MISSING:
+                missing.append(_id)
+            elif value is not None:
+                found[_id] = value
+
+        if missing:
+            self.documents.misses += len(missing)
+            loaded = {document["_id"]: document async for document in collection.find({"_id": {"$in": missing}})}
+            for _id in missing:
+                self.documents.put(_id, loaded.get(_id))
+            found.update(loaded)
+        return found
+
+    async def page(self, collection, limit: int, after: Optional[str]) -> Tuple[List[Dict], Optional[str]]:
+        return await self.pages.get_or_load(
+            (limit, after), lambda: fetch_page(collection, limit=limit, after=after)
+        )
+
+    def invalidate(self, _id=None) -> None:
+        """
+        Forget the document ``_id`` (if given) and every cached list page.
+        """
+        if _id is not None:
+            self.documents.invalidate(_id)
+        self.pages.clear()
+
+    def clear(self) -> None:
+        self.documents.clear()
+        self.pages.clear()
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [self.documents.stats(), self.pages.stats()]
+
+
+_settings = get_settings()
+resource_cache = ReferenceCache("resources", _settings.cache_max_entries, _settings.cache_ttl_seconds)
+storage_cache = ReferenceCache("storages", _settings.cache_max_entries, _settings.cache_ttl_seconds)
+reference_caches: Dict[str, ReferenceCache] = {"resources": resource_cache, "storages": storage_cache}
+
+
+async def invalidate_changes(collection, changes: Iterable[Tuple[Optional[Dict], Optional[Dict]]]) -> None:
+    """
+    Write hook (same signature as ``services.summary.record_changes``) that drops stale entries.
+    """
+    cache = reference_caches.get(collection.name)
+    if cache is None:
+        return
+    for before, after in changes:
+        cache.invalidate((before or after)["_id"])
+
+
+async def invalidate_from_change(change: Dict) -> None:
+    """
+    Change stream handler: evict what another worker (or this one) just wrote.
+    """
+    cache = reference_caches.get(change.get("ns", {}).get("coll"))
+    if cache is None:
+        return
+    if (document_key := change.get("documentKey")) is not None:
+        cache.invalidate(document_key["_id"])
+    else:
+        # drop, rename, invalidate: anything may have changed
+        cache.clear()
+
+
+async def clear_all() -> None:
+    for cache in reference_caches.values():
+        cache.clear()
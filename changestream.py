@@ -0,0 +1,151 @@
+"""
+Background tailing of a MongoDB change stream.
+
+Used to keep per-worker state (such as the read caches) in sync with writes made by
+other workers. Change streams need a replica set or sharded cluster; against a
+standalone mongod the watcher logs a warning and stops, and callers fall back to
+whatever they do without it (TTL expiry for the caches).
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+TOKEN_COLLECTION = "change_stream_tokens"
+TOKEN_FLUSH_SECONDS = 1.0
+RETRY_DELAY_SECONDS = (0.5, 1, 2, 5, 10)
+
+# Server error codes meaning change streams cannot be used at all, or the stored resume
+# token can no longer be used.
+_UNSUPPORTED_CODES = {40573, 40324}
+_HISTORY_LOST_CODES = {280, 286, 260}
+
+ChangeHandler = Callable[[Dict], Awaitable[None]]
+
+
+class ChangeStreamWatcher:
+    """
+    Tail the changes to ``collections`` of ``db`` and pass every event to ``handlers``.
+
+    The resume token is stored under ``name`` in the ``change_stream_tokens`` collection
+    (at most once per second) so a restarted watcher carries on where it stopped; every
+    consumer needs a name of its own. Without ``resume`` nothing is stored and the watcher
+    starts from the current time, for consumers whose state is read afresh on start and
+    must not be fed the events replayed from before (they still resume after an
+    interruption). ``on_reset`` is awaited when events may have been missed, i.e. when the
+    stored token is too old to resume from.
+    """
+
+    def __init__(
+        self,
+        db,
+        name: str,
+        collections: List[str],
+        handlers: List[ChangeHandler],
+        on_reset: Optional[Callable[[], Awaitable[None]]] = None,
+        resume: bool = True,
+    ):
+        self.db = db
+        self.name = name
+        self.resume = resume
+        self.collections = collections
+        self.handlers = handlers
+        self.on_reset = on_reset
+        self.active = False
+        self._token: Optional[Dict] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def _load_token(self) -> Optional[Dict]:
+        if not self.resume:
+            return None
+        document = await self.db[TOKEN_COLLECTION].find_one({"_id": self.name})
+        return document["token"] if document else None
+
+    async def _save_token(self, token: Dict) -> None:
+        if not self.resume:
+            return
+        await self.db[TOKEN_COLLECTION].update_one(
+            {"_id": self.name},
+            {"$set": {"token": token, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True,
+        )
+
+    async def _dispatch(self, change: Dict) -> None:
+        for handler in self.handlers:
+            try:
+                await handler(change)
+            except Exception:
+                logger.exception("Change stream handler %r failed", handler)
+
+    async def run(self) -> None:
+        pipeline = [
+            {"$match": {"ns.coll": {"$in": self.collections}}},
+            {"$project": {"operationType": 1, "ns": 1, "documentKey": 1, "updateDescription.updatedFields": 1}},
+        ]
+        self._token = await self._load_token()
+        attempt = 0
+
+        while True:
+            try:
+                async with self.db.watch(pipeline, resume_after=self._token) as stream:
+                    self.active = True
+                    attempt = 0
+                    logger.info("Change stream %s watching %s", self.name, ", ".join(self.collections))
+                    last_flush = time.monotonic()
+                    async for change in stream:
+                        await self._dispatch(change)
+                        self._token = stream.resume_token
+                        if time.monotonic() - last_flush >= TOKEN_FLUSH_SECONDS:
+                            await self._save_token(self._token)
+                            last_flush = time.monotonic()
+                # The stream only ends by itself after an "invalidate" event (database dropped).
+                self._token = None
+                if self.on_reset is not None:
+                    await self.on_reset()
+                continue
+            except OperationFailure as e:
+                self.active = False
+                if e.code in _UNSUPPORTED_CODES:
+                    logger.warning("Change streams unavailable (%s); relying on cache TTLs only", e)
+                    return
+                if e.code in _HISTORY_LOST_CODES and self._token is not None:
+                    logger.warning("Cannot resume change stream %s (%s); starting from now", self.name, e)
+                    self._token = None
+                    if self.on_reset is not None:
+                        await self.on_reset()
+                    continue
+                logger.warning("Change stream %s failed: %s", self.name, e)
+            except PyMongoError as e:
+                self.active = False
+                logger.warning("Change stream %s interrupted: %s", self.name, e)
+
+            delay = RETRY_DELAY_SECONDS[min(attempt, len(RETRY_DELAY_SECONDS) - 1)]
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def start(self) -> asyncio.Task:
+        self._task = asyncio.create_task(self.run(), name=f"change-stream:{self.name}")
+        return self._task
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.exception("Change stream %s stopped with an error", self.name)
+        self._task = None
+        self.active = False
+        if self._token is not None:
+            try:
+                await self._save_token(self._token)
+            except PyMongoError as e:
+                logger.warning("Could not store the resume token of %s: %s", self.name, e)
@@ -0,0 +1,391 @@
+"""
+ETags, conditional GETs and Cache-Control for the read endpoints.
+
+Every collection has a version number, shared by all workers in the ``collection_versions``
+collection (one ``{"_id": <collection>, "version": <n>}`` document each). :data:`write_tracker`,
+a pymongo command listener, sees every write this process makes, whatever code path it comes
+from; the collections a request wrote to have their versions incremented before its response
+is sent (:func:`publishing_writes`), and writes made outside a request soon after. A GET
+endpoint decorated with :func:`conditional` names the collections its response is computed
+from, and its ``ETag`` is made of their versions, so it is the same on every worker. A
+matching ``If-None-Match`` is answered with a 304 before the endpoint runs.
+
+With an active change stream, the versions are mirrored in memory from the change events
+of ``collection_versions`` (a stream of its own, never resumed from before a restart: the
+mirror starts empty and reads the current versions) and 304s are answered without
+touching MongoDB; otherwise computing an ETag reads them, one indexed query. Writes made outside the service (e.g. from
+the mongo shell) do not change any version.
+
+Endpoints returning one document are declared with :func:`conditional_document` instead:
+their ``ETag`` is the document's own version (:func:`responses.document_etag`), the one
+``If-Match`` is checked against by the updates, so it is only known once the endpoint ran.
+
+Endpoints declared ``shared`` (the aggregations) can also keep their responses in a
+response cache shared by all clients (``RENTAL_RESPONSE_CACHE_TTL_SECONDS``), keyed by the
+path, the query parameters and the ETag, so a write makes the old entries unreachable.
+"""
+import asyncio
+import contextvars
+import logging
+import threading
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Optional, Set, Tuple
+
+from fastapi import Request, Response
+from pymongo import ReturnDocument, monitoring
+
+from cache import AsyncTTLCache
+from changestream import TOKEN_COLLECTION
+from instrumentation import InstrumentedRoute
+from settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+VERSIONS_COLLECTION = "collection_versions"
+
+# Write commands and the field naming the collection they write to
+_WRITE_COMMANDS = {"insert", "update", "delete", "findAndModify", "create", "drop"}
+_END_TRANSACTION = {"commitTransaction", "abortTransaction"}
+# Collections whose writes do not make a new version: the versions themselves, and the
+# change stream's resume tokens, saved every second
+_UNVERSIONED = {VERSIONS_COLLECTION, TOKEN_COLLECTION}
+
+
+class _Writes:
+    """
+    The collections written while a request (or command) runs, until it is done.
+    """
+
+    def __init__(self):
+        self._collections: Set[str] = set()
+        self._open = True
+        self._lock = threading.Lock()
+
+    def add(self, collections: Iterable[str]) -> bool:
+        with self._lock:
+            if self._open:
+                self._collections.update(collections)
+            return self._open
+
+    def close(self) -> Set[str]:
+        with self._lock:
+            self._open = False
+            return self._collections
+
+
+_writes: contextvars.ContextVar[Optional[_Writes]] = contextvars.ContextVar("collection_writes", default=None)
+
+
+class CollectionVersions:
+    """
+    The shared per-collection versions, their in-memory mirror and the ETags made of them.
+    """
+
+    def __init__(self):
+        # ChangeStreamWatcher keeping the mirror current, if any
+        self.watcher = None
+        self._known: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _mirrored(self) -> bool:
+        return self.watcher is not None and self.watcher.active
+
+    def learn(self, versions: Dict[str, int]) -> None:
+        # Only while the change stream runs: nothing would tell the mirror about later bumps.
+        if not self._mirrored():
+            return
+        # Versions only go up; change events may arrive after a newer version was read.
+        with self._lock:
+            for name, version in versions.items():
+                self._known[name] = max(version, self._known.get(name, 0))
+
+    def forget(self, collections: Iterable[str]) -> None:
+        with self._lock:
+            for name in collections:
+                self._known.pop(name, None)
+
+    def reset(self) -> None:
+        """
+        Forget the mirror, e.g. when change stream events may have been missed.
+        """
+        with self._lock:
+            self._known.clear()
+
+    async def bump(self, db, collections: Iterable[str]) -> None:
+        """
+        Make a new version of ``collections``, invalidating the ETags computed from them.
+        """
+        collections = sorted(set(collections) - _UNVERSIONED)
+        if not collections:
+            return
+        versions = db[VERSIONS_COLLECTION]
+        documents = await asyncio.gather(*(
+            versions.find_one_and_update(
+                {"_id": name}, {"$inc": {"version": 1}}, upsert=True, return_document=ReturnDocument.AFTER
+            )
+            for name in collections
+        ))
+        self.learn({document["_id"]: document["version"] for document in documents})
+
+    async def etag(self, db, collections: Iterable[str]) -> str:
+        """
+        The current ETag of a response computed from ``collections``.
+        """
+        collections = list(collections)
+        current: Dict[str, int] = {}
+        if self._mirrored():
+            with self._lock:
+                current = {name: self._known[name] for name in collections if name in self._known}
+        if missing := [name for name in collections if name not in current]:
+            found = {
+                document["_id"]: document["version"]
+                async for document in db[VERSIONS_COLLECTION].find({"_id": {"$in": missing}})
+            }
+            loaded = {name: found.get(name, 0) for name in missing}
+            self.learn(loaded)
+            current.update(loaded)
+        return '"' + "-".join(str(current[name]) for name in collections) + '"'
+
+
+versions = CollectionVersions()
+
+
+@asynccontextmanager
+async def publishing_writes(db) -> AsyncIterator[None]:
+    """
+    Bump the versions of the collections written inside the block once it is done.
+    """
+    writes = _Writes()
+    token = _writes.set(writes)
+    try:
+        yield
+    finally:
+        _writes.reset(token)
+        # Written to, even if the block failed halfway.
+        if collections := writes.close():
+            await versions.bump(db, collections)
+
+
+def _written_collections(command_name: str, command: Dict) -> Tuple[str, ...]:
+    if command_name in _WRITE_COMMANDS:
+        target = command.get(command_name)
+        return (target,) if isinstance(target, str) else ()
+    if command_name == "renameCollection":
+        # Full namespaces, "<database>.<collection>"
+        return tuple(command[key].split(".", 1)[-1] for key in ("renameCollection", "to") if isinstance(command.get(key), str))
+    if command_name == "aggregate" and command.get("pipeline"):
+        last = command["pipeline"][-1]
+        target = last.get("$out", last.get("$merge")) if isinstance(last, dict) else None
+        if isinstance(target, dict):
+            target = target.get("coll", target.get("into"))
+        return (target,) if isinstance(target, str) else ()
+    return ()
+
+
+class WriteTracker(monitoring.CommandListener):
+    """
+    Pymongo command listener reporting every collection this process writes to.
+
+    Writes count once they are done (or failed, as they may have been partly applied), and
+    writes inside a transaction once it is committed or aborted, so that an ETag computed
+    before a response is read never outlives the data it was read from. They are added to
+    the running :func:`publishing_writes` block, if any; otherwise (background tasks) their
+    versions are bumped as soon as possible on the loop given to :meth:`attach`.
+    """
+
+    def __init__(self, versions: CollectionVersions):
+        self.versions = versions
+        self._pending: Dict[Tuple[Any, int], Tuple[str, ...]] = {}
+        self._transactions: Dict[Any, Set[str]] = {}
+        self._lock = threading.Lock()
+        self._db = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def attach(self, db, loop: asyncio.AbstractEventLoop) -> None:
+        self._db, self._loop = db, loop
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        command = event.command
+        session = command.get("lsid", {}).get("id") if isinstance(command.get("lsid"), dict) else None
+        with self._lock:
+            if event.command_name in _END_TRANSACTION:
+                collections = tuple(self._transactions.pop(session, ()))
+            else:
+                collections = tuple(set(_written_collections(event.command_name, command)) - _UNVERSIONED)
+                if collections and command.get("autocommit") is False:
+                    self._transactions.setdefault(session, set()).update(collections)
+                    return
+            if collections:
+                self._pending[(event.connection_id, event.request_id)] = collections
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._finish(event)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._finish(event)
+
+    def _finish(self, event) -> None:
+        with self._lock:
+            collections = self._pending.pop((event.connection_id, event.request_id), None)
+        if not collections:
+            return
+        writes = _writes.get()
+        if writes is not None and writes.add(collections):
+            return
+        if self._loop is not None:
+            # Not part of whatever the current context is doing.
+            contextvars.Context().run(asyncio.run_coroutine_threadsafe, self._bump(collections), self._loop)
+
+    async def _bump(self, collections: Tuple[str, ...]) -> None:
+        try:
+            await self.versions.bump(self._db, collections)
+        except Exception:
+            logger.exception("Could not bump the versions of %s", ", ".join(collections))
+
+
+write_tracker = WriteTracker(versions)
+
+
+async def versions_from_change(change: Dict) -> None:
+    """
+    Change stream handler: mirror the versions bumped by other workers (or this one).
+    """
+    collection = change.get("ns", {}).get("coll")
+    if collection is None:
+        # dropDatabase, invalidate: anything may have changed
+        versions.reset()
+        return
+    if collection != VERSIONS_COLLECTION or "documentKey" not in change:
+        return
+    name = change["documentKey"]["_id"]
+    version = change.get("updateDescription", {}).get("updatedFields", {}).get("version")
+    if version is not None:
+        versions.learn({name: version})
+    else:
+        # Inserted or deleted: read it again when it is next needed.
+        versions.forget([name])
+
+
+@dataclass(frozen=True)
+class CachePolicy:
+    collections: Tuple[str, ...]
+    cache_control: str
+    shared: bool = False
+    per_day: bool = False
+    # The ETag is the one of the document the endpoint returns
+    document: bool = False
+
+
+def conditional(*collections: str, max_age: int = 0, shared: bool = False, per_day: bool = False) -> Callable:
+    """
+    Declare that the decorated GET endpoint's response only depends on ``collections``.
+
+    Clients may reuse a response for ``max_age`` seconds without asking (by default they
+    have to revalidate it every time). ``shared`` endpoints may be answered from the shared
+    response cache. ``per_day`` endpoints also depend on the current (UTC) date.
+    """
+    cache_control = f"public, max-age={max_age}" if max_age else "no-cache"
+
+    def decorate(endpoint):
+        endpoint.cache_policy = CachePolicy(tuple(collections), cache_control, shared, per_day)
+        return endpoint
+
+    return decorate
+
+
+def conditional_document(max_age: int = 0) -> Callable:
+    """
+    Declare that the decorated GET endpoint returns one document, with its own ``ETag``.
+    """
+    cache_control = f"public, max-age={max_age}" if max_age else "no-cache"
+
+    def decorate(endpoint):
+        endpoint.cache_policy = CachePolicy((), cache_control, document=True)
+        return endpoint
+
+    return decorate
+
+
+def if_none_match(header: Optional[str], etag: str) -> bool:
+    """
+    Whether ``header`` matches ``etag``; ``*`` matches any current representation, so it
+    must only be checked once the endpoint has found one.
+    """
+    if header is None:
+        return False
+    if header.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison.
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+_settings = get_settings()
+response_cache = AsyncTTLCache("responses", _settings.cache_max_entries, _settings.response_cache_ttl_seconds)
+
+
+def _cache_key(request: Request, etag: str) -> Tuple:
+    return request.url.path, tuple(sorted(request.query_params.multi_items())), etag
+
+
+class ConditionalRoute(InstrumentedRoute):
+    """
+    Route bumping the versions of the collections its endpoint writes to, and serving
+    ``ETag``/``Cache-Control`` headers and 304s for endpoints declared with :func:`conditional`.
+    """
+
+    def get_route_handler(self):
+        handler = self._conditional_handler(super().get_route_handler())
+
+        async def publishing_handler(request: Request) -> Response:
+            async with publishing_writes(request.app.state.db):
+                return await handler(request)
+
+        return publishing_handler
+
+    def _conditional_handler(self, handler):
+        policy: Optional[CachePolicy] = getattr(self.endpoint, "cache_policy", None)
+        if policy is None:
+            return handler
+
+        # Only the endpoint knows the document, and so its ETag.
+        async def document_handler(request: Request) -> Response:
+            response = await handler(request)
+            if response.status_code != 200 or "etag" not in response.headers:
+                return response
+            headers = {"ETag": response.headers["etag"], "Cache-Control": policy.cache_control}
+            if if_none_match(request.headers.get("if-none-match"), headers["ETag"]):
+                return Response(status_code=304, headers=headers)
+            response.headers.update(headers)
+            return response
+
+        async def conditional_handler(request: Request) -> Response:
+            if not get_settings().http_caching_enabled:
+                return await handler(request)
+            if policy.document:
+                return await document_handler(request)
+            etag = await versions.etag(request.app.state.db, policy.collections)
+            if policy.per_day:
+                etag = f'{etag[:-1]}-{datetime.now(timezone.utc).date().isoformat()}"'
+            headers = {"ETag": etag, "Cache-Control": policy.cache_control}
+            header = request.headers.get("if-none-match")
+            # "*" asks whether the resource exists at all: only the endpoint knows.
+            if header is not None and header.strip() != "*" and if_none_match(header, etag):
+                return Response(status_code=304, headers=headers)
+
+            if policy.shared and response_cache.ttl > 0:
+                key = _cache_key(request, etag)
+                response = await response_cache.get_or_load(key, lambda: handler(request))
+                if response.status_code != 200:
+                    response_cache.invalidate(key)
+            else:
+                response = await handler(request)
+            if response.status_code != 200:
+                return response
+            if if_none_match(header, etag):
+                return Response(status_code=304, headers=headers)
+            response.headers.update(headers)
+            return response
+
+        return conditional_handler
@@ -0,0 +1,79 @@
+import asyncio
+from typing import Annotated, Sequence
+
+import motor.motor_asyncio
+from fastapi import Depends, Request
+
+from settings import Settings
+
+AsyncIOMotorClient = motor.motor_asyncio.AsyncIOMotorClient
+AsyncIOMotorDatabase = motor.motor_asyncio.AsyncIOMotorDatabase
+AsyncIOMotorCollection = motor.motor_asyncio.AsyncIOMotorCollection
+
+
+def create_client(settings: Settings, event_listeners: Sequence = ()) -> AsyncIOMotorClient:
+    """
+    Build the single Motor client (and therefore the single connection pool) used by the process.
+
+    ``event_listeners`` are pymongo monitoring listeners, e.g. to count the commands sent.
+    """
+    options = {
+        "maxPoolSize": settings.max_pool_size,
+        "minPoolSize": settings.min_pool_size,
+        "connectTimeoutMS": settings.connect_timeout_ms,
+        "serverSelectionTimeoutMS": settings.server_selection_timeout_ms,
+        "readPreference": settings.read_preference,
+        "appname": settings.app_name,
+    }
+    if settings.max_idle_time_ms is not None:
+        options["maxIdleTimeMS"] = settings.max_idle_time_ms
+    if settings.wait_queue_timeout_ms is not None:
+        options["waitQueueTimeoutMS"] = settings.wait_queue_timeout_ms
+    if settings.socket_timeout_ms is not None:
+        options["socketTimeoutMS"] = settings.socket_timeout_ms
+    if settings.compressors:
+        options["compressors"] = settings.compressors
+    if settings.write_concern is not None:
+        w = settings.write_concern
+        options["w"] = int(w) if w.isdigit() else w
+    if settings.write_journal is not None:
+        options["journal"] = settings.write_journal
+    if event_listeners:
+        options["event_listeners"] = list(event_listeners)
+
+    return AsyncIOMotorClient(settings.mongodb_url, **options)
+
+
+async def warm_up(client: AsyncIOMotorClient, settings: Settings) -> None:
+    """
+    Make sure the deployment is reachable and open ``min_pool_size`` connections up front,
+    so the first requests after startup do not pay for the TCP/TLS handshakes.
+    """
+    await client.admin.command("ping")
+    if settings.min_pool_size > 1:
+        await asyncio.gather(
+            *(client.admin.command("ping") for _ in range(settings.min_pool_size))
+        )
+
+
+def get_database(request: Request) -> AsyncIOMotorDatabase:
+    return request.app.state.db
+
+
+def get_collection(name: str):
+    """
+    Return a dependency that resolves to the named collection of the application database.
+    """
+
+    def dependency(request: Request) -> AsyncIOMotorCollection:
+        return request.app.state.db[name]
+
+    return dependency
+
+
+DatabaseDep = Annotated[AsyncIOMotorDatabase, Depends(get_database)]
+ResourcesDep = Annotated[AsyncIOMotorCollection, Depends(get_collection("resources"))]
+StoragesDep = Annotated[AsyncIOMotorCollection, Depends(get_collection("storages"))]
+StockItemsDep = Annotated[AsyncIOMotorCollection, Depends(get_collection("stock_items"))]
+ReservationsDep = Annotated[AsyncIOMotorCollection, Depends(get_collection("reservations"))]
+DamagesDep = Annotated[AsyncIOMotorCollection, Depends(get_collection("damages"))]
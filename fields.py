@@ -0,0 +1,159 @@
+"""
+Sparse fieldsets: the ``fields`` query parameter of the GET endpoints.
+
+``fields=title,platform`` returns only those fields of each document, under the names the
+API returns them with (``id`` is always included for documents with a model); fields of
+embedded documents are selected with dots, e.g. ``fields=booking_date,resource_details.title``.
+The selection becomes a MongoDB projection (:func:`projection`), so the other fields are
+neither sent by the server nor decoded, and documents that come from a cache are trimmed
+in memory (:func:`select_fields`). Selected documents no longer match the response models,
+so they are always encoded straight with orjson.
+"""
+from functools import lru_cache
+from typing import Annotated, Any, Dict, Iterable, Optional, Tuple, Type
+
+from fastapi import Depends, HTTPException, Query
+from pydantic import BaseModel
+
+Fields = Tuple[str, ...]
+# {stored key: None for the whole value, or the tree of the fields selected in it}
+FieldTree = Dict[str, Optional[Dict]]
+
+_SKIP = object()
+
+
+def parse_fields(
+    fields: Optional[str] = Query(
+        None, description="Comma-separated fields to return, e.g. `title,platform`; use dots for embedded fields"
+    ),
+) -> Optional[Fields]:
+    if fields is None:
+        return None
+    names = tuple(dict.fromkeys(name.strip() for name in fields.split(",") if name.strip()))
+    if not names or any("" in name.split(".") or name.startswith("$") for name in names):
+        raise HTTPException(status_code=400, detail=f"Invalid fields {fields!r}")
+    return names
+
+
+FieldsDep = Annotated[Optional[Fields], Depends(parse_fields)]
+
+
+@lru_cache
+def _stored_keys(model: Type[BaseModel]) -> Dict[str, str]:
+    return {name: field.alias or name for name, field in model.model_fields.items()}
+
+
+def _add(tree: FieldTree, path: Iterable[str]) -> None:
+    *parents, leaf = path
+    for part in parents:
+        if part in tree and tree[part] is None:
+            return  # the whole parent is selected already
+        tree = tree.setdefault(part, {})
+    tree[leaf] = None
+
+
+@lru_cache(maxsize=256)
+def _tree(model: Optional[Type[BaseModel]], fields: Fields) -> FieldTree:
+    """
+    The selection as a tree of stored keys; raise a 400 for a field ``model`` does not have.
+    """
+    if model is None:
+        tree: FieldTree = {}
+        for path in fields:
+            _add(tree, path.split("."))
+        return tree
+
+    stored = _stored_keys(model)
+    extra = model.model_config.get("extra") == "allow"
+    tree = {"_id": None}
+    for path in fields:
+        name, *rest = path.split(".")
+        # Stored keys of renamed fields (e.g. "_id", "name" for "title") are not API names.
+        if name not in stored and (not extra or name in stored.values()):
+            raise HTTPException(status_code=400, detail=f"Unknown field {name!r}")
+        _add(tree, [stored.get(name, name), *rest])
+    return tree
+
+
+def check_fields(model: Optional[Type[BaseModel]], fields: Fields) -> None:
+    """
+    Raise a 400 for a field ``model`` does not have, whether or not there is a document to select it from.
+    """
+    _tree(model, fields)
+
+
+def _flatten(tree: FieldTree, prefix: str = "") -> Dict[str, int]:
+    paths = {}
+    for key, subtree in tree.items():
+        if subtree is None:
+            paths[prefix + key] = 1
+        else:
+            paths.update(_flatten(subtree, prefix + key + "."))
+    return paths
+
+
+def projection(model: Optional[Type[BaseModel]], fields: Optional[Fields], keep: Iterable[str] = ()) -> Optional[Dict]:
+    """
+    The MongoDB projection of ``fields`` (``None`` for every field).
+
+    ``keep`` lists stored keys the caller needs whether or not they are selected, such as
+    the sort keys of a page; :func:`select_fields` drops them again.
+    """
+    if fields is None:
+        return None
+    tree = _copy(_tree(model, fields))
+    for path in keep:
+        _add(tree, path.split("."))
+    return _flatten(tree)
+
+
+def _copy(tree: FieldTree) -> FieldTree:
+    return {key: None if subtree is None else _copy(subtree) for key, subtree in tree.items()}
+
+
+def _pick(value: Any, tree: Optional[FieldTree]) -> Any:
+    # Mirrors what a projection of the same paths returns.
+    if tree is None:
+        return value
+    if isinstance(value, dict):
+        picked = {}
+        for key, subtree in tree.items():
+            if key in value and (inner := _pick(value[key], subtree)) is not _SKIP:
+                picked[key] = inner
+        return picked
+    if isinstance(value, list):
+        return [inner for item in value if (inner := _pick(item, tree)) is not _SKIP]
+    return _SKIP
+
+
+def select_fields(model: Optional[Type[BaseModel]], document: Dict, fields: Fields) -> Dict:
+    """
+    The selected fields of ``document``, renamed to the names ``model`` returns them with.
+
+    Like the response models, fields of ``model`` missing from the document get their default.
+    """
+    tree = _tree(model, fields)
+    if model is None:
+        return _pick(document, tree)
+
+    names = {stored: name for name, stored in _stored_keys(model).items()}
+    output = {}
+    for key, subtree in tree.items():
+        name = names.get(key, key)
+        if key in document:
+            if (value := _pick(document[key], subtree)) is not _SKIP:
+                output[name] = value
+        elif name in model.model_fields and not model.model_fields[name].is_required():
+            output[name] = model.model_fields[name].get_default(call_default_factory=True)
+    return output
+
+
+def fields_under(fields: Optional[Fields], name: str) -> Optional[Fields]:
+    """
+    The fields selected inside the embedded document(s) ``name``: ``None`` if all of them
+    are (including when there is no selection), ``()`` if none are.
+    """
+    if fields is None or name in fields:
+        return None
+    prefix = name + "."
+    return tuple(path[len(prefix):] for path in fields if path.startswith(prefix))
@@ -0,0 +1,38 @@
+"""
+Document ids given in the path or the query string, as validated ObjectIds.
+
+A path id that is not an ObjectId cannot name an existing document, so it is answered
+with a 404, like an unknown one; a malformed id in the query string is a 400.
+"""
+from typing import Callable, Optional
+
+from bson import ObjectId
+from fastapi import HTTPException, Path, Query
+
+
+def path_id(name: str, what: str) -> Callable[..., ObjectId]:
+    """
+    Dependency returning the ``{name}`` path parameter, the id of a ``what`` (e.g. "Resource").
+    """
+
+    def dependency(value: str = Path(..., alias=name)) -> ObjectId:
+        if not ObjectId.is_valid(value):
+            raise HTTPException(status_code=404, detail=f"{what} {value} not found")
+        return ObjectId(value)
+
+    return dependency
+
+
+def query_id(name: str, description: str) -> Callable[..., Optional[ObjectId]]:
+    """
+    Dependency returning the optional ``name`` query parameter as an ObjectId.
+    """
+
+    def dependency(value: Optional[str] = Query(None, alias=name, description=description)) -> Optional[ObjectId]:
+        if value is None:
+            return None
+        if not ObjectId.is_valid(value):
+            raise HTTPException(status_code=400, detail=f"{name} must be a 24-character hex ObjectId")
+        return ObjectId(value)
+
+    return dependency
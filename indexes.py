@@ -0,0 +1,143 @@
+import logging
+import re
+from typing import Dict, List
+
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Options that make two indexes with the same name different from each other.
+_COMPARED_OPTIONS = ("unique", "sparse", "partialFilterExpression", "expireAfterSeconds", "collation")
+
+# Secondary indexes of every collection, keyed by collection name. Every index must be named,
+# the name is what reconciliation matches on.
+INDEXES: Dict[str, List[IndexModel]] = {
+    "stock_items": [
+        IndexModel([("storage_id", ASCENDING), ("resource_id", ASCENDING)], name="storage_id_resource_id"),
+        IndexModel([("resource_id", ASCENDING), ("storage_id", ASCENDING)], name="resource_id_storage_id"),
+        # Damaged stock items only, for the paginated damage report.
+        IndexModel(
+            [("storage_id", ASCENDING), ("_id", ASCENDING)],
+            name="damaged_storage_id",
+            partialFilterExpression={"damage_count": {"$gt": 0}},
+        ),
+    ],
+    "reservations": [
+        IndexModel([("stock_item_id", ASCENDING), ("booking_date", ASCENDING)], name="stock_item_id_booking_date"),
+        IndexModel([("return_date", ASCENDING)], name="return_date"),
+        # Open loans only: small, and exactly what the unreturned queries look for.
+        IndexModel(
+            [("stock_item_id", ASCENDING), ("booking_date", ASCENDING)],
+            name="unreturned_stock_item_id_booking_date",
+            partialFilterExpression={"return_date": None},
+        ),
+    ],
+    "damages": [
+        IndexModel([("stock_item_id", ASCENDING)], name="stock_item_id"),
+        IndexModel([("reservation_id", ASCENDING)], name="reservation_id", sparse=True),
+        # Only damages marked as resolved, which the archival job looks for.
+        IndexModel([("resolved_at", ASCENDING)], name="resolved_at", sparse=True),
+    ],
+    "reservation_views": [
+        IndexModel(
+            [("stock_item_details.storage_id", ASCENDING), ("booking_date", ASCENDING), ("_id", ASCENDING)],
+            name="storage_id_booking_date",
+        ),
+        IndexModel([("booking_date", ASCENDING), ("_id", ASCENDING)], name="booking_date"),
+        IndexModel([("stock_item_id", ASCENDING)], name="stock_item_id"),
+        IndexModel([("stock_item_details.resource_id", ASCENDING)], name="resource_id"),
+    ],
+    "stock_item_availability": [
+        IndexModel([("resource_id", ASCENDING), ("storage_id", ASCENDING)], name="resource_id_storage_id"),
+    ],
+    "reservation_stats": [
+        IndexModel(
+            [("dimension", ASCENDING), ("granularity", ASCENDING), ("key", ASCENDING), ("start", ASCENDING)],
+            name="dimension_granularity_key_start",
+            unique=True,
+        ),
+        # Every resource (or storage) of a period
+        IndexModel(
+            [("dimension", ASCENDING), ("granularity", ASCENDING), ("start", ASCENDING), ("key", ASCENDING)],
+            name="dimension_granularity_start_key",
+        ),
+    ],
+    "idempotency_keys": [
+        # Keys of PUT requests are forgotten once expired (see updates.idempotent).
+        IndexModel([("expires_at", ASCENDING)], name="expires_at", expireAfterSeconds=0),
+    ],
+}
+
+
+def _normalise(index: Dict) -> Dict:
+    normalised = {"key": list(dict(index["key"]).items())}
+    for option in _COMPARED_OPTIONS:
+        if option in index:
+            normalised[option] = index[option]
+    return normalised
+
+
+async def _indexes_in_progress(db) -> Dict[str, List[str]]:
+    """
+    Return the names of the index builds currently running in ``db``, per collection.
+
+    Requires the ``inprog`` privilege; without it no build is reported.
+    """
+    pipeline = [
+        {"$currentOp": {"allUsers": True, "idleConnections": False}},
+        {"$match": {"command.createIndexes": {"$exists": True}, "ns": {"$regex": f"^{re.escape(db.name)}\\."}}},
+    ]
+    in_progress: Dict[str, List[str]] = {}
+    try:
+        operations = await db.client.admin.aggregate(pipeline).to_list(None)
+    except OperationFailure as e:
+        logger.warning("Cannot inspect running index builds: %s", e)
+        return in_progress
+
+    for operation in operations:
+        command = operation["command"]
+        names = in_progress.setdefault(command["createIndexes"], [])
+        names.extend(index["name"] for index in command.get("indexes", []))
+    return in_progress
+
+
+async def reconcile_indexes(db, *, create: bool = True, drop_extra: bool = False) -> Dict[str, Dict[str, List[str]]]:
+    """
+    Compare the indexes in the database with :data:`INDEXES` and report, per collection,
+    the indexes that are ``missing``, ``extra`` (not declared), ``changed`` (same name,
+    different definition) and ``in_progress``.
+
+    With ``create`` the missing indexes are built (``created``), with ``drop_extra`` the
+    undeclared ones are dropped (``dropped``). Running it again is always safe.
+    """
+    in_progress = await _indexes_in_progress(db)
+    report = {}
+
+    for collection_name, declared in INDEXES.items():
+        collection = db[collection_name]
+        existing = {index["name"]: index async for index in collection.list_indexes()}
+        existing.pop("_id_", None)
+        building = in_progress.get(collection_name, [])
+        declared_by_name = {index.document["name"]: index for index in declared}
+
+        missing = [name for name in declared_by_name if name not in existing and name not in building]
+        extra = [name for name in existing if name not in declared_by_name]
+        changed = [
+            name for name, index in declared_by_name.items()
+            if name in existing and _normalise(index.document) != _normalise(existing[name])
+        ]
+        entry = {"missing": missing, "extra": extra, "changed": changed, "in_progress": building}
+
+        if create and missing:
+            entry["created"] = await collection.create_indexes([declared_by_name[name] for name in missing])
+        if drop_extra:
+            for name in extra:
+                await collection.drop_index(name)
+            entry["dropped"] = extra
+
+        for name in changed:
+            logger.warning("Index %s.%s differs from its declaration; drop it to rebuild", collection_name, name)
+        report[collection_name] = entry
+
+    return report
@@ -0,0 +1,345 @@
+"""
+Per-request timing of database commands, Pydantic/serialization and the whole request.
+
+:class:`InstrumentationMiddleware` opens a :class:`RequestStats` for every HTTP request in a
+context variable. Motor runs pymongo calls on its thread pool with a copy of the caller's
+context, so :class:`CommandTimer` (a pymongo command listener) sees the stats of the request
+that issued each command and adds the command's duration to them. Routes built with
+:class:`InstrumentedRoute` record when the endpoint returned, which splits the time before
+the response starts into the endpoint itself (``handler``, database calls included) and
+response validation/encoding (``serialize``).
+
+Every response carries a ``Server-Timing`` header with these figures, and the process keeps
+Prometheus histograms per route and per collection, exposed by ``GET /metrics/prometheus``.
+Aggregations slower than ``RENTAL_SLOW_PIPELINE_MS`` are logged with their pipeline and a
+summary of their ``explain`` plan.
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from bson import json_util
+from fastapi.routing import APIRoute
+from pymongo import monitoring
+
+from settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+# The same slow pipeline shape (collection + stage names) is explained at most this often
+EXPLAIN_INTERVAL_SECONDS = 60.0
+MAX_LOGGED_PIPELINE_CHARS = 2000
+
+
+class Histogram:
+    """
+    Minimal thread-safe Prometheus histogram with labels.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str], buckets: Sequence[float]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: Tuple[str, ...], value: float) -> None:
+        position = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            if position < len(self.buckets):
+                series[0][position] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((labels, (list(counts), total, count)) for labels, (counts, total, count) in self._series.items())
+        for labels, (counts, total, count) in series:
+            label_text = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, labels))
+            prefix = label_text + "," if label_text else ""
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound:g}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{label_text}}} {total:.6f}")
+            lines.append(f"{self.name}_count{{{label_text}}} {count}")
+        return lines
+
+    def reset(self) -> None:
+        with self._lock:
+            self._series.clear()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+request_duration = Histogram(
+    "http_request_duration_seconds", "Time until the response was sent.", ("method", "route", "status"), LATENCY_BUCKETS
+)
+request_db_duration = Histogram(
+    "http_request_db_duration_seconds", "Time spent in database commands per request.", ("method", "route"), LATENCY_BUCKETS
+)
+request_serialize_duration = Histogram(
+    "http_request_serialize_duration_seconds",
+    "Time between the endpoint returning and the response starting (validation and encoding).",
+    ("method", "route"),
+    LATENCY_BUCKETS,
+)
+request_db_commands = Histogram(
+    "http_request_db_commands", "Database commands per request.", ("method", "route"), COUNT_BUCKETS
+)
+command_duration = Histogram(
+    "mongodb_command_duration_seconds",
+    "Duration of database commands, as measured by the driver.",
+    ("collection", "command", "outcome"),
+    LATENCY_BUCKETS,
+)
+HISTOGRAMS = (request_duration, request_db_duration, request_serialize_duration, request_db_commands, command_duration)
+
+
+def render_metrics() -> str:
+    return "\n".join(line for histogram in HISTOGRAMS for line in histogram.render()) + "\n"
+
+
+class RequestStats:
+    """
+    What one HTTP request spent, filled in by the middleware, the route and the command listener.
+    """
+
+    def __init__(self, method: str):
+        self.method = method
+        self.route: Optional[str] = None
+        self.started = time.perf_counter()
+        self.handler_done: Optional[float] = None
+        self.response_started: Optional[float] = None
+        self.db_seconds = 0.0
+        self.db_commands = 0
+        self._lock = threading.Lock()
+
+    def add_command(self, seconds: float) -> None:
+        with self._lock:
+            self.db_seconds += seconds
+            self.db_commands += 1
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+def _collection_of(command_name: str, command: Dict) -> str:
+    if command_name == "getMore":
+        target = command.get("collection")
+    else:
+        target = command.get(command_name)
+    return target if isinstance(target, str) else "-"
+
+
+def _stage_names(pipeline: Any) -> Tuple[str, ...]:
+    if not isinstance(pipeline, list):
+        return ()
+    return tuple(next(iter(stage), "?") for stage in pipeline if isinstance(stage, dict))
+
+
+def summarize_explain(explain: Dict) -> Dict[str, Any]:
+    """
+    Reduce an ``explain`` reply to the winning plan stages, the indexes used and whether
+    any collection was scanned (including in ``$lookup`` sub-pipelines).
+    """
+    stages: List[str] = []
+    indexes: List[str] = []
+
+    def walk(node: Any, in_plan: bool) -> None:
+        if isinstance(node, dict):
+            if in_plan and isinstance(node.get("stage"), str) and node["stage"] not in stages:
+                stages.append(node["stage"])
+            if in_plan and isinstance(node.get("indexName"), str) and node["indexName"] not in indexes:
+                indexes.append(node["indexName"])
+            for key, value in node.items():
+                if key in ("rejectedPlans", "command"):
+                    continue
+                walk(value, in_plan or key in ("winningPlan", "queryPlan"))
+        elif isinstance(node, list):
+            for value in node:
+                walk(value, in_plan)
+
+    walk(explain, False)
+    return {"stages": stages, "indexes": indexes, "collection_scan": "COLLSCAN" in stages}
+
+
+class CommandTimer(monitoring.CommandListener):
+    """
+    Pymongo command listener timing every command for the request (if any) that sent it.
+    """
+
+    def __init__(self, slow_pipeline_ms: float = 0.0, explain: bool = True):
+        self.slow_pipeline_ms = slow_pipeline_ms
+        self.explain = explain
+        self._pending: Dict[Tuple[Any, int], Tuple[str, Optional[Dict]]] = {}
+        self._lock = threading.Lock()
+        self._client = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._explained: Dict[Tuple, float] = {}
+
+    def attach(self, client, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Let the listener run ``explain`` for slow pipelines with ``client`` on ``loop``.
+        """
+        self._client, self._loop = client, loop
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        collection = _collection_of(event.command_name, event.command)
+        slow_check = None
+        if event.command_name == "aggregate" and self.slow_pipeline_ms:
+            slow_check = {"database": event.database_name, "command": event.command}
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = (collection, slow_check)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._finish(event, "success")
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._finish(event, "failure")
+
+    def _finish(self, event, outcome: str) -> None:
+        with self._lock:
+            collection, slow_check = self._pending.pop((event.connection_id, event.request_id), ("-", None))
+        seconds = event.duration_micros / 1_000_000
+        command_duration.observe((collection, event.command_name, outcome), seconds)
+        stats = current_request.get()
+        if stats is not None:
+            stats.add_command(seconds)
+        if slow_check is not None and seconds * 1000 >= self.slow_pipeline_ms:
+            self._report_slow_pipeline(collection, seconds, stats, **slow_check)
+
+    def _report_slow_pipeline(self, collection: str, seconds: float, stats: Optional[RequestStats], database: str, command: Dict) -> None:
+        pipeline = command.get("pipeline", [])
+        route = f"{stats.method} {stats.route}" if stats is not None and stats.route else "-"
+        text = json_util.dumps(pipeline)
+        if len(text) > MAX_LOGGED_PIPELINE_CHARS:
+            text = text[:MAX_LOGGED_PIPELINE_CHARS] + "..."
+
+        shape = (database, collection, _stage_names(pipeline))
+        now = time.monotonic()
+        with self._lock:
+            should_explain = (
+                self.explain
+                and self._client is not None
+                and now - self._explained.get(shape, float("-inf")) >= EXPLAIN_INTERVAL_SECONDS
+            )
+            if should_explain:
+                self._explained[shape] = now
+        if not should_explain:
+            logger.warning("Slow aggregation on %s.%s (%.1f ms, %s): %s", database, collection, seconds * 1000, route, text)
+            return
+
+        explain_command = {"aggregate": command.get("aggregate"), "pipeline": pipeline, "cursor": {}}
+        if "let" in command:
+            explain_command["let"] = command["let"]
+        coroutine = self._explain_and_log(database, collection, seconds, route, text, explain_command)
+        # The request's context must not leak into the explain: its command is not the request's.
+        contextvars.Context().run(asyncio.run_coroutine_threadsafe, coroutine, self._loop)
+
+    async def _explain_and_log(self, database: str, collection: str, seconds: float, route: str, text: str, command: Dict) -> None:
+        try:
+            explain = await self._client[database].command("explain", command, verbosity="queryPlanner")
+            summary = summarize_explain(explain)
+        except Exception as e:
+            summary = {"error": str(e)}
+        logger.warning(
+            "Slow aggregation on %s.%s (%.1f ms, %s): %s; plan: %s", database, collection, seconds * 1000, route, text, summary
+        )
+
+
+class InstrumentedRoute(APIRoute):
+    """
+    Route recording its path template and when its endpoint returned in the request's stats.
+    """
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        @functools.wraps(endpoint)
+        async def timed_endpoint(*args, **values):
+            try:
+                return await endpoint(*args, **values)
+            finally:
+                stats = current_request.get()
+                if stats is not None:
+                    stats.handler_done = time.perf_counter()
+
+        super().__init__(path, timed_endpoint, **kwargs)
+
+    async def handle(self, scope, receive, send) -> None:
+        stats = current_request.get()
+        if stats is not None:
+            stats.route = self.path_format
+        await super().handle(scope, receive, send)
+
+
+class InstrumentationMiddleware:
+    """
+    ASGI middleware adding ``Server-Timing`` to every response and feeding the request histograms.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(scope["method"])
+        token = current_request.set(stats)
+        status = "500"
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+                stats.response_started = time.perf_counter()
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(stats).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_request.reset(token)
+            route = stats.route or "unmatched"
+            request_duration.observe((stats.method, route, status), time.perf_counter() - stats.started)
+            request_db_duration.observe((stats.method, route), stats.db_seconds)
+            request_db_commands.observe((stats.method, route), stats.db_commands)
+            if stats.handler_done is not None and stats.response_started is not None:
+                request_serialize_duration.observe((stats.method, route), stats.response_started - stats.handler_done)
+
+
+def server_timing(stats: RequestStats) -> str:
+    """
+    ``Server-Timing`` value of a response that is starting.
+
+    ``db`` adds up the commands' durations, so concurrent commands can make it exceed ``handler``.
+    """
+    metrics = [f'db;dur={stats.db_seconds * 1000:.1f};desc="{stats.db_commands} commands"']
+    if stats.handler_done is not None:
+        metrics.append(f"handler;dur={(stats.handler_done - stats.started) * 1000:.1f}")
+        metrics.append(f"serialize;dur={(stats.response_started - stats.handler_done) * 1000:.1f}")
+    metrics.append(f"total;dur={(stats.response_started - stats.started) * 1000:.1f}")
+    return ", ".join(metrics)
+
+
+_settings = get_settings()
+command_timer = CommandTimer(_settings.slow_pipeline_ms, _settings.explain_slow_pipelines)
@@ -0,0 +1,133 @@
+"""
+Maintenance commands for the rental service database.
+
+Usage: python manage.py <command> [options]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+
+from conditional import publishing_writes, write_tracker
+from database import create_client
+from indexes import reconcile_indexes
+from migrations import migrate_object_id_foreign_keys
+from queries import QUERIES, check_query_plans
+from services.archive import archive_history
+from services.availability import rebuild_availability
+from services.damaged import rebuild_damage_counts
+from services.reservation_stats import rebuild_reservation_stats
+from services.reservation_views import rebuild_reservation_views
+from services.summary import rebuild_summaries
+from settings import get_settings
+
+
+async def _run(command, *args, database=None, **kwargs):
+    settings = get_settings()
+    # The commands rewrite whole collections: the ETags served from them must change too.
+    client = create_client(settings, event_listeners=[write_tracker] if settings.http_caching_enabled else [])
+    db = client[database or settings.database_name]
+    try:
+        async with publishing_writes(db):
+            return await command(db, *args, **kwargs)
+    finally:
+        client.close()
+
+
+async def _seed_and_check_query_plans(db, **kwargs):
+    from benchmarks.seed import DatasetSize, seed_database
+
+    await seed_database(db, DatasetSize())
+    await reconcile_indexes(db)
+    return await check_query_plans(db, **kwargs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rental service maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate = subparsers.add_parser(
+        "migrate-object-ids", help="Convert string foreign keys to native ObjectIds (resumable)"
+    )
+    migrate.add_argument("--batch-size", type=int, default=1000)
+
+    indexes = subparsers.add_parser(
+        "ensure-indexes", help="Build the indexes declared in indexes.py and report missing/extra/in-progress ones"
+    )
+    indexes.add_argument("--check", action="store_true", help="Only report, do not build anything")
+    indexes.add_argument("--drop-extra", action="store_true", help="Drop indexes that are not declared")
+
+    subparsers.add_parser("rebuild-summary", help="Recompute the storage summary counters from scratch")
+
+    availability = subparsers.add_parser(
+        "rebuild-availability", help="Recompute the stock item booking calendars from the reservations"
+    )
+    availability.add_argument("--batch-size", type=int, default=1000)
+
+    views = subparsers.add_parser(
+        "rebuild-reservation-views", help="Recompute the denormalised reservations behind /reservations/detailed"
+    )
+    views.add_argument("--batch-size", type=int, default=1000)
+
+    damages = subparsers.add_parser(
+        "rebuild-damage-counts", help="Recompute the damage counters of the stock items from the damages"
+    )
+    damages.add_argument("--batch-size", type=int, default=1000)
+
+    stats = subparsers.add_parser(
+        "rebuild-reservation-stats", help="Recompute the reservation statistics behind /reservations/stats"
+    )
+    stats.add_argument("--batch-size", type=int, default=1000)
+
+    archive = subparsers.add_parser(
+        "archive", help="Move long returned reservations and long resolved damages to the archive collections"
+    )
+    archive.add_argument("--days", type=int, help="Age in days (default: RENTAL_ARCHIVE_AFTER_DAYS)")
+    archive.add_argument("--batch-size", type=int, default=1000)
+
+    plans = subparsers.add_parser(
+        "check-query-plans",
+        help="Explain every registered aggregation (queries.QUERIES) and fail on collection scans, "
+             "lost indexes or too many documents examined per result",
+    )
+    plans.add_argument("--query", action="append", choices=sorted(QUERIES), help="Only check this query (repeatable)")
+    plans.add_argument("--max-ratio", type=float, help="Override the documents examined per result of every query")
+    plans.add_argument("--database", help="Database to check instead of the application database")
+    plans.add_argument(
+        "--seed", action="store_true",
+        help="Replace the content of --database with the synthetic benchmark dataset first (needs dev-requirements)",
+    )
+
+    args = parser.parse_args(argv)
+    if args.command == "check-query-plans" and args.seed and args.database in (None, get_settings().database_name):
+        parser.error("--seed needs a --database other than the application database, it is overwritten")
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+
+    if args.command == "migrate-object-ids":
+        result = asyncio.run(_run(migrate_object_id_foreign_keys, batch_size=args.batch_size))
+    elif args.command == "ensure-indexes":
+        result = asyncio.run(_run(reconcile_indexes, create=not args.check, drop_extra=args.drop_extra))
+    elif args.command == "rebuild-summary":
+        result = asyncio.run(_run(rebuild_summaries))
+    elif args.command == "rebuild-availability":
+        result = asyncio.run(_run(rebuild_availability, batch_size=args.batch_size))
+    elif args.command == "rebuild-reservation-views":
+        result = asyncio.run(_run(rebuild_reservation_views, batch_size=args.batch_size))
+    elif args.command == "rebuild-damage-counts":
+        result = asyncio.run(_run(rebuild_damage_counts, batch_size=args.batch_size))
+    elif args.command == "rebuild-reservation-stats":
+        result = asyncio.run(_run(rebuild_reservation_stats, batch_size=args.batch_size))
+    elif args.command == "archive":
+        result = asyncio.run(_run(archive_history, days=args.days, batch_size=args.batch_size))
+    elif args.command == "check-query-plans":
+        check = _seed_and_check_query_plans if args.seed else check_query_plans
+        result = asyncio.run(_run(check, database=args.database, names=args.query, max_examined_ratio=args.max_ratio))
+
+    print(json.dumps(result, indent=2, default=str))
+    if args.command == "check-query-plans" and not result["ok"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
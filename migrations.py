@@ -0,0 +1,61 @@
+import logging
+from typing import Dict, List
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# Reference fields that used to be stored as hex strings, per collection.
+OBJECT_ID_FOREIGN_KEYS: Dict[str, List[str]] = {
+    "stock_items": ["resource_id", "storage_id"],
+    "reservations": ["stock_item_id"],
+    "damages": ["stock_item_id", "reservation_id"],
+}
+
+
+async def migrate_object_id_foreign_keys(db, batch_size: int = 1000) -> Dict[str, Dict[str, int]]:
+    """
+    Convert string foreign keys to native ObjectIds, one batch of documents at a time.
+
+    Only documents that still hold a string reference are selected, so an interrupted run
+    simply picks up where it stopped when started again. Values that are not valid ObjectId
+    hex strings are left untouched and counted as ``invalid``.
+    """
+    report = {}
+    for collection_name, fields in OBJECT_ID_FOREIGN_KEYS.items():
+        collection = db[collection_name]
+        pending = {"$or": [{field: {"$type": "string"}} for field in fields]}
+        stats = {"converted": 0, "invalid": 0}
+        last_id = None
+
+        while True:
+            query = pending if last_id is None else {"$and": [pending, {"_id": {"$gt": last_id}}]}
+            documents = await collection.find(query, {field: 1 for field in fields}).sort("_id", 1).to_list(batch_size)
+            if not documents:
+                break
+
+            requests = []
+            for document in documents:
+                changes = {}
+                for field in fields:
+                    value = document.get(field)
+                    if not isinstance(value, str):
+                        continue
+                    if ObjectId.is_valid(value):
+                        changes[field] = ObjectId(value)
+                    else:
+                        stats["invalid"] += 1
+                if changes:
+                    # Match on the old values so a concurrent write is never overwritten.
+                    original = {field: document[field] for field in changes}
+                    requests.append(UpdateOne({"_id": document["_id"], **original}, {"$set": changes}))
+
+            if requests:
+                result = await collection.bulk_write(requests, ordered=False)
+                stats["converted"] += result.modified_count
+            last_id = documents[-1]["_id"]
+            logger.info("%s: converted %d documents so far", collection_name, stats["converted"])
+
+        report[collection_name] = stats
+    return report
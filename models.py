@@ -1,10 +1,49 @@
 from datetime import datetime
-from typing import Optional, List, Annotated
+from typing import Any, Dict, Optional, List, Annotated, Union
 
-from pydantic import Field, BaseModel, BeforeValidator
+from bson import ObjectId
+from pydantic import Field, BaseModel, BeforeValidator, PlainSerializer, PlainValidator, WithJsonSchema
 
 PyObjectId = Annotated[str, BeforeValidator(str)]
 
+# Stored field of every document's ``version``, incremented by each update (see updates.py)
+VERSION_FIELD = "_version"
+
+
+def _to_object_id(value) -> ObjectId:
+    if isinstance(value, ObjectId):
+        return value
+    if isinstance(value, str) and ObjectId.is_valid(value):
+        return ObjectId(value)
+    raise ValueError(f"{value!r} is not a valid 24-character hex ObjectId")
+
+
+def _object_id_to_str(value: ObjectId) -> str:
+    return str(value)
+
+
+# Reference to another document. Stored as a native ObjectId so `$lookup` can use indexes,
+# while the API accepts and returns the 24-character hex string.
+ObjectIdRef = Annotated[
+    ObjectId,
+    PlainValidator(_to_object_id),
+    PlainSerializer(_object_id_to_str, return_type=str, when_used="json"),
+    WithJsonSchema({"type": "string", "pattern": "^[0-9a-fA-F]{24}$"}),
+]
+
+
+def stringify_ids(value):
+    """
+    Recursively replace ObjectIds with their hex strings in a raw aggregation result.
+    """
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, dict):
+        return {k: stringify_ids(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [stringify_ids(v) for v in value]
+    return value
+
 
 class Resource(BaseModel):
     """
@@ -13,6 +52,8 @@ class Resource(BaseModel):
 
     id: Optional[PyObjectId] = Field(alias="_id", default=None)
     title: str = Field(..., alias="name")
+    # Incremented by every update; PUT takes it back in If-Match
+    version: int = Field(0, alias="_version")
 
     class Config:
         extra = "allow"
@@ -36,6 +77,7 @@ class UpdateResource(BaseModel):
     """
 
     title: Optional[str] = None
+    inc: Optional[Dict[str, Union[int, float]]] = Field(None, alias="$inc")
 
     class Config:
         extra = "allow"
@@ -62,6 +104,7 @@ class Storage(BaseModel):
     name: str = Field(...)
     address: str = Field(...)
     contact_number: str = Field(...)
+    version: int = Field(0, alias="_version")
 
     class Config:
         json_schema_extra = {
@@ -98,8 +141,9 @@ class StockItem(BaseModel):
     """
 
     id: Optional[PyObjectId] = Field(alias="_id", default=None)
-    resource_id: str = Field(...)
-    storage_id: str = Field(...)
+    resource_id: ObjectIdRef = Field(...)
+    storage_id: ObjectIdRef = Field(...)
+    version: int = Field(0, alias="_version")
 
     class Config:
         json_schema_extra = {
@@ -115,14 +159,14 @@ class UpdateStockItem(BaseModel):
     A set of optional updates to be made to a document in the database.
     """
 
-    resource_id: Optional[str] = None
-    storage_id: Optional[str] = None
+    resource_id: Optional[ObjectIdRef] = None
+    storage_id: Optional[ObjectIdRef] = None
 
     class Config:
         json_schema_extra = {
             "example": {
-                "resource_id": "updated_resource_id",
-                "storage_id": "updated_storage_id"
+                "resource_id": "123456789012345678901235",
+                "storage_id": "123456789012345678901235"
             }
         }
 
@@ -133,11 +177,12 @@ class Reservation(BaseModel):
     """
 
     id: Optional[PyObjectId] = Field(alias="_id", default=None)
-    stock_item_id: str = Field(...)
+    stock_item_id: ObjectIdRef = Field(...)
     booking_date: datetime = Field(...)
     client_data: Optional[str] = None
     return_date: Optional[datetime] = None
     notes: Optional[str] = None
+    version: int = Field(0, alias="_version")
 
     class Config:
         json_schema_extra = {
@@ -156,7 +201,7 @@ class UpdateReservation(BaseModel):
     A set of optional updates to be made to a document in the database.
     """
 
-    stock_item_id: Optional[str] = None
+    stock_item_id: Optional[ObjectIdRef] = None
     booking_date: Optional[datetime] = None
     client_data: Optional[str] = None
     return_date: Optional[datetime] = None
@@ -165,7 +210,7 @@ class UpdateReservation(BaseModel):
     class Config:
         json_schema_extra = {
             "example": {
-                "stock_item_id": "updated_stock_item_id",
+                "stock_item_id": "123456789012345678901235",
                 "booking_date": "2024-04-15T12:00:00",
                 "client_data": "Updated Client ABC",
                 "return_date": "2024-04-22T12:00:00",
@@ -180,15 +225,18 @@ class Damages(BaseModel):
     """
 
     id: Optional[PyObjectId] = Field(alias="_id", default=None)
-    stock_item_id: str = Field(...)
-    reservation_id: Optional[str] = None
+    stock_item_id: ObjectIdRef = Field(...)
+    reservation_id: Optional[ObjectIdRef] = None
+    # When the damage was dealt with; resolved damages are archived after RENTAL_ARCHIVE_AFTER_DAYS
+    resolved_at: Optional[datetime] = None
+    version: int = Field(0, alias="_version")
 
     class Config:
         extra = "allow"
         json_schema_extra = {
             "example": {
                 "stock_item_id": "123456789012345678901234",
-                "reservation_id": "optional_reservation_id",
+                "reservation_id": "123456789012345678901236",
                 "damage_type": "Scratch",
                 "description": "Small scratch on the surface",
                 "repair_cost": "50 USD"
@@ -201,15 +249,17 @@ class UpdateDamages(BaseModel):
     A set of optional updates to be made to a document in the database.
     """
 
-    stock_item_id: Optional[str] = None
-    reservation_id: Optional[str] = None
+    stock_item_id: Optional[ObjectIdRef] = None
+    reservation_id: Optional[ObjectIdRef] = None
+    resolved_at: Optional[datetime] = None
+    inc: Optional[Dict[str, Union[int, float]]] = Field(None, alias="$inc")
 
     class Config:
         extra = "allow"
         json_schema_extra = {
             "example": {
-                "stock_item_id": "updated_stock_item_id",
-                "reservation_id": "updated_optional_reservation_id",
+                "stock_item_id": "123456789012345678901235",
+                "reservation_id": "123456789012345678901237",
                 "damage_type": "updated_damage_type",
                 "description": "updated_description",
                 "repair_cost": "updated_repair_cost"
@@ -223,6 +273,7 @@ class ResourceCollection(BaseModel):
     """
 
     resources: List[Resource]
+    next_cursor: Optional[str] = None
 
 
 class StorageCollection(BaseModel):
@@ -231,6 +282,7 @@ class StorageCollection(BaseModel):
     """
 
     storages: List[Storage]
+    next_cursor: Optional[str] = None
 
 
 class StockItemCollection(BaseModel):
@@ -239,6 +291,7 @@ class StockItemCollection(BaseModel):
     """
 
     stock_items: List[StockItem]
+    next_cursor: Optional[str] = None
 
 
 class ReservationCollection(BaseModel):
@@ -247,6 +300,26 @@ class ReservationCollection(BaseModel):
     """
 
     reservations: List[Reservation]
+    next_cursor: Optional[str] = None
+
+
+class ReservationDetails(Reservation):
+    """
+    A reservation with snapshots of its stock item, resource and storage.
+    """
+
+    stock_item_details: Optional[Dict[str, Any]] = None
+    resource_details: Optional[Dict[str, Any]] = None
+    storage_details: Optional[Dict[str, Any]] = None
+
+
+class ReservationDetailsCollection(BaseModel):
+    """
+    A container holding a list of `ReservationDetails` instances.
+    """
+
+    reservations: List[ReservationDetails]
+    next_cursor: Optional[str] = None
 
 
 class DamagesCollection(BaseModel):
@@ -255,10 +328,75 @@ class DamagesCollection(BaseModel):
     """
 
     damages: List[Damages]
+    next_cursor: Optional[str] = None
 
 
 class StorageSummary(BaseModel):
     storage_id: str
     total_reservations: int
     total_stock_items: int
-    total_damages: int
\ No newline at end of file
+    total_damages: int
+
+
+class StorageAvailability(BaseModel):
+    storage_id: str
+    total_units: int
+    free_units: int
+
+
+class ResourceAvailability(BaseModel):
+    """
+    Stock items of a resource that are free for a whole period, per storage.
+    """
+
+    resource_id: str
+    start: datetime = Field(..., alias="from")
+    end: datetime = Field(..., alias="to")
+    storages: List[StorageAvailability]
+
+
+class ReservationStatsBucket(BaseModel):
+    """
+    Reservations of one resource or storage booked in the period starting at `start`.
+    """
+
+    id: PyObjectId
+    start: datetime
+    bookings: int
+    returned: int
+    open: int
+    overdue: int
+    average_rental_days: Optional[float] = None
+
+
+class ReservationStats(BaseModel):
+    """
+    Reservation statistics per resource or storage and period, from `GET /reservations/stats`.
+    """
+
+    group_by: str
+    granularity: str
+    start: datetime = Field(..., alias="from")
+    end: datetime = Field(..., alias="to")
+    buckets: List[ReservationStatsBucket]
+
+
+class BulkItemError(BaseModel):
+    """
+    Why the item at position `index` of a bulk request was not written.
+    """
+
+    index: int
+    detail: Any
+
+
+class BulkWriteReport(BaseModel):
+    """
+    Outcome of a bulk create, update or delete request.
+    """
+
+    inserted_ids: List[Optional[str]] = []
+    matched_count: int = 0
+    modified_count: int = 0
+    deleted_count: int = 0
+    errors: List[BulkItemError] = []
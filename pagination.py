@@ -0,0 +1,226 @@
+import base64
+from datetime import datetime
+from typing import Annotated, Any, Dict, List, Optional, Sequence, Tuple, Type
+
+from bson import ObjectId, json_util
+from fastapi import Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from fields import Fields, projection as fields_projection, select_fields
+from responses import dump_document, dumps, fast_responses_enabled
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+SortSpec = Sequence[Tuple[str, int]]
+ID_SORT: SortSpec = (("_id", 1),)
+
+# Type of the cursor values of the sort keys in use; values of other keys must at least be scalars.
+_SORT_KEY_TYPES = {"_id": ObjectId, "booking_date": datetime}
+_SCALAR_TYPES = (ObjectId, datetime, str, int, float, bool, type(None))
+
+
+class CursorParams:
+    """
+    Query parameters of every paginated endpoint.
+    """
+
+    def __init__(
+        self,
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Maximum number of items to return"),
+        after: Optional[str] = Query(None, description="Opaque cursor returned as `next_cursor` by the previous page"),
+    ):
+        self.limit = limit
+        self.after = after
+
+
+class PageParams(CursorParams):
+    """
+    Common query parameters of every list endpoint.
+    """
+
+    def __init__(
+        self,
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Maximum number of items to return"),
+        after: Optional[str] = Query(None, description="Opaque cursor returned as `next_cursor` by the previous page"),
+        stream: bool = Query(False, description="Stream every matching document as NDJSON instead of returning a page"),
+    ):
+        super().__init__(limit, after)
+        self.stream = stream
+
+
+CursorDep = Annotated[CursorParams, Depends()]
+PageDep = Annotated[PageParams, Depends()]
+
+
+def encode_cursor(values: List[Any]) -> str:
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        # binascii.Error, ValueError, bson.errors.InvalidId, ... for anything that is not one of our cursors
+        raise HTTPException(status_code=400, detail="Invalid pagination cursor")
+    if not isinstance(values, list):
+        raise HTTPException(status_code=400, detail="Invalid pagination cursor")
+    return values
+
+
+def _sort_value(document: Dict, key: str) -> Any:
+    value = document
+    for part in key.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def keyset_filter(sort: SortSpec, values: List[Any]) -> Dict:
+    """
+    Build the filter selecting documents that come strictly after ``values`` in ``sort`` order.
+
+    The last sort key must be unique (normally ``_id``) so that ties are broken deterministically.
+    """
+    if len(values) != len(sort):
+        raise HTTPException(status_code=400, detail="Invalid pagination cursor")
+    # Cursors come from clients: anything else (e.g. an operator like {"$ne": null}) would change the query.
+    for (key, _), value in zip(sort, values):
+        if not isinstance(value, _SORT_KEY_TYPES.get(key, _SCALAR_TYPES)):
+            raise HTTPException(status_code=400, detail="Invalid pagination cursor")
+
+    branches = []
+    for position, (key, direction) in enumerate(sort):
+        branch = {sort[i][0]: values[i] for i in range(position)}
+        branch[key] = {"$gt" if direction > 0 else "$lt": values[position]}
+        branches.append(branch)
+    return branches[0] if len(branches) == 1 else {"$or": branches}
+
+
+def _apply_cursor(query: Dict, sort: SortSpec, after: Optional[str]) -> Dict:
+    if after is None:
+        return query
+    after_filter = keyset_filter(sort, decode_cursor(after))
+    return {"$and": [query, after_filter]} if query else after_filter
+
+
+async def fetch_page(
+    collection,
+    query: Optional[Dict] = None,
+    *,
+    limit: int,
+    after: Optional[str] = None,
+    sort: SortSpec = ID_SORT,
+    projection: Optional[Dict] = None,
+    archive: Optional[str] = None,
+    archive_stages: Sequence[Dict] = (),
+) -> Tuple[List[Dict], Optional[str]]:
+    """
+    Return one page of documents plus the cursor of the next page (``None`` on the last page).
+
+    With ``archive``, the documents of that collection (e.g. ``reservations_archive``) are
+    merged in, in sort order; ``archive_stages`` run on them first, e.g. to add the fields
+    ``query`` filters on.
+    """
+    if archive is not None:
+        query = _apply_cursor(query or {}, sort, after)
+        cursor = collection.aggregate(_union_pipeline(query, archive, sort, projection, limit + 1, archive_stages))
+        return _next_page(await cursor.to_list(limit + 1), limit, sort)
+    cursor = collection.find(_apply_cursor(query or {}, sort, after), projection)
+    documents = await cursor.sort(list(sort)).limit(limit + 1).to_list(limit + 1)
+    return _next_page(documents, limit, sort)
+
+
+def _union_pipeline(
+    query: Dict,
+    archive: str,
+    sort: SortSpec,
+    projection: Optional[Dict],
+    limit: Optional[int] = None,
+    archive_stages: Sequence[Dict] = (),
+) -> List[Dict]:
+    """
+    Documents of the collection and of ``archive`` matching ``query``, merged in ``sort`` order.
+    """
+    branch = [{"$match": query}, {"$sort": dict(sort)}]
+    if limit is not None:
+        branch.append({"$limit": limit})
+    pipeline = branch + [{"$unionWith": {"coll": archive, "pipeline": [*archive_stages, *branch]}}] + branch[1:]
+    if projection:
+        pipeline.append({"$project": projection})
+    return pipeline
+
+
+def _next_page(documents: List[Dict], limit: int, sort: SortSpec) -> Tuple[List[Dict], Optional[str]]:
+    if len(documents) <= limit:
+        return documents, None
+    documents = documents[:limit]
+    return documents, encode_cursor([_sort_value(documents[-1], key) for key, _ in sort])
+
+
+def page_stages(pipeline: List[Dict], *, limit: int, after: Optional[str] = None, sort: SortSpec = ID_SORT) -> List[Dict]:
+    """
+    Append the keyset filter, sort and limit (one extra document) of a page to ``pipeline``.
+
+    The sort keys must exist on the documents the pipeline outputs.
+    """
+    stages = list(pipeline)
+    if after is not None:
+        stages.append({"$match": keyset_filter(sort, decode_cursor(after))})
+    return stages + [{"$sort": dict(sort)}, {"$limit": limit + 1}]
+
+
+async def aggregate_page(
+    collection,
+    pipeline: List[Dict],
+    *,
+    limit: int,
+    after: Optional[str] = None,
+    sort: SortSpec = ID_SORT,
+) -> Tuple[List[Dict], Optional[str]]:
+    """
+    Like :func:`fetch_page`, for documents produced by an aggregation ``pipeline``.
+    """
+    documents = await collection.aggregate(page_stages(pipeline, limit=limit, after=after, sort=sort)).to_list(limit + 1)
+    return _next_page(documents, limit, sort)
+
+
+def stream_documents(
+    collection,
+    model: Type[BaseModel],
+    query: Optional[Dict] = None,
+    *,
+    after: Optional[str] = None,
+    sort: SortSpec = ID_SORT,
+    projection: Optional[Dict] = None,
+    archive: Optional[str] = None,
+    fields: Optional[Fields] = None,
+) -> StreamingResponse:
+    """
+    Stream every matching document as one JSON object per line, as the cursor yields them.
+
+    ``archive`` is merged in as in :func:`fetch_page`. With ``fields``, only those are read and returned.
+    """
+    if fields is not None:
+        projection = fields_projection(model, fields, keep=[key for key, _ in sort])
+    if archive is not None:
+        pipeline = _union_pipeline(_apply_cursor(query or {}, sort, after), archive, sort, projection)
+        cursor = collection.aggregate(pipeline, allowDiskUse=True, batchSize=STREAM_BATCH_SIZE)
+    else:
+        cursor = collection.find(_apply_cursor(query or {}, sort, after), projection)
+        cursor = cursor.sort(list(sort)).batch_size(STREAM_BATCH_SIZE)
+
+    fast = fast_responses_enabled()
+
+    async def lines():
+        async for document in cursor:
+            if fields is not None:
+                yield dumps(select_fields(model, document, fields)) + b"\n"
+            elif fast:
+                yield dumps(dump_document(model, document)) + b"\n"
+            else:
+                yield model.model_validate(document).model_dump_json() + "\n"
+
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE)
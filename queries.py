@@ -0,0 +1,308 @@
+"""
+Registry of the aggregation pipelines the API runs, and the query plan check over them.
+
+Every pipeline is built by a function of its parameters and registered in :data:`QUERIES`
+under a name, together with how to pick representative parameters from a database and
+what its plan must look like. :func:`check_query_plans` (``python manage.py
+check-query-plans``) runs ``explain`` with ``executionStats`` for every registered query
+and reports a failure when a query examines more documents per result than its
+``max_examined_ratio``, scans a collection, or stops using one of its ``expected_indexes``
+(names from ``indexes.INDEXES``). Run it against a seeded dataset after changing a
+pipeline or an index.
+"""
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from bson import ObjectId
+
+from pagination import DEFAULT_PAGE_SIZE, SortSpec, page_stages
+
+Pipeline = List[Dict]
+
+# Reservations and damages of deleted stock items can be kept with a "deleted_at" stamp
+# (see services.cascade); every read leaves them out.
+NOT_DELETED = {"deleted_at": None}
+
+UNRETURNED_SORT: SortSpec = (('booking_date', 1), ('_id', 1))
+
+
+def _open_reservations_lookup(projection: Optional[Dict] = None) -> Dict:
+    pipeline = [
+        {
+            '$match': {
+                'return_date': None,
+                **NOT_DELETED
+            }
+        }
+    ]
+    if projection:
+        pipeline.append({'$project': projection})
+    return {
+        '$lookup': {
+            'from': 'reservations',
+            'localField': '_id',
+            'foreignField': 'stock_item_id',
+            'pipeline': pipeline,
+            'as': 'reservations'
+        }
+    }
+
+
+def unreturned_reservations(storage_id: ObjectId, projection: Optional[Dict] = None) -> Pipeline:
+    # Start from the storage's stock items and only join their open reservations
+    # (served by the partial "unreturned" index), instead of joining every reservation ever made.
+    # ``projection`` trims the joined reservations inside the lookup.
+    return [
+        {
+            '$match': {
+                'storage_id': storage_id
+            }
+        },
+        _open_reservations_lookup(projection),
+        {
+            '$unwind': {
+                'path': '$reservations'
+            }
+        },
+        {
+            '$addFields': {
+                'reservations.resource_details': {
+                    'resource_id': '$resource_id',
+                    'storage_id': '$storage_id'
+                }
+            }
+        },
+        {
+            '$replaceRoot': {
+                'newRoot': '$reservations'
+            }
+        }
+    ]
+
+
+def unreturned_count(storage_id: ObjectId) -> Pipeline:
+    return [
+        {
+            '$match': {
+                'storage_id': storage_id
+            }
+        },
+        {
+            '$project': {
+                '_id': 1
+            }
+        },
+        # Only the number of open reservations is needed.
+        _open_reservations_lookup({'_id': 1}),
+        {
+            '$group': {
+                '_id': None,
+                'count': {
+                    '$sum': {
+                        '$size': '$reservations'
+                    }
+                }
+            }
+        }
+    ]
+
+
+def resource_availability(resource_id: ObjectId, start: datetime, end: datetime) -> Pipeline:
+    return [
+        {"$match": {"resource_id": resource_id}},
+        {"$project": {
+            "storage_id": 1,
+            "busy": {"$gt": [{"$size": {"$filter": {
+                "input": {"$ifNull": ["$bookings", []]},
+                "cond": {"$and": [{"$lt": ["$$this.start", end]}, {"$gt": ["$$this.end", start]}]},
+            }}}, 0]},
+        }},
+        {"$group": {
+            "_id": "$storage_id",
+            "total_units": {"$sum": 1},
+            "free_units": {"$sum": {"$cond": ["$busy", 0, 1]}},
+        }},
+        {"$sort": {"_id": 1}},
+    ]
+
+
+def counts_per_stock_item(stock_item_ids: Sequence[ObjectId]) -> Pipeline:
+    return [
+        {"$match": {"stock_item_id": {"$in": list(stock_item_ids)}, **NOT_DELETED}},
+        {"$group": {"_id": "$stock_item_id", "count": {"$sum": 1}}},
+    ]
+
+
+# Representative parameters, picked from the database the check runs against.
+
+async def _busiest_storage(db) -> Dict[str, Any]:
+    rows = await db.stock_items.aggregate([
+        {"$group": {"_id": "$storage_id", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1}},
+        {"$limit": 1},
+    ]).to_list(1)
+    return {"storage_id": rows[0]["_id"] if rows else ObjectId()}
+
+
+async def _busiest_resource(db) -> Dict[str, Any]:
+    rows = await db.stock_items.aggregate([
+        {"$group": {"_id": "$resource_id", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1}},
+        {"$limit": 1},
+    ]).to_list(1)
+    latest = await db.reservations.find_one({}, {"booking_date": 1}, sort=[("booking_date", -1)])
+    start = latest["booking_date"] if latest else datetime(2020, 1, 1)
+    return {"resource_id": rows[0]["_id"] if rows else ObjectId(), "start": start, "end": start + timedelta(days=7)}
+
+
+async def _some_stock_items(db) -> Dict[str, Any]:
+    stock_items = await db.stock_items.find({}, {"_id": 1}).limit(100).to_list(100)
+    return {"stock_item_ids": [stock_item["_id"] for stock_item in stock_items]}
+
+
+@dataclass(frozen=True)
+class NamedQuery:
+    collection: str
+    build: Callable[..., Pipeline]
+    sample: Callable[[Any], Awaitable[Dict[str, Any]]]
+    # Documents examined per document returned; None when the query aggregates (e.g. counts)
+    max_examined_ratio: Optional[float] = None
+    # Index names (see indexes.INDEXES, "_id_" for the primary key) the plan must use
+    expected_indexes: Tuple[str, ...] = ()
+    # Pages with this sort are cut by pagination.page_stages, the check explains the first page
+    page_sort: Optional[SortSpec] = None
+    allow_collection_scan: bool = False
+    description: str = ""
+
+    def pipeline(self, **params) -> Pipeline:
+        stages = self.build(**params)
+        if self.page_sort is not None:
+            stages = page_stages(stages, limit=DEFAULT_PAGE_SIZE, sort=self.page_sort)
+        return stages
+
+
+QUERIES: Dict[str, NamedQuery] = {
+    "unreturned_reservations": NamedQuery(
+        "stock_items", unreturned_reservations, _busiest_storage,
+        max_examined_ratio=25, expected_indexes=("storage_id_resource_id",), page_sort=UNRETURNED_SORT,
+        description="GET /reservations/unreturned/{storage_id}, one page",
+    ),
+    "unreturned_count": NamedQuery(
+        "stock_items", unreturned_count, _busiest_storage,
+        expected_indexes=("storage_id_resource_id",),
+        description="GET /reservations/unreturned/{storage_id}, total",
+    ),
+    "resource_availability": NamedQuery(
+        "stock_item_availability", resource_availability, _busiest_resource,
+        expected_indexes=("resource_id_storage_id",),
+        description="GET /resources/{id}/availability",
+    ),
+    "reservations_per_stock_item": NamedQuery(
+        "reservations", counts_per_stock_item, _some_stock_items,
+        expected_indexes=("stock_item_id_booking_date",),
+        description="Storage summary counters of moved stock items",
+    ),
+    "damages_per_stock_item": NamedQuery(
+        "damages", counts_per_stock_item, _some_stock_items,
+        expected_indexes=("stock_item_id",),
+        description="Storage summary counters of moved stock items",
+    ),
+}
+
+
+@dataclass
+class PlanStats:
+    docs_examined: int = 0
+    keys_examined: int = 0
+    collection_scans: int = 0
+    indexes: List[str] = field(default_factory=list)
+
+
+# Join strategies of SBE ($lookup pushed down into the query engine) that scan the foreign collection
+_SCANNING_JOINS = ("NestedLoopJoin", "HashJoin")
+
+
+def plan_stats(explain: Dict) -> PlanStats:
+    """
+    Add up what an ``executionStats`` explain of an aggregation examined, across the initial
+    query and every ``$lookup``, whichever engine (classic or SBE) ran them.
+    """
+    stats = PlanStats()
+
+    def use(index: Any) -> None:
+        if isinstance(index, str) and index not in stats.indexes:
+            stats.indexes.append(index)
+
+    def walk(node: Any) -> None:
+        if isinstance(node, list):
+            for value in node:
+                walk(value)
+            return
+        if not isinstance(node, dict):
+            return
+        if isinstance(node.get("totalDocsExamined"), int):
+            stats.docs_examined += node["totalDocsExamined"]
+            stats.keys_examined += node.get("totalKeysExamined", 0)
+        if node.get("stage") == "COLLSCAN":
+            stats.collection_scans += 1
+        if node.get("stage") == "EQ_LOOKUP" and node.get("strategy") in _SCANNING_JOINS:
+            stats.collection_scans += 1
+        if isinstance(node.get("collectionScans"), int):
+            stats.collection_scans += node["collectionScans"]
+        use(node.get("indexName"))
+        for index in node.get("indexesUsed", []):
+            use(index)
+        for key, value in node.items():
+            # Rejected and trial plans did not run; executionStages repeat the winning plan
+            if key not in ("rejectedPlans", "allPlansExecution", "command", "executionStages"):
+                walk(value)
+
+    walk(explain)
+    return stats
+
+
+async def check_query(db, name: str, query: NamedQuery, max_examined_ratio: Optional[float] = None) -> Dict[str, Any]:
+    params = await query.sample(db)
+    pipeline = query.pipeline(**params)
+    explain = await db.command(
+        "explain", {"aggregate": query.collection, "pipeline": pipeline, "cursor": {}}, verbosity="executionStats"
+    )
+    stats = plan_stats(explain)
+    returned = len(await db[query.collection].aggregate(pipeline).to_list(None))
+
+    problems = []
+    limit = max_examined_ratio if max_examined_ratio is not None else query.max_examined_ratio
+    ratio = stats.docs_examined / max(returned, 1)
+    if limit is not None and ratio > limit:
+        problems.append(f"examined {stats.docs_examined} documents for {returned} results (ratio {ratio:.1f} > {limit:g})")
+    if stats.collection_scans and not query.allow_collection_scan:
+        problems.append(f"{stats.collection_scans} collection scan(s)")
+    missing = [index for index in query.expected_indexes if index not in stats.indexes]
+    if missing:
+        problems.append(f"does not use index(es) {', '.join(missing)}")
+
+    return {
+        "query": name,
+        "collection": query.collection,
+        "returned": returned,
+        "docs_examined": stats.docs_examined,
+        "keys_examined": stats.keys_examined,
+        "indexes": stats.indexes,
+        "ok": not problems,
+        "problems": problems,
+    }
+
+
+async def check_query_plans(db, names: Optional[Sequence[str]] = None, max_examined_ratio: Optional[float] = None) -> Dict:
+    """
+    Explain every registered query (or only ``names``) and report the ones whose plan regressed.
+
+    ``max_examined_ratio`` overrides the per-query ratios.
+    """
+    results = [
+        await check_query(db, name, query, max_examined_ratio)
+        for name, query in QUERIES.items()
+        if not names or name in names
+    ]
+    return {"ok": all(result["ok"] for result in results), "queries": results}
@@ -0,0 +1,132 @@
+"""
+Validation-free responses for documents read from (or just written to) the database.
+
+Documents from our own collections are already valid, and request bodies are validated on
+the way in, so instead of validating documents into the response models and running them
+through ``jsonable_encoder``, they are renamed to the models' output field names
+(:func:`dump_document`) and encoded by orjson, which writes ObjectIds as hex strings and
+datetimes in ISO 8601. The output is the same as the Pydantic path, which
+``RENTAL_FAST_JSON_RESPONSES=false`` switches back to.
+"""
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+import orjson
+from bson import ObjectId
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+from fields import Fields, check_fields, select_fields
+from models import VERSION_FIELD, stringify_ids
+from settings import get_settings
+
+_REQUIRED = object()
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def dumps(content: Any) -> bytes:
+    # UTC as "Z", like Pydantic
+    return orjson.dumps(content, default=_default, option=orjson.OPT_UTC_Z)
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    ``JSONResponse`` encoded with orjson, accepting ObjectIds anywhere in the content.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+@lru_cache
+def _output_plan(model: Type[BaseModel]) -> Tuple[Tuple[Tuple[str, str, Any], ...], Optional[frozenset]]:
+    """
+    ``(stored key, output key, default)`` for every field of ``model``, and the stored keys of
+    the fields if extra keys are kept (``None`` otherwise).
+    """
+    fields = []
+    for name, field in model.model_fields.items():
+        default = _REQUIRED if field.is_required() else field.get_default(call_default_factory=True)
+        fields.append((field.alias or name, name, default))
+    known = frozenset(stored for stored, _, _ in fields) if model.model_config.get("extra") == "allow" else None
+    return tuple(fields), known
+
+
+def dump_document(model: Type[BaseModel], document: Dict) -> Dict:
+    """
+    What ``model.model_validate(document).model_dump()`` would give, without validating ``document``.
+    """
+    fields, known = _output_plan(model)
+    output = {}
+    for stored, name, default in fields:
+        value = document.get(stored, default)
+        if value is not _REQUIRED:
+            output[name] = value
+    if known is not None:
+        for key, value in document.items():
+            if key not in known:
+                output[key] = value
+    return output
+
+
+def fast_responses_enabled() -> bool:
+    return get_settings().fast_json_responses
+
+
+def collection_response(
+    collection_model: Type[BaseModel],
+    key: str,
+    model: Type[BaseModel],
+    documents: List[Dict],
+    next_cursor: Optional[str],
+    fields: Optional[Fields] = None,
+):
+    """
+    Return a page of ``documents`` as ``collection_model`` (``{key: [...], "next_cursor": ...}``),
+    or only their ``fields``.
+    """
+    if fields is not None:
+        check_fields(model, fields)
+        return FastJSONResponse({key: [select_fields(model, document, fields) for document in documents], "next_cursor": next_cursor})
+    if not fast_responses_enabled():
+        # Validated once, by the route's response model (a model instance would be dumped and validated again).
+        return {key: documents, "next_cursor": next_cursor}
+    return FastJSONResponse({key: [dump_document(model, document) for document in documents], "next_cursor": next_cursor})
+
+
+def document_etag(document: Dict) -> str:
+    """
+    The ``ETag`` of one document: its version, which ``If-Match`` is checked against.
+    """
+    # Documents that were never updated have no _version yet.
+    return f'"{document.get(VERSION_FIELD) or 0}"'
+
+
+def document_response(model: Type[BaseModel], document: Dict, status_code: int = 200, fields: Optional[Fields] = None):
+    """
+    Return one document as ``model``, e.g. a document just read or written, or only its ``fields``,
+    with its :func:`document_etag`.
+
+    ``status_code`` must match the route's, which FastAPI does not apply to returned responses.
+    """
+    headers = {"ETag": document_etag(document)}
+    if fields is not None:
+        return FastJSONResponse(select_fields(model, document, fields), status_code=status_code, headers=headers)
+    if not fast_responses_enabled():
+        # A response rather than the document, for updates.idempotent to store
+        return JSONResponse(model.model_validate(document).model_dump(mode="json"), status_code=status_code, headers=headers)
+    return FastJSONResponse(dump_document(model, document), status_code=status_code, headers=headers)
+
+
+def json_response(content: Any):
+    """
+    Return raw documents (e.g. aggregation results), with their ObjectIds as strings.
+    """
+    if not fast_responses_enabled():
+        return stringify_ids(content)
+    return FastJSONResponse(content)
@@ -0,0 +1,28 @@
+from typing import Dict, List
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from cache import reference_caches
+from conditional import response_cache
+from instrumentation import InstrumentedRoute, render_metrics
+
+router = APIRouter(route_class=InstrumentedRoute)
+
+
+@router.get(
+    "/cache",
+    response_description="Hit/miss counters of the in-process read caches and of the shared response cache",
+    response_model=List[Dict],
+)
+async def get_cache_stats():
+    return [stats for cache in reference_caches.values() for stats in cache.stats()] + [response_cache.stats()]
+
+
+@router.get(
+    "/prometheus",
+    response_description="Request and database command latency histograms in the Prometheus text format",
+    response_class=PlainTextResponse,
+)
+async def get_prometheus_metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
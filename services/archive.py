@@ -0,0 +1,94 @@
+"""
+Hot/cold split of the reservations and damages.
+
+:func:`archive_history` (``python manage.py archive``, meant to run on a schedule) moves the
+reservations returned more than ``RENTAL_ARCHIVE_AFTER_DAYS`` ago, and the damages resolved
+(``resolved_at``) more than that ago, to ``reservations_archive`` and ``damages_archive``
+in batches. The archive collections are created with zstd block compression. The API reads
+the hot collections only, unless a list endpoint is called with ``include_archived=true``.
+Archived documents keep counting in the storage summaries, but archived damages no longer
+mark their stock item as damaged.
+"""
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional, Tuple
+
+from pymongo import DeleteMany, ReplaceOne
+from pymongo.errors import CollectionInvalid
+
+from services.availability import record_bookings
+from services.damaged import record_damages
+from services.reservation_views import record_views
+from settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_SUFFIX = "_archive"
+# Field holding the date after which a document can be archived, per collection
+ARCHIVED_BY = {"reservations": "return_date", "damages": "resolved_at"}
+COLD_STORAGE = {"wiredTiger": {"configString": "block_compressor=zstd"}}
+
+
+def archive_collection(name: str) -> str:
+    return name + ARCHIVE_SUFFIX
+
+
+async def ensure_archive_collections(db) -> None:
+    existing = set(await db.list_collection_names())
+    for name in ARCHIVED_BY:
+        if archive_collection(name) not in existing:
+            try:
+                await db.create_collection(archive_collection(name), storageEngine=COLD_STORAGE)
+            except CollectionInvalid:
+                pass  # created concurrently
+
+
+async def _archive_batch(db, name: str, query: Dict, batch_size: int, now: datetime) -> Tuple[int, int]:
+    collection, archive = db[name], db[archive_collection(name)]
+    documents = await collection.find(query).limit(batch_size).to_list(batch_size)
+    if not documents:
+        return 0, 0
+    ids = [document["_id"] for document in documents]
+
+    # Copy first, then delete what still qualifies; documents changed in between stay hot
+    # and their copies are withdrawn. Re-running after a crash only rewrites the same copies.
+    await archive.bulk_write(
+        [ReplaceOne({"_id": document["_id"]}, {**document, "archived_at": now}, upsert=True) for document in documents],
+        ordered=False,
+    )
+    await collection.bulk_write([DeleteMany({"_id": {"$in": ids}, **query})])
+    kept = [document["_id"] async for document in collection.find({"_id": {"$in": ids}}, {"_id": 1})]
+    if kept:
+        await archive.delete_many({"_id": {"$in": kept}})
+    kept_ids = set(kept)
+    moved = [document for document in documents if document["_id"] not in kept_ids]
+
+    changes = [(document, None) for document in moved]
+    if name == "reservations":
+        await record_bookings(collection, changes)
+        await record_views(collection, changes)
+    else:
+        await record_damages(collection, changes)
+    return len(documents), len(moved)
+
+
+async def archive_history(db, days: Optional[int] = None, batch_size: int = 1000) -> Dict[str, int]:
+    """
+    Move the reservations and damages that are done with for more than ``days`` to the archive.
+    """
+    days = get_settings().archive_after_days if days is None else days
+    now = datetime.now(timezone.utc)
+    cutoff = now - timedelta(days=days)
+    await ensure_archive_collections(db)
+
+    moved = {}
+    for name, field in ARCHIVED_BY.items():
+        query = {field: {"$lt": cutoff}}
+        moved[name] = 0
+        while True:
+            fetched, count = await _archive_batch(db, name, query, batch_size, now)
+            moved[name] += count
+            if fetched < batch_size:
+                break
+            logger.info("Archived %d %s so far", moved[name], name)
+    return moved
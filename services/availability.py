@@ -0,0 +1,271 @@
+"""
+Per-stock-item booking calendar behind reservation conflict checks and ``GET /resources/{id}/availability``.
+
+The ``stock_item_availability`` collection holds one document per stock item with its
+``resource_id``, ``storage_id`` and the ``bookings`` (``reservation_id``, ``start``,
+``end``) it is out for. A reservation occupies ``[booking_date, return_date)``; an open
+loan (no ``return_date``) runs until it is returned.
+
+A booking is added with a single conditional update of the stock item's document, which
+only matches when no other booking overlaps, so two concurrent reservations of the same
+stock item cannot both succeed. Bookings that ended more than
+``RENTAL_AVAILABILITY_HISTORY_DAYS`` ago are pruned on every write and are no longer
+checked, which keeps the documents small however many reservations pile up.
+"""
+import asyncio
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+import queries
+from settings import get_settings
+
+AVAILABILITY_COLLECTION = "stock_item_availability"
+
+# End of a booking that has no return date yet.
+OPEN_END = datetime(9999, 12, 31)
+
+Change = Tuple[Optional[Dict], Optional[Dict]]
+
+_BOOKING_FIELDS = ("stock_item_id", "booking_date", "return_date")
+
+
+class BookingConflict(Exception):
+    """
+    The stock item is already booked for an overlapping period.
+    """
+
+    def __init__(self, stock_item_id, reservation_id=None):
+        self.stock_item_id = stock_item_id
+        self.reservation_id = reservation_id
+        detail = f"Stock item {stock_item_id} is already booked for this period"
+        if reservation_id is not None:
+            detail += f" (reservation {reservation_id})"
+        super().__init__(detail)
+
+
+def _booking(reservation: Dict) -> Dict:
+    return {
+        "reservation_id": reservation["_id"],
+        "start": reservation["booking_date"],
+        "end": reservation.get("return_date") or OPEN_END,
+    }
+
+
+def _overlapping(booking: Dict) -> Dict:
+    return {
+        "reservation_id": {"$ne": booking["reservation_id"]},
+        "start": {"$lt": booking["end"]},
+        "end": {"$gt": booking["start"]},
+    }
+
+
+def _replace_booking(booking: Dict, cutoff: Optional[datetime] = None) -> List[Dict]:
+    """
+    Update pipeline that (re)places ``booking`` in ``bookings``, dropping the ones that ended before ``cutoff``.
+    """
+    keep = {"$ne": ["$$this.reservation_id", booking["reservation_id"]]}
+    if cutoff is not None:
+        keep = {"$and": [keep, {"$gte": ["$$this.end", cutoff]}]}
+    return [{"$set": {"bookings": {"$concatArrays": [
+        {"$filter": {"input": {"$ifNull": ["$bookings", []]}, "cond": keep}},
+        {"$literal": [booking]},
+    ]}}}]
+
+
+async def _conflicting_reservation(availability, stock_item_id, booking: Dict):
+    document = await availability.find_one({"_id": stock_item_id}, {"bookings": {"$elemMatch": _overlapping(booking)}})
+    if document is None or not document.get("bookings"):
+        return None
+    return document["bookings"][0]["reservation_id"]
+
+
+async def book(db, reservation: Dict) -> None:
+    """
+    Add (or move) the booking of ``reservation``, raising :class:`BookingConflict` if its
+    stock item is already out for an overlapping period.
+    """
+    availability = db[AVAILABILITY_COLLECTION]
+    stock_item_id = reservation["stock_item_id"]
+    booking = _booking(reservation)
+    cutoff = datetime.now(timezone.utc) - timedelta(days=get_settings().availability_history_days)
+    query = {"_id": stock_item_id, "bookings": {"$not": {"$elemMatch": _overlapping(booking)}}}
+
+    for _ in range(3):
+        try:
+            result = await availability.update_one(query, _replace_booking(booking, cutoff), upsert=True)
+        except DuplicateKeyError:
+            # The document exists but did not match: either a booking overlaps, or a concurrent
+            # first booking of the same stock item has just created it.
+            if (reservation_id := await _conflicting_reservation(availability, stock_item_id, booking)) is not None:
+                raise BookingConflict(stock_item_id, reservation_id)
+            continue
+        if result.upserted_id is not None:
+            # Stock item created before this collection existed; see rebuild_availability.
+            stock_item = await db.stock_items.find_one({"_id": stock_item_id}, {"resource_id": 1, "storage_id": 1})
+            if stock_item is not None:
+                await availability.update_one(
+                    {"_id": stock_item_id},
+                    {"$set": {"resource_id": stock_item.get("resource_id"), "storage_id": stock_item.get("storage_id")}},
+                )
+        return
+    raise BookingConflict(stock_item_id)
+
+
+async def _release(db, reservations: Iterable[Dict]) -> None:
+    requests = [
+        UpdateOne({"_id": reservation["stock_item_id"]}, {"$pull": {"bookings": {"reservation_id": reservation["_id"]}}})
+        for reservation in reservations
+        if reservation.get("stock_item_id") is not None
+    ]
+    if requests:
+        await db[AVAILABILITY_COLLECTION].bulk_write(requests, ordered=False)
+
+
+def _booking_changed(before: Optional[Dict], after: Dict) -> bool:
+    return before is None or any(before.get(field) != after.get(field) for field in _BOOKING_FIELDS)
+
+
+async def book_changes(collection, changes: Iterable[Change]) -> Dict[int, str]:
+    """
+    Book the reservations about to be written; return why, per position in ``changes``, a
+    reservation cannot be. Reservations of the same stock item are booked in order, so the
+    first of two overlapping ones wins.
+
+    Call :func:`unbook_changes` with the changes whose write then fails.
+    """
+    changes = list(changes)
+    db = collection.database
+    rejected: Dict[int, str] = {}
+    per_stock_item = defaultdict(list)
+    for position, (before, after) in enumerate(changes):
+        if after is not None and _booking_changed(before, after):
+            per_stock_item[after["stock_item_id"]].append(position)
+
+    async def book_in_order(positions: List[int]) -> None:
+        for position in positions:
+            try:
+                await book(db, changes[position][1])
+            except BookingConflict as e:
+                rejected[position] = str(e)
+
+    await asyncio.gather(*(book_in_order(positions) for positions in per_stock_item.values()))
+
+    moved = [
+        before for position, (before, after) in enumerate(changes)
+        if before is not None and after is not None and position not in rejected
+        and before.get("stock_item_id") != after.get("stock_item_id")
+    ]
+    await _release(db, moved)
+    return rejected
+
+
+async def unbook_changes(collection, changes: Iterable[Change]) -> None:
+    """
+    Undo :func:`book_changes` for writes that failed: put the bookings back as they were ``before``.
+    """
+    db = collection.database
+    changes = [(before, after) for before, after in changes if after is not None and _booking_changed(before, after)]
+    await _release(db, [after for _, after in changes])
+    requests = [
+        UpdateOne({"_id": before["stock_item_id"]}, _replace_booking(_booking(before)), upsert=True)
+        for before, _ in changes
+        if before is not None and before.get("stock_item_id") is not None
+    ]
+    if requests:
+        await db[AVAILABILITY_COLLECTION].bulk_write(requests, ordered=False)
+
+
+async def record_bookings(collection, changes: Iterable[Change]) -> None:
+    """
+    Write hook (same signature as ``services.summary.record_changes``) for the writes that do
+    not go through :func:`book_changes`: stock items created, moved or deleted, and deleted
+    reservations.
+    """
+    changes = list(changes)
+    db = collection.database
+    requests = []
+
+    if collection.name == "stock_items":
+        for before, after in changes:
+            if after is None:
+                requests.append(DeleteOne({"_id": before["_id"]}))
+            elif before is None or any(before.get(field) != after.get(field) for field in ("resource_id", "storage_id")):
+                requests.append(UpdateOne(
+                    {"_id": after["_id"]},
+                    {
+                        "$set": {"resource_id": after.get("resource_id"), "storage_id": after.get("storage_id")},
+                        "$setOnInsert": {"bookings": []},
+                    },
+                    upsert=True,
+                ))
+    elif collection.name == "reservations":
+        await _release(db, [before for before, after in changes if after is None])
+
+    if requests:
+        await db[AVAILABILITY_COLLECTION].bulk_write(requests, ordered=False)
+
+
+async def resource_availability(db, resource_id, start: datetime, end: datetime) -> List[Dict]:
+    """
+    Count, per storage, the stock items of ``resource_id`` and how many of them are free for all of ``[start, end)``.
+    """
+    return await db[AVAILABILITY_COLLECTION].aggregate(queries.resource_availability(resource_id, start, end)).to_list(None)
+
+
+async def rebuild_availability(db, batch_size: int = 1000) -> Dict[str, int]:
+    """
+    Recompute every stock item's bookings from the reservations and atomically swap them in.
+
+    Reservations that overlap are kept as they are (they predate the conflict check) and
+    reported as ``overlapping``. Writes that happen while the rebuild runs may be missed;
+    run it when traffic is low.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(days=get_settings().availability_history_days)
+    pipeline = [
+        {"$lookup": {
+            "from": "reservations",
+            "localField": "_id",
+            "foreignField": "stock_item_id",
+            "pipeline": [
+                {"$match": {"$or": [{"return_date": None}, {"return_date": {"$gte": cutoff}}]}},
+                {"$project": {"booking_date": 1, "return_date": 1}},
+            ],
+            "as": "reservations",
+        }},
+        {"$project": {"resource_id": 1, "storage_id": 1, "reservations": 1}},
+    ]
+
+    staging = db[AVAILABILITY_COLLECTION + "_rebuild"]
+    await staging.drop()
+    stock_items = overlapping = 0
+    batch = []
+    async for stock_item in db.stock_items.aggregate(pipeline):
+        bookings = sorted((_booking(reservation) for reservation in stock_item["reservations"]), key=lambda b: b["start"])
+        latest_end = None
+        for booking in bookings:
+            if latest_end is not None and booking["start"] < latest_end:
+                overlapping += 1
+            latest_end = booking["end"] if latest_end is None else max(latest_end, booking["end"])
+        batch.append({
+            "_id": stock_item["_id"],
+            "resource_id": stock_item.get("resource_id"),
+            "storage_id": stock_item.get("storage_id"),
+            "bookings": bookings,
+        })
+        stock_items += 1
+        if len(batch) >= batch_size:
+            await staging.insert_many(batch)
+            batch = []
+    if batch:
+        await staging.insert_many(batch)
+
+    if stock_items:
+        await staging.create_index([("resource_id", 1), ("storage_id", 1)], name="resource_id_storage_id")
+        await staging.rename(AVAILABILITY_COLLECTION, dropTarget=True)
+    else:
+        await db[AVAILABILITY_COLLECTION].delete_many({})
+    return {"stock_items": stock_items, "overlapping": overlapping}
@@ -0,0 +1,155 @@
+"""
+Deleting a stock item together with its reservations and damages.
+
+The stock item is removed with a single ``find_one_and_delete`` and its dependent documents
+are handled in the same multi-document transaction (together with the storage summary and
+the reservation statistics), with one bulk write per collection, according to
+``RENTAL_STOCK_ITEM_DELETE_POLICY``:
+
+* ``reject``: refuse while the stock item has any reservations or damages, returned or
+  not, so that no history is lost; a stock item without any is just deleted.
+* ``soft_delete``: keep the reservations and damages but stamp them with ``deleted_at``;
+  the API no longer returns them.
+* ``archive``: move the reservations and damages to ``reservations_archive`` and
+  ``damages_archive``, stamped with ``archived_at``.
+
+Transactions need a replica set; on a standalone mongod the same steps run without one.
+:func:`delete_stock_items` deletes several stock items, each in its own transaction.
+"""
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Literal, Optional, Tuple, Union
+
+from pymongo import DeleteMany, InsertOne, UpdateMany
+from pymongo.errors import OperationFailure
+
+from queries import NOT_DELETED
+from services.archive import archive_collection, ensure_archive_collections
+from services.availability import AVAILABILITY_COLLECTION, OPEN_END, record_bookings
+from services.reservation_stats import record_stats
+from services.reservation_views import record_views
+from services.summary import record_changes
+
+logger = logging.getLogger(__name__)
+
+CascadePolicy = Literal["reject", "soft_delete", "archive"]
+
+DEPENDENT_COLLECTIONS = ("reservations", "damages")
+# "Transaction numbers are only allowed on a replica set member or mongos"
+_ILLEGAL_OPERATION = 20
+
+
+class StockItemInUse(Exception):
+    def __init__(self, stock_item_id, reservations: int, damages: int):
+        super().__init__(
+            f"Stock item {stock_item_id} has {reservations} reservation(s) and {damages} damage(s); "
+            "delete it with cascade=soft_delete or cascade=archive"
+        )
+        self.stock_item_id = stock_item_id
+        self.reservations = reservations
+        self.damages = damages
+
+
+async def _cascade(db, stock_item_id, policy: CascadePolicy, session) -> Tuple[Optional[Dict], Dict[str, List[Dict]]]:
+    availability = db[AVAILABILITY_COLLECTION]
+    if session is not None:
+        # Bookings are written to this document, so a reservation of the stock item made meanwhile
+        # conflicts with the transaction, which is then retried and sees it.
+        calendar = await availability.find_one_and_delete({"_id": stock_item_id}, session=session)
+    else:
+        calendar = await availability.find_one({"_id": stock_item_id})
+
+    # Checked before anything is deleted, so that it also holds without a transaction to roll back.
+    if policy == "reject":
+        history = {"stock_item_id": stock_item_id, **NOT_DELETED}
+        # A reservation is booked before it is inserted: count the open bookings too.
+        open_bookings = sum(booking["end"] == OPEN_END for booking in (calendar or {}).get("bookings", []))
+        reservations = max(await db.reservations.count_documents(history, session=session), open_bookings)
+        damages = await db.damages.count_documents(history, session=session)
+        if reservations or damages:
+            raise StockItemInUse(stock_item_id, reservations, damages)
+
+    stock_item = await db.stock_items.find_one_and_delete({"_id": stock_item_id}, session=session)
+    dependents: Dict[str, List[Dict]] = {}
+    if stock_item is None:
+        return None, dependents
+
+    for name in DEPENDENT_COLLECTIONS:
+        query = {"stock_item_id": stock_item_id, **NOT_DELETED}
+        dependents[name] = await db[name].find(query, session=session).to_list(None)
+
+    # The summary and statistics count the stock item's reservations and damages, so they must see them before they go.
+    await record_changes(db.stock_items, [(stock_item, None)], session=session)
+    await record_stats(db.stock_items, [(stock_item, None)], session=session)
+
+    now = datetime.now(timezone.utc)
+    for name, documents in dependents.items():
+        if not documents:
+            continue
+        query = {"stock_item_id": stock_item_id, **NOT_DELETED}
+        if policy == "soft_delete":
+            await db[name].bulk_write([UpdateMany(query, {"$set": {"deleted_at": now}})], session=session)
+            continue
+        if policy == "archive":
+            archived = [InsertOne({**document, "archived_at": now}) for document in documents]
+            await db[archive_collection(name)].bulk_write(archived, session=session)
+        await db[name].bulk_write([DeleteMany(query)], session=session)
+
+    return stock_item, dependents
+
+
+async def _delete(db, stock_item_id, policy: CascadePolicy) -> Optional[Dict]:
+    async def in_transaction(session):
+        return await _cascade(db, stock_item_id, policy, session)
+
+    async with await db.client.start_session() as session:
+        try:
+            # Retried as a whole on transient errors, e.g. a write conflict with a concurrent booking.
+            stock_item, dependents = await session.with_transaction(in_transaction)
+        except OperationFailure as e:
+            if e.code != _ILLEGAL_OPERATION:
+                raise
+            logger.warning("Deleting stock item %s without a transaction: %s", stock_item_id, e)
+            stock_item, dependents = await _cascade(db, stock_item_id, policy, None)
+
+    if stock_item is not None:
+        # The availability calendar goes with the stock item; the reservation views go with the reservations.
+        await record_bookings(db.stock_items, [(stock_item, None)])
+        await record_views(db.reservations, [(reservation, None) for reservation in dependents["reservations"]])
+    return stock_item
+
+
+async def _ensure_collections(db, policy: CascadePolicy) -> None:
+    if policy == "archive":
+        # Created with their compression settings outside the transaction, not implicitly by the first insert.
+        await ensure_archive_collections(db)
+
+
+async def delete_stock_item(db, stock_item_id, policy: CascadePolicy) -> Optional[Dict]:
+    """
+    Delete the stock item and apply ``policy`` to its reservations and damages.
+
+    Return the deleted stock item, or ``None`` if it does not exist. Raise
+    :class:`StockItemInUse` if ``policy`` is ``reject`` and the stock item has any history.
+    """
+    await _ensure_collections(db, policy)
+    return await _delete(db, stock_item_id, policy)
+
+
+async def delete_stock_items(db, stock_item_ids: Iterable, policy: CascadePolicy) -> List[Union[Dict, None, StockItemInUse]]:
+    """
+    :func:`delete_stock_item` for each of ``stock_item_ids``, concurrently.
+
+    Return, in the same order, the deleted stock item, ``None`` if it does not exist or the
+    :class:`StockItemInUse` error refusing to delete it.
+    """
+
+    async def delete(stock_item_id):
+        try:
+            return await _delete(db, stock_item_id, policy)
+        except StockItemInUse as e:
+            return e
+
+    await _ensure_collections(db, policy)
+    return list(await asyncio.gather(*(delete(stock_item_id) for stock_item_id in stock_item_ids)))
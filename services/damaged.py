@@ -0,0 +1,111 @@
+"""
+Damage counters on stock items, behind ``GET /stock-items/damaged/{storage_id}``.
+
+Every write to the damages reports its ``(before, after)`` documents to
+:func:`record_damages`, which keeps ``damage_count`` on the stock items current. The
+report then reads only the damaged stock items of a storage, through a partial index, one
+page at a time. :func:`rebuild_damage_counts` recomputes the counters from scratch.
+"""
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+from cache import resource_cache
+from fields import Fields, fields_under, projection
+from pagination import fetch_page
+from queries import NOT_DELETED
+from updates import VERSION_FIELD
+
+Change = Tuple[Optional[Dict], Optional[Dict]]
+
+DAMAGED = {"damage_count": {"$gt": 0}}
+
+
+def _counted(document: Optional[Dict]):
+    if document is None or document.get("deleted_at") is not None:
+        return None
+    return document.get("stock_item_id")
+
+
+async def record_damages(collection, changes: Iterable[Change]) -> None:
+    """
+    Write hook (same signature as ``services.summary.record_changes``) for damage writes.
+    """
+    if collection.name != "damages":
+        return
+    deltas: Counter = Counter()
+    for before, after in changes:
+        old, new = _counted(before), _counted(after)
+        if old != new:
+            if old is not None:
+                deltas[old] -= 1
+            if new is not None:
+                deltas[new] += 1
+    requests = [
+        UpdateOne({"_id": stock_item_id}, {"$inc": {"damage_count": delta}})
+        for stock_item_id, delta in deltas.items()
+        if delta
+    ]
+    if requests:
+        await collection.database.stock_items.bulk_write(requests, ordered=False)
+
+
+async def damaged_stock_items(
+    db, storage_id, limit: int, after: Optional[str], fields: Optional[Fields] = None
+) -> Tuple[List[Dict], Optional[str]]:
+    """
+    One page of the damaged stock items of a storage, each with its ``damages`` and ``resource``.
+
+    With ``fields``, only what is needed for them is read (the caller trims the result);
+    the damages and resources are not read at all if none of their fields is selected.
+    """
+    damage_fields, resource_fields = fields_under(fields, "damages"), fields_under(fields, "resource")
+    stock_items, next_cursor = await fetch_page(
+        db.stock_items,
+        {"storage_id": storage_id, **DAMAGED},
+        limit=limit,
+        after=after,
+        # The versions are each document's concurrency token, not part of the report.
+        projection=projection(None, fields, keep=["_id", "resource_id"]) or {VERSION_FIELD: 0},
+    )
+    if not stock_items:
+        return [], next_cursor
+
+    damages: Dict = {}
+    if damage_fields != ():
+        query = {"stock_item_id": {"$in": [stock_item["_id"] for stock_item in stock_items]}, **NOT_DELETED}
+        damage_projection = projection(None, damage_fields, keep=["stock_item_id"]) or {VERSION_FIELD: 0}
+        async for damage in db.damages.find(query, {**damage_projection, "_id": 0}):
+            damages.setdefault(damage["stock_item_id"], []).append(damage)
+    resources: Dict = {}
+    if resource_fields != ():
+        resources = await resource_cache.get_many(db.resources, [stock_item["resource_id"] for stock_item in stock_items])
+
+    for stock_item in stock_items:
+        stock_item["damages"] = damages.get(stock_item["_id"], [])
+        resource = resources.get(stock_item["resource_id"])
+        stock_item["resource"] = [{k: v for k, v in resource.items() if k not in ("_id", VERSION_FIELD)}] if resource is not None else []
+    return stock_items, next_cursor
+
+
+async def rebuild_damage_counts(db, batch_size: int = 1000) -> Dict[str, int]:
+    """
+    Recompute ``damage_count`` of every stock item from the damages.
+
+    Writes that happen while the rebuild runs may be missed; run it when traffic is low.
+    """
+    counts = {
+        row["_id"]: row["count"]
+        async for row in db.damages.aggregate([
+            {"$match": NOT_DELETED},
+            {"$group": {"_id": "$stock_item_id", "count": {"$sum": 1}}},
+        ])
+    }
+    requests = [UpdateOne({"_id": stock_item_id}, {"$set": {"damage_count": count}}) for stock_item_id, count in counts.items()]
+    for start in range(0, len(requests), batch_size):
+        await db.stock_items.bulk_write(requests[start:start + batch_size], ordered=False)
+    cleared = await db.stock_items.update_many(
+        {**DAMAGED, "_id": {"$nin": list(counts)}}, {"$unset": {"damage_count": ""}}
+    )
+    return {"damaged_stock_items": len(counts), "cleared": cleared.modified_count}
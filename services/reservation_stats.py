@@ -0,0 +1,269 @@
+"""
+Time-bucketed reservation statistics behind ``GET /reservations/stats``.
+
+The ``reservation_stats`` collection holds one document per resource (and per storage),
+granularity (``day``, ``week`` starting on Monday, ``month``; in UTC) and period, counting
+the reservations booked in that period:
+
+* ``bookings``: all of them,
+* ``returned``, ``rental_seconds``: those returned, and their total rental duration,
+* ``late_returns``: those returned more than ``RENTAL_LOAN_PERIOD_DAYS`` after booking,
+* ``open``: those not returned yet.
+
+Like the storage summary (see ``services.summary``), reservations count for their stock
+item's current resource and storage, archived ones included. Every write to reservations
+and stock items reports its ``(before, after)`` documents to :func:`record_stats`, which
+turns them into ``$inc`` updates; :func:`rebuild_reservation_stats` recomputes the
+collection from scratch. Reading a period is then one indexed query, whatever the history.
+"""
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, Iterator, List, Literal, Optional, Tuple
+
+from pymongo import UpdateOne
+
+from indexes import INDEXES
+from queries import NOT_DELETED
+from services.archive import archive_collection
+from settings import get_settings
+
+STATS_COLLECTION = "reservation_stats"
+
+Change = Tuple[Optional[Dict], Optional[Dict]]
+GroupBy = Literal["resource", "storage"]
+Granularity = Literal["day", "week", "month"]
+
+_GRANULARITIES: Tuple[Granularity, ...] = ("day", "week", "month")
+_DIMENSIONS = (("resource", "resource_id"), ("storage", "storage_id"))
+_COUNTERS = ("bookings", "returned", "rental_seconds", "late_returns", "open")
+
+# Periods one request may ask for
+MAX_PERIODS = 366
+
+# (dimension, key, granularity, start)
+BucketKey = Tuple[str, object, str, datetime]
+
+
+def _utc(value: datetime) -> datetime:
+    # Stored dates are naive UTC; request bodies may carry an offset.
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def bucket_start(granularity: Granularity, value: datetime) -> datetime:
+    day = datetime(value.year, value.month, value.day)
+    if granularity == "week":
+        return day - timedelta(days=day.weekday())
+    if granularity == "month":
+        return day.replace(day=1)
+    return day
+
+
+def bucket_end(granularity: Granularity, start: datetime) -> datetime:
+    if granularity == "week":
+        return start + timedelta(weeks=1)
+    if granularity == "month":
+        return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    return start + timedelta(days=1)
+
+
+def periods(granularity: Granularity, start: datetime, end: datetime, limit: int) -> int:
+    """
+    Number of buckets overlapping ``[start, end)``, counted up to ``limit + 1``.
+    """
+    count, period = 0, bucket_start(granularity, _utc(start))
+    while period < _utc(end) and count <= limit:
+        count, period = count + 1, bucket_end(granularity, period)
+    return count
+
+
+def _counters(reservation: Dict) -> Dict[str, float]:
+    returned = reservation.get("return_date")
+    if returned is None:
+        return {"bookings": 1, "open": 1}
+    duration = (_utc(returned) - _utc(reservation["booking_date"])).total_seconds()
+    late = duration > timedelta(days=get_settings().loan_period_days).total_seconds()
+    return {"bookings": 1, "returned": 1, "rental_seconds": duration, "late_returns": int(late)}
+
+
+def _contributions(reservation: Optional[Dict], stock_item: Optional[Dict]) -> Iterator[Tuple[BucketKey, Dict[str, float]]]:
+    """
+    The counters ``reservation`` adds to each of its buckets, if it counts at all.
+    """
+    if (
+        reservation is None or stock_item is None
+        or reservation.get("deleted_at") is not None or reservation.get("booking_date") is None
+    ):
+        return
+    counters = _counters(reservation)
+    booked = _utc(reservation["booking_date"])
+    for dimension, field in _DIMENSIONS:
+        if (key := stock_item.get(field)) is None:
+            continue
+        for granularity in _GRANULARITIES:
+            yield (dimension, key, granularity, bucket_start(granularity, booked)), counters
+
+
+def _add(deltas: Counter, reservation: Optional[Dict], stock_item: Optional[Dict], sign: int) -> None:
+    for bucket, counters in _contributions(reservation, stock_item):
+        for counter, value in counters.items():
+            deltas[bucket + (counter,)] += sign * value
+
+
+async def _stock_items(db, stock_item_ids, session=None) -> Dict:
+    ids = list({_id for _id in stock_item_ids if _id is not None})
+    if not ids:
+        return {}
+    return {
+        stock_item["_id"]: stock_item
+        async for stock_item in db.stock_items.find(
+            {"_id": {"$in": ids}}, {"resource_id": 1, "storage_id": 1}, session=session
+        )
+    }
+
+
+async def _reservations_of(db, stock_item_ids: List, session=None) -> List[Dict]:
+    query = {"stock_item_id": {"$in": stock_item_ids}, **NOT_DELETED}
+    projection = {"stock_item_id": 1, "booking_date": 1, "return_date": 1}
+    reservations = await db.reservations.find(query, projection, session=session).to_list(None)
+    archived = db[archive_collection("reservations")].find(query, projection, session=session)
+    return reservations + await archived.to_list(None)
+
+
+async def record_stats(collection, changes: Iterable[Change], session=None) -> None:
+    """
+    Write hook (same signature as ``services.summary.record_changes``) keeping the reservation statistics current.
+
+    For a stock item that is deleted or moved, call this *before* its reservations are touched.
+    """
+    changes = list(changes)
+    db = collection.database
+    deltas: Counter = Counter()
+
+    if collection.name == "reservations":
+        stock_items = await _stock_items(
+            db, [document.get("stock_item_id") for change in changes for document in change if document is not None],
+            session,
+        )
+        for before, after in changes:
+            if before is not None:
+                _add(deltas, before, stock_items.get(before.get("stock_item_id")), -1)
+            if after is not None:
+                _add(deltas, after, stock_items.get(after.get("stock_item_id")), 1)
+
+    elif collection.name == "stock_items":
+        # Reservations follow their stock item; brand new stock items have none.
+        moved = {
+            before["_id"]: (before, after)
+            for before, after in changes
+            if before is not None
+            and (after is None or any(before.get(field) != after.get(field) for _, field in _DIMENSIONS))
+        }
+        if not moved:
+            return
+        for reservation in await _reservations_of(db, list(moved), session):
+            before, after = moved[reservation["stock_item_id"]]
+            _add(deltas, reservation, before, -1)
+            _add(deltas, reservation, after, 1)
+
+    increments: Dict[BucketKey, Dict[str, float]] = {}
+    for (*bucket, counter), delta in deltas.items():
+        if delta:
+            increments.setdefault(tuple(bucket), {})[counter] = delta
+    requests = [
+        UpdateOne(
+            {"dimension": dimension, "key": key, "granularity": granularity, "start": start},
+            {"$inc": increment},
+            upsert=True,
+        )
+        for (dimension, key, granularity, start), increment in increments.items()
+    ]
+    if requests:
+        await db[STATS_COLLECTION].bulk_write(requests, ordered=False, session=session)
+
+
+async def list_stats(
+    db, group_by: GroupBy, granularity: Granularity, start: datetime, end: datetime, key=None
+) -> List[Dict]:
+    """
+    The buckets of ``group_by`` (one resource or storage if ``key`` is given) overlapping ``[start, end)``.
+
+    ``overdue`` counts the late returns, plus the open reservations once the whole bucket is
+    past the loan period; open reservations of more recent buckets are only counted in ``open``.
+    """
+    query = {
+        "dimension": group_by,
+        "granularity": granularity,
+        "start": {"$gte": bucket_start(granularity, _utc(start)), "$lt": _utc(end)},
+    }
+    if key is not None:
+        query["key"] = key
+    overdue_before = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=get_settings().loan_period_days)
+
+    buckets = []
+    async for bucket in db[STATS_COLLECTION].find(query).sort([("start", 1), ("key", 1)]):
+        counts = {counter: bucket.get(counter, 0) for counter in _COUNTERS}
+        if not counts["bookings"]:
+            # Every reservation of the bucket was moved or deleted since.
+            continue
+        overdue = counts["late_returns"]
+        if bucket_end(granularity, bucket["start"]) <= overdue_before:
+            overdue += counts["open"]
+        buckets.append({
+            "id": bucket["key"],
+            "start": bucket["start"],
+            "bookings": counts["bookings"],
+            "returned": counts["returned"],
+            "open": counts["open"],
+            "overdue": overdue,
+            "average_rental_days": counts["rental_seconds"] / counts["returned"] / 86400 if counts["returned"] else None,
+        })
+    return buckets
+
+
+async def rebuild_reservation_stats(db, batch_size: int = 1000) -> Dict[str, int]:
+    """
+    Recompute every reservation statistic and atomically swap them in.
+
+    Writes that happen while the rebuild runs may be missed; run it when traffic is low.
+    """
+    deltas: Counter = Counter()
+    count = 0
+    batch: List[Dict] = []
+
+    async def flush():
+        nonlocal count
+        stock_items = await _stock_items(db, [reservation.get("stock_item_id") for reservation in batch])
+        for reservation in batch:
+            _add(deltas, reservation, stock_items.get(reservation.get("stock_item_id")), 1)
+        count += len(batch)
+
+    projection = {"stock_item_id": 1, "booking_date": 1, "return_date": 1}
+    for source in (db.reservations, db[archive_collection("reservations")]):
+        async for reservation in source.find(NOT_DELETED, projection):
+            batch.append(reservation)
+            if len(batch) >= batch_size:
+                await flush()
+                batch = []
+    if batch:
+        await flush()
+
+    buckets: Dict[BucketKey, Dict[str, float]] = {}
+    for (*bucket, counter), value in deltas.items():
+        buckets.setdefault(tuple(bucket), dict.fromkeys(_COUNTERS, 0))[counter] = value
+    documents = [
+        {"dimension": dimension, "key": key, "granularity": granularity, "start": start, **counters}
+        for (dimension, key, granularity, start), counters in buckets.items()
+    ]
+
+    staging = db[STATS_COLLECTION + "_rebuild"]
+    await staging.drop()
+    if documents:
+        for start in range(0, len(documents), batch_size):
+            await staging.insert_many(documents[start:start + batch_size])
+        await staging.create_indexes(INDEXES[STATS_COLLECTION])
+        await staging.rename(STATS_COLLECTION, dropTarget=True)
+    else:
+        await db[STATS_COLLECTION].delete_many({})
+    return {"reservations": count, "buckets": len(documents)}
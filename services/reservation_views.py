@@ -0,0 +1,190 @@
+"""
+Denormalised reservations behind ``GET /reservations/detailed``.
+
+The ``reservation_views`` collection holds every reservation together with snapshots of
+its stock item, resource and storage (``stock_item_details``, ``resource_details``,
+``storage_details``), so listing them is a single indexed read instead of three joins.
+
+Reservation and stock item writes update the affected views straight away. Resources and
+storages are embedded in many views, so their changes are patched in by a background task
+after the response has been sent; views can lag behind such a change for a moment.
+:func:`rebuild_reservation_views` recomputes the collection from scratch.
+
+Archived reservations have no view: :func:`archived_view_stages` and :func:`add_archived_details`
+give them the same details when they are read, from the current documents.
+"""
+import asyncio
+import logging
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from pymongo import DeleteOne, ReplaceOne
+
+from indexes import INDEXES
+from queries import NOT_DELETED
+from updates import VERSION_FIELD
+
+logger = logging.getLogger(__name__)
+
+VIEW_COLLECTION = "reservation_views"
+
+Change = Tuple[Optional[Dict], Optional[Dict]]
+
+# Field of the view that embeds a snapshot of each referenced collection, and the
+# stock item field that refers to it.
+_EMBEDDED = {"resources": ("resource_details", "resource_id"), "storages": ("storage_details", "storage_id")}
+
+_pending: Set[asyncio.Task] = set()
+
+
+def _snapshot(document: Optional[Dict]) -> Optional[Dict]:
+    if document is None:
+        return None
+    # The version is the embedded document's own concurrency token, not part of the view.
+    return {k: v for k, v in document.items() if k not in ("_id", VERSION_FIELD)}
+
+
+async def _by_id(collection, ids: Iterable) -> Dict:
+    ids = list({_id for _id in ids if _id is not None})
+    if not ids:
+        return {}
+    return {document["_id"]: document async for document in collection.find({"_id": {"$in": ids}})}
+
+
+async def _details(db, stock_item_ids: Iterable) -> Dict:
+    """
+    Return ``{stock_item_id: {"stock_item_details": ..., "resource_details": ..., "storage_details": ...}}``.
+    """
+    stock_items = {
+        stock_item["_id"]: stock_item
+        async for stock_item in db.stock_items.find({"_id": {"$in": list(set(stock_item_ids))}})
+    }
+    # Read from the collections: the cache of this worker may not have seen another worker's write yet.
+    resources = await _by_id(db.resources, [s.get("resource_id") for s in stock_items.values()])
+    storages = await _by_id(db.storages, [s.get("storage_id") for s in stock_items.values()])
+    return {
+        _id: {
+            "stock_item_details": _snapshot(stock_item),
+            "resource_details": _snapshot(resources.get(stock_item.get("resource_id"))),
+            "storage_details": _snapshot(storages.get(stock_item.get("storage_id"))),
+        }
+        for _id, stock_item in stock_items.items()
+    }
+
+
+_NO_DETAILS = {"stock_item_details": None, "resource_details": None, "storage_details": None}
+
+
+async def build_views(db, reservations: List[Dict]) -> List[Dict]:
+    details = await _details(db, [r.get("stock_item_id") for r in reservations if r.get("stock_item_id") is not None])
+    return [{**reservation, **details.get(reservation.get("stock_item_id"), _NO_DETAILS)} for reservation in reservations]
+
+
+def archived_view_stages(query: Dict) -> List[Dict]:
+    """
+    Stages adding to archived reservations the details ``query`` filters on.
+    """
+    if not any(key.startswith("stock_item_details.") for key in query):
+        return []
+    return [
+        {"$lookup": {"from": "stock_items", "localField": "stock_item_id", "foreignField": "_id", "as": "stock_item_details"}},
+        {"$set": {"stock_item_details": {"$arrayElemAt": ["$stock_item_details", 0]}}},
+    ]
+
+
+async def add_archived_details(db, reservations: List[Dict]) -> List[Dict]:
+    """
+    Complete the archived reservations (stamped with ``archived_at``) of a page read with :func:`archived_view_stages`.
+    """
+    archived = iter(await build_views(db, [r for r in reservations if "archived_at" in r]))
+    return [next(archived) if "archived_at" in reservation else reservation for reservation in reservations]
+
+
+async def _patch_embedded(db, collection_name: str, changes: List[Change]) -> None:
+    field, reference = _EMBEDDED[collection_name]
+    views = db[VIEW_COLLECTION]
+    for before, after in changes:
+        _id = (after or before)["_id"]
+        await views.update_many({f"stock_item_details.{reference}": _id}, {"$set": {field: _snapshot(after)}})
+
+
+def _run_in_background(coroutine, description: str) -> None:
+    async def run():
+        try:
+            await coroutine
+        except Exception:
+            logger.exception("Could not %s", description)
+
+    task = asyncio.create_task(run())
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+
+
+async def wait_for_pending() -> None:
+    """
+    Let the background patches that are still running finish (called on shutdown).
+    """
+    if _pending:
+        await asyncio.gather(*_pending, return_exceptions=True)
+
+
+async def record_views(collection, changes: Iterable[Change]) -> None:
+    """
+    Write hook (same signature as ``services.summary.record_changes``) keeping the reservation views current.
+    """
+    changes = list(changes)
+    db = collection.database
+    views = db[VIEW_COLLECTION]
+
+    if collection.name == "reservations":
+        requests = [DeleteOne({"_id": before["_id"]}) for before, after in changes if after is None]
+        written = await build_views(db, [after for _, after in changes if after is not None])
+        requests += [ReplaceOne({"_id": view["_id"]}, view, upsert=True) for view in written]
+        if requests:
+            await views.bulk_write(requests, ordered=False)
+
+    elif collection.name == "stock_items":
+        # New stock items have no reservations yet.
+        changed = [(before, after) for before, after in changes if before is not None and before != after]
+        if not changed:
+            return
+        details = await _details(db, [after["_id"] for _, after in changed if after is not None])
+        for before, after in changed:
+            await views.update_many(
+                {"stock_item_id": before["_id"]}, {"$set": details.get(before["_id"], _NO_DETAILS)}
+            )
+
+    elif collection.name in _EMBEDDED:
+        _run_in_background(
+            _patch_embedded(db, collection.name, changes), f"patch {collection.name} into {VIEW_COLLECTION}"
+        )
+
+
+async def rebuild_reservation_views(db, batch_size: int = 1000) -> Dict[str, int]:
+    """
+    Recompute every reservation view and atomically swap them in.
+
+    Writes that happen while the rebuild runs may be missed; run it when traffic is low.
+    """
+    staging = db[VIEW_COLLECTION + "_rebuild"]
+    await staging.drop()
+    count = 0
+    batch = []
+
+    async def flush():
+        await staging.insert_many(await build_views(db, batch))
+
+    async for reservation in db.reservations.find(NOT_DELETED):
+        batch.append(reservation)
+        count += 1
+        if len(batch) >= batch_size:
+            await flush()
+            batch = []
+    if batch:
+        await flush()
+
+    if count:
+        await staging.create_indexes(INDEXES[VIEW_COLLECTION])
+        await staging.rename(VIEW_COLLECTION, dropTarget=True)
+    else:
+        await db[VIEW_COLLECTION].delete_many({})
+    return {"reservations": count}
@@ -0,0 +1,297 @@
+"""
+Full-text search over resources behind ``GET /resources/search``.
+
+``RENTAL_SEARCH_BACKEND`` selects the implementation:
+
+* ``atlas`` (default) runs the ``$search`` stage against the ``baseTextSearch`` Atlas Search index.
+* ``local`` keeps an inverted index of every resource in process, over all of its string
+  fields (the ``extra`` ones too). Queries are tokenised, every query term also matches the
+  indexed terms it is a prefix of, and results are ranked with BM25. The index is built from
+  the collection on first use, updated by the resource write hooks and the change stream,
+  and rebuilt in the background every ``RENTAL_SEARCH_INDEX_MAX_AGE_SECONDS`` to catch
+  anything missed.
+"""
+import asyncio
+import bisect
+import logging
+import math
+import re
+import time
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+ATLAS_INDEX = "baseTextSearch"
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+# Weight of a term that a query term is only a prefix of, and how many such terms are considered.
+PREFIX_WEIGHT = 0.5
+MAX_PREFIX_EXPANSIONS = 50
+
+_TOKEN = re.compile(r"\w+")
+
+Change = Tuple[Optional[Dict], Optional[Dict]]
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split ``text`` into lowercase, accent-free word tokens.
+    """
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return _TOKEN.findall(text)
+
+
+def _strings(value: Any) -> Iterable[str]:
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for nested in value.values():
+            yield from _strings(nested)
+    elif isinstance(value, (list, tuple)):
+        for nested in value:
+            yield from _strings(nested)
+
+
+def document_terms(document: Dict) -> Counter:
+    return Counter(
+        term for key, value in document.items() if key != "_id" for text in _strings(value) for term in tokenize(text)
+    )
+
+
+class InvertedIndex:
+    """
+    Term -> ``{document id: term frequency}`` postings with BM25 scoring and prefix expansion.
+    """
+
+    def __init__(self):
+        self.postings: Dict[str, Dict[Any, int]] = defaultdict(dict)
+        self.lengths: Dict[Any, int] = {}
+        self._terms_of: Dict[Any, Counter] = {}
+        self._sorted_terms: List[str] = []
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def add(self, doc_id, terms: Counter, *, keep_sorted: bool = True) -> None:
+        self.remove(doc_id)
+        for term, frequency in terms.items():
+            postings = self.postings[term]
+            if not postings and keep_sorted:
+                bisect.insort(self._sorted_terms, term)
+            postings[doc_id] = frequency
+        self._terms_of[doc_id] = terms
+        self.lengths[doc_id] = length = sum(terms.values())
+        self._total_length += length
+
+    def remove(self, doc_id) -> None:
+        terms = self._terms_of.pop(doc_id, None)
+        if terms is None:
+            return
+        for term in terms:
+            postings = self.postings[term]
+            postings.pop(doc_id, None)
+            if not postings:
+                del self.postings[term]
+                position = bisect.bisect_left(self._sorted_terms, term)
+                if position < len(self._sorted_terms) and self._sorted_terms[position] == term:
+                    del self._sorted_terms[position]
+        self._total_length -= self.lengths.pop(doc_id)
+
+    def sort_terms(self) -> None:
+        self._sorted_terms = sorted(self.postings)
+
+    def _expansions(self, prefix: str) -> List[str]:
+        start = bisect.bisect_left(self._sorted_terms, prefix)
+        expansions = []
+        for term in self._sorted_terms[start:]:
+            if not term.startswith(prefix) or len(expansions) >= MAX_PREFIX_EXPANSIONS:
+                break
+            expansions.append(term)
+        return expansions
+
+    def search(self, query: str, limit: int) -> List[Tuple[Any, float]]:
+        """
+        Return up to ``limit`` ``(document id, score)`` pairs, best first.
+        """
+        count = len(self.lengths)
+        if not count:
+            return []
+        average_length = self._total_length / count or 1
+        scores: Dict[Any, float] = defaultdict(float)
+
+        for query_term in set(tokenize(query)):
+            best: Dict[Any, float] = {}
+            for term in self._expansions(query_term):
+                postings = self.postings[term]
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                weight = 1.0 if term == query_term else PREFIX_WEIGHT
+                for doc_id, frequency in postings.items():
+                    norm = K1 * (1 - B + B * self.lengths[doc_id] / average_length)
+                    score = weight * idf * frequency * (K1 + 1) / (frequency + norm)
+                    if score > best.get(doc_id, 0.0):
+                        best[doc_id] = score
+            for doc_id, score in best.items():
+                scores[doc_id] += score
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], str(item[0])))
+        return ranked[:limit]
+
+
+class AtlasSearchBackend:
+    async def search(self, collection, query: str, limit: int, projection: Optional[Dict] = None) -> List[Dict]:
+        pipeline = [
+            {
+                '$search': {
+                    'index': ATLAS_INDEX,
+                    'text': {
+                        'query': query,
+                        'path': {
+                            'wildcard': "*"
+                        }
+                    }
+                }
+            },
+            {
+                '$limit': limit
+            }
+        ]
+        if projection:
+            pipeline.append({'$project': projection})
+        return await collection.aggregate(pipeline).to_list(limit)
+
+
+class LocalSearchBackend:
+    """
+    In-process inverted index of the resources collection.
+    """
+
+    def __init__(self, max_age: float):
+        self.max_age = max_age
+        self.index = InvertedIndex()
+        self.documents: Dict[Any, Dict] = {}
+        self._collection = None
+        self._built_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+        self._rebuild: Optional[asyncio.Task] = None
+        # Documents put (or removed, None) while a build reads the collection, one dict per running build
+        self._building: List[Dict[Any, Optional[Dict]]] = []
+
+    async def _build(self, collection) -> None:
+        index, documents = InvertedIndex(), {}
+        changed: Dict[Any, Optional[Dict]] = {}
+        self._building.append(changed)
+        try:
+            async for document in collection.find():
+                documents[document["_id"]] = document
+                index.add(document["_id"], document_terms(document), keep_sorted=False)
+        finally:
+            self._building.remove(changed)
+        # The scan may have read some documents before these writes: replay them on top.
+        for doc_id, document in changed.items():
+            if document is None:
+                documents.pop(doc_id, None)
+                index.remove(doc_id)
+            else:
+                documents[doc_id] = document
+                index.add(doc_id, document_terms(document), keep_sorted=False)
+        index.sort_terms()
+        self.index, self.documents = index, documents
+        self._collection = collection
+        self._built_at = time.monotonic()
+        logger.info("Built the local search index of %d resources", len(documents))
+
+    async def _rebuild_in_background(self, collection) -> None:
+        try:
+            await self._build(collection)
+        except Exception:
+            logger.exception("Could not rebuild the local search index")
+        finally:
+            self._rebuild = None
+
+    async def _ensure_built(self, collection) -> None:
+        if self._built_at is None:
+            async with self._lock:
+                if self._built_at is None:
+                    await self._build(collection)
+        elif self.max_age and time.monotonic() - self._built_at > self.max_age and self._rebuild is None:
+            self._rebuild = asyncio.create_task(self._rebuild_in_background(collection))
+
+    async def search(self, collection, query: str, limit: int, projection: Optional[Dict] = None) -> List[Dict]:
+        # The documents are in memory already; ``projection`` is left to the response.
+        await self._ensure_built(collection)
+        return [self.documents[doc_id] for doc_id, _ in self.index.search(query, limit)]
+
+    def put(self, document: Dict) -> None:
+        for changed in self._building:
+            changed[document["_id"]] = document
+        if self._built_at is None:
+            return
+        self.documents[document["_id"]] = document
+        self.index.add(document["_id"], document_terms(document))
+
+    def remove(self, doc_id) -> None:
+        for changed in self._building:
+            changed[doc_id] = None
+        if self._built_at is None:
+            return
+        self.documents.pop(doc_id, None)
+        self.index.remove(doc_id)
+
+    async def refresh(self, doc_id) -> None:
+        if self._collection is None:
+            return
+        if (document := await self._collection.find_one({"_id": doc_id})) is not None:
+            self.put(document)
+        else:
+            self.remove(doc_id)
+
+    def reset(self) -> None:
+        """
+        Forget everything; the index is rebuilt on the next search.
+        """
+        self.index, self.documents, self._built_at = InvertedIndex(), {}, None
+
+
+_settings = get_settings()
+if _settings.search_backend == "local":
+    search_backend = LocalSearchBackend(_settings.search_index_max_age_seconds)
+else:
+    search_backend = AtlasSearchBackend()
+
+
+async def index_changes(collection, changes: Iterable[Change]) -> None:
+    """
+    Write hook (same signature as ``services.summary.record_changes``) for resource writes.
+    """
+    if not isinstance(search_backend, LocalSearchBackend) or collection.name != "resources":
+        return
+    for before, after in changes:
+        if after is None:
+            search_backend.remove(before["_id"])
+        else:
+            search_backend.put(after)
+
+
+async def reindex_from_change(change: Dict) -> None:
+    """
+    Change stream handler: pick up resource writes made by other workers.
+    """
+    if not isinstance(search_backend, LocalSearchBackend) or change.get("ns", {}).get("coll") != "resources":
+        return
+    if (document_key := change.get("documentKey")) is not None:
+        await search_backend.refresh(document_key["_id"])
+    else:
+        search_backend.reset()
+
+
+async def reset_index() -> None:
+    if isinstance(search_backend, LocalSearchBackend):
+        search_backend.reset()
@@ -0,0 +1,179 @@
+"""
+Materialised per-storage counters behind ``GET /storages/summary``.
+
+Every write to storages, stock items, reservations and damages reports its
+``(before, after)`` documents to :func:`record_changes`, which turns them into
+``$inc`` updates of the ``storage_summaries`` collection. :func:`rebuild_summaries`
+recomputes the collection from scratch, e.g. after a deploy or if counters drifted.
+"""
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+import queries
+from services.archive import archive_collection
+
+SUMMARY_COLLECTION = "storage_summaries"
+
+Change = Tuple[Optional[Dict], Optional[Dict]]
+
+_COUNTERS = ("total_stock_items", "total_reservations", "total_damages")
+
+
+async def _storages_of_stock_items(db, stock_item_ids, session=None) -> Dict:
+    stock_items = await db.stock_items.find(
+        {"_id": {"$in": list(stock_item_ids)}}, {"storage_id": 1}, session=session
+    ).to_list(None)
+    return {stock_item["_id"]: stock_item["storage_id"] for stock_item in stock_items}
+
+
+async def _counts_per_stock_item(db, name: str, stock_item_ids, session=None) -> Counter:
+    # Archived documents still count, as in rebuild_summaries.
+    pipeline = queries.counts_per_stock_item(stock_item_ids)
+    counts: Counter = Counter()
+    for collection in (db[name], db[archive_collection(name)]):
+        async for row in collection.aggregate(pipeline, session=session):
+            counts[row["_id"]] += row["count"]
+    return counts
+
+
+async def _stock_item_deltas(db, changes: List[Change], deltas: Counter, session=None) -> None:
+    moved: List[Tuple[Optional[Dict], Optional[Dict]]] = []
+    for before, after in changes:
+        old_storage = before.get("storage_id") if before else None
+        new_storage = after.get("storage_id") if after else None
+        if old_storage != new_storage:
+            moved.append((before, after))
+            if old_storage is not None:
+                deltas[old_storage, "total_stock_items"] -= 1
+            if new_storage is not None:
+                deltas[new_storage, "total_stock_items"] += 1
+
+    # Reservations and damages follow their stock item. Brand new stock items have none.
+    existing = [before["_id"] for before, _ in moved if before is not None]
+    if not existing:
+        return
+    reservations = await _counts_per_stock_item(db, "reservations", existing, session)
+    damages = await _counts_per_stock_item(db, "damages", existing, session)
+    for before, after in moved:
+        if before is None:
+            continue
+        for counter, counts in (("total_reservations", reservations), ("total_damages", damages)):
+            count = counts[before["_id"]]
+            if before.get("storage_id") is not None:
+                deltas[before["storage_id"], counter] -= count
+            if after is not None and after.get("storage_id") is not None:
+                deltas[after["storage_id"], counter] += count
+
+
+async def _child_deltas(db, changes: List[Change], counter: str, deltas: Counter, session=None) -> None:
+    stock_item_ids = {
+        document.get("stock_item_id")
+        for change in changes
+        for document in change
+        if document is not None and document.get("stock_item_id") is not None
+    }
+    if not stock_item_ids:
+        return
+    storages = await _storages_of_stock_items(db, stock_item_ids, session)
+    for before, after in changes:
+        old_storage = storages.get(before.get("stock_item_id")) if before else None
+        new_storage = storages.get(after.get("stock_item_id")) if after else None
+        if old_storage != new_storage:
+            if old_storage is not None:
+                deltas[old_storage, counter] -= 1
+            if new_storage is not None:
+                deltas[new_storage, counter] += 1
+
+
+async def record_changes(collection, changes: Iterable[Change], session=None) -> None:
+    """
+    Update the storage summaries for writes made to ``collection``.
+
+    ``changes`` holds one ``(before, after)`` pair per written document: ``before`` is
+    ``None`` for inserts and ``after`` is ``None`` for deletes. For a stock item that is
+    deleted or moved, call this *before* its reservations and damages are touched. Pass the
+    ``session`` of a transaction to update the summaries in it.
+    """
+    changes = list(changes)
+    db = collection.database
+    summaries = db[SUMMARY_COLLECTION]
+    deltas: Counter = Counter()
+    requests = []
+
+    if collection.name == "storages":
+        for before, after in changes:
+            if after is None:
+                requests.append(UpdateOne({"_id": before["_id"]}, {"$set": {"deleted": True}}))
+            elif before is None:
+                requests.append(UpdateOne(
+                    {"_id": after["_id"]},
+                    {"$setOnInsert": {counter: 0 for counter in _COUNTERS}},
+                    upsert=True,
+                ))
+    elif collection.name == "stock_items":
+        await _stock_item_deltas(db, changes, deltas, session)
+    elif collection.name == "reservations":
+        await _child_deltas(db, changes, "total_reservations", deltas, session)
+    elif collection.name == "damages":
+        await _child_deltas(db, changes, "total_damages", deltas, session)
+
+    increments: Dict = {}
+    for (storage_id, counter), delta in deltas.items():
+        if delta:
+            increments.setdefault(storage_id, {})[counter] = delta
+    requests += [
+        UpdateOne({"_id": storage_id}, {"$inc": increment}, upsert=True)
+        for storage_id, increment in increments.items()
+    ]
+    if requests:
+        await summaries.bulk_write(requests, ordered=False, session=session)
+
+
+async def list_summaries(db) -> List[Dict]:
+    return await db[SUMMARY_COLLECTION].find({"deleted": {"$ne": True}}).sort("_id", 1).to_list(None)
+
+
+async def rebuild_summaries(db) -> Dict[str, int]:
+    """
+    Recompute every storage summary from the source collections and atomically swap them in.
+
+    Writes that happen while the rebuild runs may be missed; run it when traffic is low.
+    """
+    per_storage = {
+        storage["_id"]: dict.fromkeys(_COUNTERS, 0)
+        async for storage in db.storages.find({}, {"_id": 1})
+    }
+
+    join_storage = [
+        {"$lookup": {
+            "from": "stock_items",
+            "localField": "stock_item_id",
+            "foreignField": "_id",
+            "as": "stock_item",
+        }},
+        {"$unwind": "$stock_item"},
+        {"$group": {"_id": "$stock_item.storage_id", "count": {"$sum": 1}}},
+    ]
+    # Archived reservations and damages still count.
+    sources = (
+        ("total_stock_items", db.stock_items, [{"$group": {"_id": "$storage_id", "count": {"$sum": 1}}}]),
+        ("total_reservations", db.reservations, join_storage),
+        ("total_reservations", db.reservations_archive, join_storage),
+        ("total_damages", db.damages, join_storage),
+        ("total_damages", db.damages_archive, join_storage),
+    )
+    for counter, collection, pipeline in sources:
+        async for row in collection.aggregate(pipeline):
+            if row["_id"] in per_storage:
+                per_storage[row["_id"]][counter] += row["count"]
+
+    staging = db[SUMMARY_COLLECTION + "_rebuild"]
+    await staging.drop()
+    if per_storage:
+        await staging.insert_many([{"_id": storage_id, **counts} for storage_id, counts in per_storage.items()])
+        await staging.rename(SUMMARY_COLLECTION, dropTarget=True)
+    else:
+        await db[SUMMARY_COLLECTION].delete_many({})
+    return {"storages": len(per_storage)}
@@ -0,0 +1,106 @@
+import os
+from functools import lru_cache
+from typing import Literal, Optional
+
+from pydantic import BaseModel
+
+ENV_PREFIX = "RENTAL_"
+
+
+class Settings(BaseModel):
+    """
+    Runtime configuration for the service.
+
+    Every field can be overridden through an environment variable named
+    ``RENTAL_<FIELD_NAME>``; the connection string is read from ``MONGODB_URL``.
+    """
+
+    mongodb_url: str = "mongodb://localhost:27017"
+    database_name: str = "rental_service"
+
+    # Connection pool
+    max_pool_size: int = 100
+    min_pool_size: int = 10
+    max_idle_time_ms: Optional[int] = None
+    wait_queue_timeout_ms: Optional[int] = None
+
+    # Timeouts
+    connect_timeout_ms: int = 10_000
+    server_selection_timeout_ms: int = 10_000
+    socket_timeout_ms: Optional[int] = None
+
+    # Read routing and wire compression, e.g. "secondaryPreferred" / "zstd,snappy"
+    read_preference: str = "primary"
+    compressors: Optional[str] = None
+
+    # Write concern applied to every write, e.g. "majority" or "1" for acknowledged-only writes.
+    # Unset means whatever the connection string says.
+    write_concern: Optional[str] = None
+    write_journal: Optional[bool] = None
+
+    # Documents per bulk_write batch of the /bulk endpoints
+    bulk_chunk_size: int = 1000
+    # How long the response to a PUT with an Idempotency-Key is replayed to retries
+    idempotency_key_ttl_seconds: int = 86_400
+
+    # Read cache for resources and storages; a TTL of 0 disables caching
+    cache_ttl_seconds: float = 60.0
+    cache_max_entries: int = 10_000
+    # Evict cache entries written by other workers using a change stream (needs a replica set)
+    change_streams_enabled: bool = True
+
+    # ETag and Cache-Control headers on GET responses, and 304 answers to If-None-Match
+    http_caching_enabled: bool = True
+    # Keep the responses of the aggregation endpoints for this long, shared by all clients; 0 disables it
+    response_cache_ttl_seconds: float = 0.0
+
+    # Bookings that ended longer ago than this are dropped from the availability index
+    # and no longer checked for conflicts
+    availability_history_days: int = 30
+
+    # What deleting a stock item does to its reservations and damages: "reject" (refuse while it has
+    # any), "soft_delete" (stamp them with deleted_at) or "archive" (move them to *_archive)
+    stock_item_delete_policy: Literal["reject", "soft_delete", "archive"] = "reject"
+
+    # Reservations kept out longer than this are overdue in GET /reservations/stats
+    loan_period_days: int = 14
+
+    # `manage.py archive` moves reservations returned, and damages resolved, longer ago than this to the archive
+    archive_after_days: int = 365
+
+    # Full-text search of resources: Atlas Search, or an in-process index (works with any mongod)
+    search_backend: Literal["atlas", "local"] = "atlas"
+    # Rebuild the in-process index from the collection this often; 0 never rebuilds it
+    search_index_max_age_seconds: float = 600.0
+
+    # Encode responses with orjson straight from the documents instead of validating them through the
+    # response models (request bodies are still validated)
+    fast_json_responses: bool = False
+
+    # Server-Timing headers, per-route/per-collection histograms (GET /metrics/prometheus) and slow pipeline logs
+    instrumentation_enabled: bool = True
+    # Log aggregations slower than this; 0 disables the log
+    slow_pipeline_ms: float = 500.0
+    # Add a summary of the explain plan to the slow pipeline log (costs one explain per pipeline shape and minute)
+    explain_slow_pipelines: bool = True
+
+    app_name: str = "rental-service"
+
+    # Build missing indexes from indexes.INDEXES when the app starts
+    ensure_indexes_on_startup: bool = True
+
+
+def _env_name(field_name: str) -> str:
+    if field_name == "mongodb_url":
+        return "MONGODB_URL"
+    return ENV_PREFIX + field_name.upper()
+
+
+@lru_cache
+def get_settings() -> Settings:
+    values = {
+        name: os.environ[_env_name(name)]
+        for name in Settings.model_fields
+        if _env_name(name) in os.environ
+    }
+    return Settings(**values)
@@ -0,0 +1,99 @@
+"""
+Fixtures running the app against mongomock's in-memory stand-in for MongoDB.
+"""
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+
+import mongomock.aggregate
+import mongomock.database
+import mongomock.filtering
+import pytest
+from fastapi.testclient import TestClient
+from mongomock_motor import AsyncMongoMockClient
+from pymongo.errors import OperationFailure
+
+from app import app
+
+# The error a standalone mongod gives for a transaction.
+NO_TRANSACTIONS = OperationFailure("Transaction numbers are only allowed on a replica set member or mongos", 20)
+
+
+class StandaloneSession:
+    """
+    mongomock has no sessions: this one refuses transactions, like a standalone mongod.
+    """
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def with_transaction(self, callback, *args, **kwargs):
+        raise NO_TRANSACTIONS
+
+    def end_session(self):
+        pass
+
+
+async def _start_session(self, *args, **kwargs):
+    return StandaloneSession()
+
+
+def _create_collection(create_collection):
+    # mongomock does not know collection options (the archive collections set storageEngine).
+    def create(self, name, **options):
+        return create_collection(self, name)
+
+    return create
+
+
+def _utc(value: datetime) -> datetime:
+    return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo is not None else value
+
+
+def _bson_compare(bson_compare):
+    # MongoDB stores every date as UTC; mongomock keeps the datetimes it was given.
+    def compare(op, a, b, *args, **kwargs):
+        if isinstance(a, datetime) and isinstance(b, datetime):
+            a, b = _utc(a), _utc(b)
+        return bson_compare(op, a, b, *args, **kwargs)
+
+    return compare
+
+
+def _union_with(in_collection, database, options):
+    # mongomock has no $unionWith (the archive is merged into the lists with it).
+    other = mongomock.aggregate.process_pipeline(
+        list(database[options["coll"]].find()), database, options.get("pipeline", []), None
+    )
+    return list(in_collection) + list(other)
+
+
+@pytest.fixture
+def mongo_client(monkeypatch):
+    monkeypatch.setattr(mongomock.filtering, "bson_compare", _bson_compare(mongomock.filtering.bson_compare))
+    monkeypatch.setitem(mongomock.aggregate._PIPELINE_HANDLERS, "$unionWith", _union_with)
+    monkeypatch.setattr(AsyncMongoMockClient, "start_session", _start_session, raising=False)
+    monkeypatch.setattr(
+        mongomock.database.Database, "create_collection", _create_collection(mongomock.database.Database.create_collection)
+    )
+    return AsyncMongoMockClient()
+
+
+@pytest.fixture
+def db(mongo_client):
+    return mongo_client["rental_service_test"]
+
+
+@pytest.fixture
+def client(monkeypatch, mongo_client, db):
+    @asynccontextmanager
+    async def lifespan(app):
+        app.state.mongo_client = mongo_client
+        app.state.db = db
+        yield
+
+    monkeypatch.setattr(app.router, "lifespan_context", lifespan)
+    with TestClient(app) as client:
+        yield client
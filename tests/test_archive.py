@@ -0,0 +1,43 @@
+import pytest
+
+from services.archive import archive_history
+
+
+@pytest.fixture
+def reservations(client, db):
+    storages = [
+        client.post("/storages/", json={"name": name, "address": "1 Main Street", "contact_number": "1"}).json()["id"]
+        for name in ("North", "South")
+    ]
+    resource = client.post("/resources/", json={"name": "Zelda"}).json()["id"]
+    stock_item = client.post("/stock-items/", json={"resource_id": resource, "storage_id": storages[0]}).json()["id"]
+    old = client.post("/reservations/", json={
+        "stock_item_id": stock_item, "booking_date": "2020-01-01T00:00:00Z", "return_date": "2020-01-05T00:00:00Z",
+    }).json()["id"]
+    new = client.post("/reservations/", json={"stock_item_id": stock_item, "booking_date": "2030-01-10T00:00:00Z"}).json()["id"]
+    client.portal.call(archive_history, db, 30)
+    return storages, old, new
+
+
+def test_detailed_list_includes_archived_reservations_on_request(client, reservations):
+    (north, south), old, new = reservations
+
+    hot = client.get("/reservations/detailed").json()["reservations"]
+    every = client.get("/reservations/detailed?include_archived=true").json()["reservations"]
+
+    assert [reservation["id"] for reservation in hot] == [new]
+    assert [reservation["id"] for reservation in every] == [old, new]
+    assert every[0]["storage_details"]["name"] == every[1]["storage_details"]["name"] == "North"
+    assert every[0]["resource_details"] == every[1]["resource_details"]
+
+
+def test_archived_reservations_are_filtered_and_paginated_like_the_others(client, reservations):
+    (north, south), old, new = reservations
+    url = "/reservations/detailed?include_archived=true"
+
+    first = client.get(f"{url}&storage_id={north}&limit=1&fields=id,storage_details.name").json()
+    second = client.get(f"{url}&storage_id={north}&limit=1&after={first['next_cursor']}").json()
+
+    assert first["reservations"] == [{"id": old, "storage_details": {"name": "North"}}]
+    assert [reservation["id"] for reservation in second["reservations"]] == [new]
+    assert client.get(f"{url}&storage_id={south}").json()["reservations"] == []
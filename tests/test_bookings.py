@@ -0,0 +1,71 @@
+import pytest
+
+
+@pytest.fixture
+def stock_item(client):
+    resource = client.post("/resources/", json={"name": "Zelda"}).json()
+    storage = client.post("/storages/", json={"name": "North", "address": "1 Main Street", "contact_number": "1"}).json()
+    return client.post("/stock-items/", json={"resource_id": resource["id"], "storage_id": storage["id"]}).json()
+
+
+def _reserve(client, stock_item, booked, returned=None):
+    return client.post("/reservations/", json={
+        "stock_item_id": stock_item["id"], "booking_date": booked, "return_date": returned,
+    })
+
+
+def test_overlapping_reservation_is_409(client, stock_item):
+    assert _reserve(client, stock_item, "2030-01-10T00:00:00Z", "2030-01-20T00:00:00Z").status_code == 201
+
+    response = _reserve(client, stock_item, "2030-01-15T00:00:00Z", "2030-01-25T00:00:00Z")
+
+    assert response.status_code == 409
+    assert "already booked" in response.json()["detail"]
+    assert len(client.get("/reservations/").json()["reservations"]) == 1
+
+
+def test_open_loan_blocks_later_bookings(client, stock_item):
+    assert _reserve(client, stock_item, "2030-01-10T00:00:00Z").status_code == 201
+
+    assert _reserve(client, stock_item, "2031-06-01T00:00:00Z", "2031-06-02T00:00:00Z").status_code == 409
+
+
+def test_adjacent_reservations_do_not_conflict(client, stock_item):
+    assert _reserve(client, stock_item, "2030-01-10T00:00:00Z", "2030-01-20T00:00:00Z").status_code == 201
+
+    assert _reserve(client, stock_item, "2030-01-20T00:00:00Z", "2030-01-25T00:00:00Z").status_code == 201
+    assert _reserve(client, stock_item, "2030-01-01T00:00:00Z", "2030-01-10T00:00:00Z").status_code == 201
+
+
+def test_moving_a_reservation_onto_another_is_409(client, stock_item):
+    _reserve(client, stock_item, "2030-01-10T00:00:00Z", "2030-01-20T00:00:00Z")
+    later = _reserve(client, stock_item, "2030-02-10T00:00:00Z", "2030-02-20T00:00:00Z").json()
+
+    moved = client.put(f"/reservations/{later['id']}", json={"booking_date": "2030-01-15T00:00:00Z"})
+
+    assert moved.status_code == 409
+    # The failed move gave its old period back: it can still be extended in place.
+    extended = client.put(f"/reservations/{later['id']}", json={"return_date": "2030-02-25T00:00:00Z"})
+    assert extended.status_code == 200
+
+
+def test_returned_period_can_be_booked_again(client, stock_item):
+    reservation = _reserve(client, stock_item, "2030-01-10T00:00:00Z").json()
+
+    client.put(f"/reservations/{reservation['id']}", json={"return_date": "2030-01-12T00:00:00Z"})
+
+    assert _reserve(client, stock_item, "2030-01-12T00:00:00Z", "2030-01-14T00:00:00Z").status_code == 201
+
+
+def test_bulk_create_reports_conflicts_per_reservation(client, stock_item):
+    body = [
+        {"stock_item_id": stock_item["id"], "booking_date": "2030-01-10T00:00:00Z", "return_date": "2030-01-20T00:00:00Z"},
+        {"stock_item_id": stock_item["id"], "booking_date": "2030-01-15T00:00:00Z", "return_date": "2030-01-16T00:00:00Z"},
+        {"stock_item_id": stock_item["id"], "booking_date": "2030-01-20T00:00:00Z", "return_date": "2030-01-21T00:00:00Z"},
+    ]
+
+    report = client.post("/reservations/bulk", json=body).json()
+
+    assert [_id is not None for _id in report["inserted_ids"]] == [True, False, True]
+    assert [error["index"] for error in report["errors"]] == [1]
+    assert "already booked" in report["errors"][0]["detail"]
@@ -0,0 +1,79 @@
+from bson import ObjectId
+
+from bulk import _delete_chunk, _update_chunk
+from models import BulkWriteReport
+from updates import UpdateSpec
+
+
+class Interleaved:
+    """
+    A collection another request writes to (with ``write``) just before each of the first bulk writes.
+    """
+
+    def __init__(self, collection, *writes):
+        self._collection = collection
+        self._writes = list(writes)
+        self.bulk_writes = 0
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    async def bulk_write(self, requests, **kwargs):
+        self.bulk_writes += 1
+        if self._writes:
+            await self._writes.pop(0)(self._collection)
+        return await self._collection.bulk_write(requests, **kwargs)
+
+
+def _recorder():
+    changes = []
+
+    async def on_change(collection, pairs):
+        changes.extend(pairs)
+
+    return changes, on_change
+
+
+async def _seed(collection, count):
+    ids = [ObjectId() for _ in range(count)]
+    await collection.insert_many([{"_id": _id, "name": str(number), "_version": 0} for number, _id in enumerate(ids)])
+    return ids
+
+
+def test_updates_changed_meanwhile_are_retried_in_one_batch(client, db):
+    ids = client.portal.call(_seed, db.items, 3)
+
+    async def rename(collection):
+        await collection.update_one({"_id": ids[1]}, {"$set": {"name": "renamed"}, "$inc": {"_version": 1}})
+
+    collection = Interleaved(db.items, rename)
+    changes, on_change = _recorder()
+    report = BulkWriteReport()
+    chunk = [(index, _id, UpdateSpec(inc={"views": 1})) for index, _id in enumerate(ids + [ObjectId()])]
+    client.portal.call(_update_chunk, collection, chunk, report, on_change)
+
+    assert collection.bulk_writes == 2
+    assert report.modified_count == 3
+    assert [error.index for error in report.errors] == [3]
+    assert len(changes) == 3
+    before, after = next(pair for pair in changes if pair[0]["_id"] == ids[1])
+    assert (before["name"], before["_version"], after["_version"]) == ("renamed", 1, 2)
+
+
+def test_deletes_changed_meanwhile_are_retried_in_one_batch(client, db):
+    ids = client.portal.call(_seed, db.items, 3)
+
+    async def rename(collection):
+        await collection.update_one({"_id": ids[0]}, {"$set": {"name": "renamed"}, "$inc": {"_version": 1}})
+
+    collection = Interleaved(db.items, rename)
+    changes, on_change = _recorder()
+    report = BulkWriteReport()
+    chunk = [(0, ids[0]), (1, ids[1]), (2, ids[1]), (3, ids[2])]
+    client.portal.call(_delete_chunk, collection, chunk, report, on_change)
+
+    assert collection.bulk_writes == 2
+    assert report.deleted_count == 3
+    assert [error.index for error in report.errors] == [2]
+    assert sorted(before["name"] for before, _ in changes) == ["1", "2", "renamed"]
+    assert client.portal.call(db.items.count_documents, {}) == 0
@@ -0,0 +1,146 @@
+import asyncio
+
+import pytest
+
+from cache import _MISSING, AsyncTTLCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _loader(value, calls):
+    async def load():
+        calls.append(value)
+        return value
+
+    return load
+
+
+def test_entries_expire_after_the_ttl():
+    clock, calls = Clock(), []
+    cache = AsyncTTLCache("test", maxsize=10, ttl=5, clock=clock)
+
+    async def scenario():
+        await cache.get_or_load("a", _loader(1, calls))
+        clock.now = 4.9
+        assert await cache.get_or_load("a", _loader(2, calls)) == 1
+        clock.now = 5.0
+        assert await cache.get_or_load("a", _loader(3, calls)) == 3
+
+    asyncio.run(scenario())
+    assert calls == [1, 3]
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = AsyncTTLCache("test", maxsize=2, ttl=60, clock=Clock())
+    cache.put("a", 1)
+    cache.put("b", 2)
+
+    cache.peek("a")  # "b" is now the least recently used
+    cache.put("c", 3)
+
+    assert [cache.peek(key) for key in ("a", "c")] == [1, 3]
+    assert cache.peek("b") is _MISSING
+    assert cache.evictions == 1
+    assert cache.stats()["size"] == 2
+
+
+def test_nothing_is_kept_without_a_ttl():
+    calls = []
+    cache = AsyncTTLCache("test", maxsize=10, ttl=0)
+
+    async def scenario():
+        await cache.get_or_load("a", _loader(1, calls))
+        await cache.get_or_load("a", _loader(2, calls))
+
+    asyncio.run(scenario())
+    assert calls == [1, 2]
+
+
+def test_concurrent_misses_share_one_load():
+    cache = AsyncTTLCache("test", maxsize=10, ttl=60)
+    calls = []
+
+    async def slow_load():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "value"
+
+    async def scenario():
+        return await asyncio.gather(*(cache.get_or_load("a", slow_load) for _ in range(5)))
+
+    assert asyncio.run(scenario()) == ["value"] * 5
+    assert len(calls) == 1
+    assert cache.coalesced == 4
+
+
+def test_failed_load_reaches_every_waiter_and_is_not_cached():
+    cache = AsyncTTLCache("test", maxsize=10, ttl=60)
+
+    async def failing_load():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("down")
+
+    async def scenario():
+        return await asyncio.gather(*(cache.get_or_load("a", failing_load) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert cache.stats()["size"] == 0
+
+
+def test_cancelled_waiter_does_not_cancel_the_others():
+    cache = AsyncTTLCache("test", maxsize=10, ttl=60)
+    calls = []
+
+    async def slow_load():
+        calls.append(1)
+        await asyncio.sleep(0.02)
+        return "value"
+
+    async def scenario():
+        first = asyncio.create_task(cache.get_or_load("a", slow_load))
+        second = asyncio.create_task(cache.get_or_load("a", slow_load))
+        await asyncio.sleep(0.005)
+        first.cancel()  # e.g. its client disconnected
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(scenario()) == "value"
+    assert len(calls) == 1
+    assert cache.peek("a") == "value"
+
+
+def test_value_loaded_across_an_invalidation_is_not_cached():
+    cache = AsyncTTLCache("test", maxsize=10, ttl=60)
+
+    async def load_then_invalidate():
+        value = "stale"
+        cache.invalidate("a")  # a write lands while the load is in flight
+        return value
+
+    async def scenario():
+        assert await cache.get_or_load("a", load_then_invalidate) == "stale"
+        return await cache.get_or_load("a", _loader("fresh", []))
+
+    assert asyncio.run(scenario()) == "fresh"
+
+
+@pytest.mark.parametrize("operation", ["invalidate", "clear"])
+def test_invalidated_entries_are_gone(operation):
+    cache = AsyncTTLCache("test", maxsize=10, ttl=60)
+    cache.put("a", 1)
+
+    if operation == "invalidate":
+        cache.invalidate("a")
+    else:
+        cache.clear()
+
+    assert cache.stats()["size"] == 0
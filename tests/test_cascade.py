@@ -0,0 +1,59 @@
+import pytest
+from bson import ObjectId
+
+
+@pytest.fixture
+def stock_items(client):
+    storage = client.post("/storages/", json={"name": "North", "address": "1 Main Street", "contact_number": "1"}).json()["id"]
+    resource = client.post("/resources/", json={"name": "Zelda"}).json()["id"]
+    used, unused = client.post("/stock-items/bulk", json=[{"resource_id": resource, "storage_id": storage}] * 2).json()["inserted_ids"]
+    # Returned and resolved: only history is left.
+    client.post("/reservations/", json={
+        "stock_item_id": used, "booking_date": "2030-01-10T00:00:00Z", "return_date": "2030-01-12T00:00:00Z",
+    })
+    client.post("/damages/", json={"stock_item_id": used})
+    return used, unused
+
+
+def _delete(client, ids, policy):
+    return client.request("DELETE", f"/stock-items/bulk?cascade={policy}", json=ids).json()
+
+
+def _count(client, db, collection, stock_item_id):
+    return client.portal.call(db[collection].count_documents, {"stock_item_id": ObjectId(stock_item_id)})
+
+
+def test_reject_keeps_stock_items_with_history(client, db, stock_items):
+    used, unused = stock_items
+
+    report = _delete(client, [used, unused], "reject")
+
+    assert report["deleted_count"] == 1
+    assert [error["index"] for error in report["errors"]] == [0]
+    assert "1 reservation(s) and 1 damage(s)" in report["errors"][0]["detail"]
+    assert client.get("/stock-items/?fields=id").json()["stock_items"] == [{"id": used}]
+    assert _count(client, db, "reservations", used) == 1
+    assert client.delete(f"/stock-items/{used}?cascade=reject").status_code == 409
+
+
+def test_soft_delete_stamps_the_history(client, db, stock_items):
+    used, unused = stock_items
+
+    report = _delete(client, [used, unused, unused], "soft_delete")
+
+    assert report["deleted_count"] == 2
+    assert [error["index"] for error in report["errors"]] == [2]
+    assert client.get("/reservations/").json()["reservations"] == []
+    assert client.portal.call(db.reservations.find_one, {"stock_item_id": ObjectId(used)})["deleted_at"] is not None
+    assert client.portal.call(db.damages.find_one, {"stock_item_id": ObjectId(used)})["deleted_at"] is not None
+
+
+def test_archive_moves_the_history(client, db, stock_items):
+    used, unused = stock_items
+
+    report = _delete(client, [used, unused], "archive")
+
+    assert (report["deleted_count"], report["errors"]) == (2, [])
+    for name in ("reservations", "damages"):
+        assert _count(client, db, name, used) == 0
+        assert _count(client, db, f"{name}_archive", used) == 1
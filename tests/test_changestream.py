@@ -0,0 +1,25 @@
+from changestream import TOKEN_COLLECTION, ChangeStreamWatcher
+
+
+def _watcher(db, name, resume=True):
+    return ChangeStreamWatcher(db, name, ["storages"], [], resume=resume)
+
+
+def test_each_watcher_resumes_from_its_own_token(client, db):
+    caches, search = _watcher(db, "caches"), _watcher(db, "search")
+
+    client.portal.call(caches._save_token, {"_data": "1"})
+    client.portal.call(search._save_token, {"_data": "2"})
+
+    assert client.portal.call(caches._load_token) == {"_data": "1"}
+    assert client.portal.call(search._load_token) == {"_data": "2"}
+
+
+def test_watcher_without_resume_starts_from_now(client, db):
+    client.portal.call(_watcher(db, "versions")._save_token, {"_data": "1"})
+    watcher = _watcher(db, "versions", resume=False)
+
+    client.portal.call(watcher._save_token, {"_data": "2"})
+
+    assert client.portal.call(watcher._load_token) is None
+    assert client.portal.call(db[TOKEN_COLLECTION].find_one, {"_id": "versions"})["token"] == {"_data": "1"}
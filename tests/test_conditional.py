@@ -0,0 +1,28 @@
+from conditional import versions
+
+# mongomock has no command monitoring, so API writes do not bump the versions here: bump them explicitly.
+
+
+def test_etag_changes_once_its_collections_are_bumped(client, db):
+    first = client.get("/storages/")
+    etag = first.headers["ETag"]
+
+    assert first.headers["Cache-Control"] == "no-cache"
+    assert client.get("/storages/", headers={"If-None-Match": etag}).status_code == 304
+
+    client.portal.call(versions.bump, db, ["resources"])
+    assert client.get("/storages/", headers={"If-None-Match": etag}).status_code == 304
+
+    client.portal.call(versions.bump, db, ["storages"])
+    after = client.get("/storages/", headers={"If-None-Match": etag})
+
+    assert after.status_code == 200
+    assert after.headers["ETag"] != etag
+    assert client.get("/storages/", headers={"If-None-Match": after.headers["ETag"]}).status_code == 304
+
+
+def test_if_none_match_star_needs_an_existing_document(client):
+    assert client.get("/storages/", headers={"If-None-Match": "*"}).status_code == 304
+    missing = client.get("/storages/000000000000000000000000", headers={"If-None-Match": "*"})
+
+    assert missing.status_code == 404
@@ -0,0 +1,72 @@
+import pytest
+from fastapi import HTTPException
+
+from fields import fields_under, parse_fields, projection, select_fields
+from models import Resource, Storage
+
+
+def test_projection_uses_the_stored_keys():
+    assert projection(Resource, ("title", "platform")) == {"_id": 1, "name": 1, "platform": 1}
+    assert projection(None, ("resource.name", "resource", "damages.description"), keep=["_id"]) == {
+        "resource": 1, "damages.description": 1, "_id": 1,
+    }
+    assert projection(Resource, None) is None
+
+
+def test_unknown_fields_are_400():
+    with pytest.raises(HTTPException) as error:
+        projection(Storage, ("colour",))
+    assert error.value.status_code == 400
+    # Stored keys of renamed fields are not API names, even on models with extra fields.
+    with pytest.raises(HTTPException):
+        projection(Resource, ("name",))
+
+
+@pytest.mark.parametrize("value", [",", " , ", "title.", "damages..cost", "$where"])
+def test_invalid_fields_are_400(value):
+    with pytest.raises(HTTPException) as error:
+        parse_fields(value)
+    assert error.value.status_code == 400
+
+
+def test_select_fields_trims_and_renames():
+    document = {"_id": 1, "name": "Zelda", "platform": "Switch", "genre": ["Action"], "_version": 2}
+
+    assert select_fields(Resource, document, ("title", "genre")) == {"id": 1, "title": "Zelda", "genre": ["Action"]}
+    assert select_fields(Resource, {"_id": 1, "name": "Zelda"}, ("version",)) == {"id": 1, "version": 0}
+    assert select_fields(None, {"damages": [{"description": "d", "cost": 2}], "x": 1}, ("damages.description",)) == {
+        "damages": [{"description": "d"}],
+    }
+
+
+def test_fields_under():
+    assert fields_under(None, "resource") is None
+    assert fields_under(("resource", "damages.cost"), "resource") is None
+    assert fields_under(("damages.cost", "damages.description"), "damages") == ("cost", "description")
+    assert fields_under(("damages.cost",), "resource") == ()
+
+
+def test_list_returns_only_the_selected_fields(client):
+    client.post("/resources/", json={"name": "Zelda", "platform": "Switch", "developer": "Nintendo"})
+
+    response = client.get("/resources/?fields=title,platform")
+
+    assert response.status_code == 200
+    [resource] = response.json()["resources"]
+    assert set(resource) == {"id", "title", "platform"}
+
+
+def test_embedded_fields_of_the_damaged_report(client):
+    resource = client.post("/resources/", json={"name": "Zelda", "platform": "Switch"}).json()
+    storage = client.post("/storages/", json={"name": "North", "address": "1 Main Street", "contact_number": "1"}).json()
+    stock_item = client.post("/stock-items/", json={"resource_id": resource["id"], "storage_id": storage["id"]}).json()
+    client.post("/damages/", json={"stock_item_id": stock_item["id"], "description": "Scratched"})
+
+    response = client.get(f"/stock-items/damaged/{storage['id']}?fields=resource.name,damages.description")
+
+    assert response.json()["stock_items"] == [{"resource": [{"name": "Zelda"}], "damages": [{"description": "Scratched"}]}]
+
+
+def test_unknown_field_in_a_request_is_400(client):
+    # Even without any document to select it from
+    assert client.get("/storages/?fields=colour").status_code == 400
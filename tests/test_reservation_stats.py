@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from services.reservation_stats import MAX_PERIODS, bucket_end, bucket_start, periods
+
+
+@pytest.mark.parametrize("granularity, value, start, end", [
+    ("day", datetime(2030, 1, 10, 15, 30), datetime(2030, 1, 10), datetime(2030, 1, 11)),
+    # 2030-01-10 is a Thursday; weeks start on Monday.
+    ("week", datetime(2030, 1, 10, 15, 30), datetime(2030, 1, 7), datetime(2030, 1, 14)),
+    ("week", datetime(2029, 12, 31), datetime(2029, 12, 31), datetime(2030, 1, 7)),
+    ("month", datetime(2030, 1, 31, 23, 59), datetime(2030, 1, 1), datetime(2030, 2, 1)),
+    ("month", datetime(2030, 11, 5), datetime(2030, 11, 1), datetime(2030, 12, 1)),
+    ("month", datetime(2030, 12, 25), datetime(2030, 12, 1), datetime(2031, 1, 1)),
+])
+def test_buckets(granularity, value, start, end):
+    assert bucket_start(granularity, value) == start
+    assert bucket_end(granularity, start) == end
+
+
+def test_periods_counts_the_buckets_overlapping_the_range():
+    assert periods("day", datetime(2030, 1, 1), datetime(2030, 1, 2), MAX_PERIODS) == 1
+    assert periods("day", datetime(2030, 1, 1, 12), datetime(2030, 1, 2, 12), MAX_PERIODS) == 2
+    assert periods("month", datetime(2030, 11, 15), datetime(2031, 2, 1), MAX_PERIODS) == 3
+    assert periods("week", datetime(2030, 1, 10), datetime(2030, 1, 14), MAX_PERIODS) == 1
+    # Offsets are converted to UTC first.
+    start = datetime(2030, 1, 1, 23, tzinfo=timezone(timedelta(hours=-2)))
+    assert periods("day", start, start + timedelta(hours=1), MAX_PERIODS) == 1
+
+
+def test_periods_stops_counting_past_the_limit():
+    assert periods("day", datetime(2000, 1, 1), datetime(2100, 1, 1), 10) == 11
+
+
+def _stats(client, **params):
+    params = {"group_by": "resource", "granularity": "month", "from": "2030-01-01T00:00:00", "to": "2030-03-01T00:00:00", **params}
+    return client.get("/reservations/stats", params=params)
+
+
+def test_stats_count_reservations_per_period(client):
+    resource = client.post("/resources/", json={"name": "Zelda"}).json()
+    storage = client.post("/storages/", json={"name": "North", "address": "1 Main Street", "contact_number": "1"}).json()
+    stock_items = client.post("/stock-items/bulk", json=[
+        {"resource_id": resource["id"], "storage_id": storage["id"]}
+    ] * 2).json()["inserted_ids"]
+    client.post("/reservations/bulk", json=[
+        {"stock_item_id": stock_items[0], "booking_date": "2030-01-10T00:00:00Z", "return_date": "2030-01-12T00:00:00Z"},
+        {"stock_item_id": stock_items[1], "booking_date": "2030-01-31T12:00:00Z"},
+        {"stock_item_id": stock_items[0], "booking_date": "2030-02-01T00:00:00Z", "return_date": "2030-02-02T00:00:00Z"},
+    ])
+
+    response = _stats(client)
+
+    assert response.status_code == 200
+    january, february = response.json()["buckets"]
+    assert (january["start"], january["bookings"], january["returned"], january["open"]) == ("2030-01-01T00:00:00", 2, 1, 1)
+    assert january["average_rental_days"] == 2
+    assert (february["start"], february["bookings"]) == ("2030-02-01T00:00:00", 1)
+    assert _stats(client, id=storage["id"]).json()["buckets"] == []
+    assert len(_stats(client, group_by="storage", id=storage["id"]).json()["buckets"]) == 2
+
+
+def test_stats_etag_changes_with_the_date(client):
+    etag = _stats(client).headers["etag"]
+
+    assert etag.endswith(f'-{datetime.now(timezone.utc).date().isoformat()}"')
+
+
+@pytest.mark.parametrize("params", [
+    {"to": "2030-01-01T00:00:00"},
+    {"granularity": "day", "to": "2032-01-01T00:00:00"},
+    {"id": "not an id"},
+])
+def test_invalid_stats_requests_are_400(client, params):
+    assert _stats(client, **params).status_code == 400
@@ -0,0 +1,53 @@
+import json
+from datetime import datetime, timezone
+
+import pytest
+from bson import ObjectId
+
+from models import Damages, Reservation, Resource, StockItem, Storage
+from responses import dump_document, dumps
+from settings import get_settings
+
+DOCUMENTS = [
+    (Resource, {"_id": ObjectId(), "name": "Zelda", "genre": ["Adventure"], "specs": {"players": 1, "tags": ["a"]}}),
+    (Storage, {"_id": ObjectId(), "name": "North", "address": "1 Main Street", "contact_number": "1", "_version": 3}),
+    (StockItem, {"_id": ObjectId(), "resource_id": ObjectId(), "storage_id": ObjectId()}),
+    (Reservation, {
+        "_id": ObjectId(), "stock_item_id": ObjectId(), "booking_date": datetime(2030, 1, 10, tzinfo=timezone.utc),
+        "return_date": datetime(2030, 1, 12, 8, 30), "notes": None,
+    }),
+    (Damages, {"_id": ObjectId(), "stock_item_id": ObjectId(), "description": "Scratched", "repairs": 2}),
+]
+
+
+@pytest.mark.parametrize("model, document", DOCUMENTS, ids=[model.__name__ for model, _ in DOCUMENTS])
+def test_fast_path_encodes_like_the_model(model, document):
+    validated = model.model_validate(document).model_dump_json()
+
+    assert json.loads(dumps(dump_document(model, document))) == json.loads(validated)
+
+
+def _responses(client):
+    storage = client.post("/storages/", json={"name": "North", "address": "1 Main Street", "contact_number": "1"}).json()
+    resource = client.post("/resources/", json={"name": "Zelda", "specs": {"players": 1}}).json()
+    stock_item = client.post("/stock-items/", json={"resource_id": resource["id"], "storage_id": storage["id"]}).json()
+    reservation = client.post("/reservations/", json={"stock_item_id": stock_item["id"], "booking_date": "2030-01-10T00:00:00Z"}).json()
+    client.put(f"/storages/{storage['id']}", json={"address": "2 Main Street"})
+    paths = ["/storages/", f"/storages/{storage['id']}", "/resources/", f"/resources/{resource['id']}", "/stock-items/", "/reservations/"]
+    ids = {storage["id"]: "storage", resource["id"]: "resource", stock_item["id"]: "stock item", reservation["id"]: "reservation"}
+    responses = {}
+    for path in paths:
+        body = client.get(path).text
+        for _id, name in ids.items():
+            body = body.replace(_id, name)
+        responses[path.replace(storage["id"], "{id}").replace(resource["id"], "{id}")] = json.loads(body)
+    return responses
+
+
+def test_responses_are_the_same_on_both_paths(client, monkeypatch):
+    monkeypatch.setattr(get_settings(), "fast_json_responses", False)
+    expected = _responses(client)
+    client.portal.call(client.app.state.db.client.drop_database, client.app.state.db.name)
+    monkeypatch.setattr(get_settings(), "fast_json_responses", True)
+
+    assert _responses(client) == expected
@@ -0,0 +1,81 @@
+import pytest
+
+from services.summary import rebuild_summaries
+
+
+def _summary(client):
+    return {row["storage_id"]: row for row in client.get("/storages/summary").json()}
+
+
+def _counts(summary, storage_id):
+    row = summary[storage_id]
+    return row["total_stock_items"], row["total_reservations"], row["total_damages"]
+
+
+@pytest.fixture
+def storages(client):
+    return [
+        client.post("/storages/", json={"name": name, "address": "1 Main Street", "contact_number": "1"}).json()["id"]
+        for name in ("North", "South")
+    ]
+
+
+@pytest.fixture
+def resource_id(client):
+    return client.post("/resources/", json={"name": "Zelda"}).json()["id"]
+
+
+def test_writes_update_the_counters_of_their_storage(client, storages, resource_id):
+    north, south = storages
+    stock_item = client.post("/stock-items/", json={"resource_id": resource_id, "storage_id": north}).json()["id"]
+    client.post("/reservations/", json={"stock_item_id": stock_item, "booking_date": "2030-01-10T00:00:00Z"})
+    client.post("/damages/", json={"stock_item_id": stock_item})
+
+    assert _counts(_summary(client), north) == (1, 1, 1)
+
+    client.put(f"/stock-items/{stock_item}", json={"storage_id": south})
+
+    summary = _summary(client)
+    assert _counts(summary, north) == (0, 0, 0)
+    assert _counts(summary, south) == (1, 1, 1)
+
+
+def test_bulk_writes_only_count_what_was_written(client, storages, resource_id):
+    north, south = storages
+    created = client.post("/stock-items/bulk", json=[{"resource_id": resource_id, "storage_id": north}] * 3).json()
+    first, second, third = created["inserted_ids"]
+
+    moved = client.patch("/stock-items/bulk", json=[
+        {"id": first, "storage_id": south},
+        {"id": "000000000000000000000000", "storage_id": south},
+        {"id": second, "storage_id": "not an id"},
+    ]).json()
+    deleted = client.request("DELETE", "/stock-items/bulk", json=[third, third, "000000000000000000000000"]).json()
+
+    assert moved["modified_count"] == 1
+    assert deleted["deleted_count"] == 1
+    summary = _summary(client)
+    assert _counts(summary, north) == (1, 0, 0)
+    assert _counts(summary, south) == (1, 0, 0)
+
+
+def test_incremental_counters_match_a_rebuild(client, db, storages, resource_id):
+    north, south = storages
+    stock_items = client.post("/stock-items/bulk", json=[
+        {"resource_id": resource_id, "storage_id": storage} for storage in (north, north, south)
+    ]).json()["inserted_ids"]
+    reservations = client.post("/reservations/bulk", json=[
+        {"stock_item_id": stock_items[0], "booking_date": "2030-01-10T00:00:00Z", "return_date": "2030-01-12T00:00:00Z"},
+        {"stock_item_id": stock_items[0], "booking_date": "2030-02-10T00:00:00Z"},
+        {"stock_item_id": stock_items[2], "booking_date": "2030-01-10T00:00:00Z"},
+    ]).json()["inserted_ids"]
+    damages = client.post("/damages/bulk", json=[{"stock_item_id": stock_item} for stock_item in stock_items]).json()
+    client.put(f"/stock-items/{stock_items[0]}", json={"storage_id": south})
+    client.request("DELETE", "/reservations/bulk", json=[reservations[1]])
+    client.request("DELETE", "/damages/bulk", json=[damages["inserted_ids"][1]])
+    client.delete(f"/stock-items/{stock_items[1]}")
+    incremental = _summary(client)
+
+    client.portal.call(rebuild_summaries, db)
+
+    assert _summary(client) == incremental
@@ -0,0 +1,117 @@
+import pytest
+
+from models import Resource, Storage, UpdateResource, UpdateStorage
+from updates import VERSION_FIELD, update_spec
+
+
+def test_update_spec_sets_values_and_unsets_nulls():
+    spec = update_spec(UpdateResource.model_validate({"name": "Zelda", "platform": None}), Resource)
+
+    assert spec.set == {"name": "Zelda"}
+    assert spec.unset == ["platform"]
+    assert spec.operations() == {
+        "$inc": {VERSION_FIELD: 1}, "$set": {"name": "Zelda"}, "$unset": {"platform": ""}
+    }
+
+
+def test_update_spec_refuses_to_remove_required_fields():
+    with pytest.raises(ValueError, match="'name' cannot be removed"):
+        update_spec(UpdateResource.model_validate({"name": None}), Resource)
+
+
+def test_update_spec_increments_extra_fields():
+    spec = update_spec(UpdateResource.model_validate({"$inc": {"views": 2}}), Resource)
+
+    assert spec.inc == {"views": 2}
+    assert spec.apply({"_id": 1, "views": 3}) == {"_id": 1, "views": 5, VERSION_FIELD: 1}
+
+
+@pytest.mark.parametrize("body, message", [
+    ({"$inc": {"views": 1}, "views": 4}, "cannot be both incremented and set"),
+    ({"$inc": {"views": 1}, "views": None}, "cannot be both incremented and set"),
+    ({"$inc": {"name": 1}}, "'name' cannot be incremented"),
+    ({"$inc": {VERSION_FIELD: 1}}, "cannot be updated"),
+])
+def test_update_spec_rejects_conflicting_increments(body, message):
+    with pytest.raises(ValueError, match=message):
+        update_spec(UpdateResource.model_validate(body), Resource)
+
+
+def test_update_spec_without_fields_is_empty():
+    assert not update_spec(UpdateStorage.model_validate({}), Storage)
+
+
+def _storage(client):
+    return client.post("/storages/", json={"name": "North", "address": "1 Main Street", "contact_number": "1"}).json()
+
+
+def test_put_with_stale_if_match_is_412(client):
+    storage = _storage(client)
+    url = f"/storages/{storage['id']}"
+
+    updated = client.put(url, json={"name": "South"}, headers={"If-Match": '"0"'})
+    stale = client.put(url, json={"name": "East"}, headers={"If-Match": '"0"'})
+
+    assert updated.status_code == 200 and updated.json()["version"] == 1
+    assert stale.status_code == 412
+    assert client.get(url).json()["name"] == "South"
+
+
+def test_put_with_the_etag_of_a_get_is_conditional_on_that_version(client):
+    storage = _storage(client)
+    # The collection changes more often than the document.
+    _storage(client)
+    url = f"/storages/{storage['id']}"
+
+    etag = client.get(url).headers["ETag"]
+    updated = client.put(url, json={"name": "South"}, headers={"If-Match": etag})
+    stale = client.put(url, json={"name": "East"}, headers={"If-Match": etag})
+
+    assert etag == '"0"'
+    assert updated.status_code == 200 and updated.headers["ETag"] == '"1"'
+    assert stale.status_code == 412
+    assert client.get(url, headers={"If-None-Match": updated.headers["ETag"]}).status_code == 304
+    assert client.get(url, headers={"If-None-Match": etag}).json()["name"] == "South"
+
+
+def test_put_with_if_match_of_unknown_document_is_404(client):
+    response = client.put("/storages/000000000000000000000000", json={"name": "South"}, headers={"If-Match": '"0"'})
+
+    assert response.status_code == 404
+
+
+def test_idempotency_key_replays_the_first_response(client):
+    storage = _storage(client)
+    url, headers = f"/storages/{storage['id']}", {"Idempotency-Key": "rename-1"}
+
+    first = client.put(url, json={"name": "South"}, headers=headers)
+    retry = client.put(url, json={"name": "South"}, headers=headers)
+
+    assert retry.status_code == first.status_code == 200
+    assert retry.json() == first.json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert client.get(url).json()["version"] == 1
+
+
+def test_idempotency_key_of_a_conflict_is_released(client):
+    storage = _storage(client)
+    url = f"/storages/{storage['id']}"
+    client.put(url, json={"name": "South"})
+
+    conflict = client.put(url, json={"name": "West"}, headers={"Idempotency-Key": "rename-3", "If-Match": '"0"'})
+    retry = client.put(url, json={"name": "West"}, headers={"Idempotency-Key": "rename-3", "If-Match": '"1"'})
+
+    assert conflict.status_code == 412
+    assert retry.status_code == 200 and "Idempotent-Replayed" not in retry.headers
+    assert client.get(url).json()["name"] == "West"
+
+
+def test_idempotency_key_reused_for_another_body_is_422(client):
+    storage = _storage(client)
+    url, headers = f"/storages/{storage['id']}", {"Idempotency-Key": "rename-2"}
+
+    client.put(url, json={"name": "South"}, headers=headers)
+    reused = client.put(url, json={"name": "West"}, headers=headers)
+
+    assert reused.status_code == 422
+    assert client.get(url).json()["name"] == "South"
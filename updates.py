@@ -0,0 +1,254 @@
+"""
+Partial updates shared by the ``PUT /<collection>/{id}`` endpoints (and the bulk updates).
+
+The validated body becomes one update document (:func:`update_spec`): fields with a value
+are ``$set``, fields sent as ``null`` are ``$unset`` (required fields cannot be removed),
+and models that declare ``$inc`` accept ``{"$inc": {"<extra field>": <number>}}``. Every
+update also increments the document's ``version`` (stored as ``_version``), which the
+responses carry as their ``ETag`` (``"<version>"``).
+
+:func:`update_document` applies it with a single ``find_one_and_update`` and reports the
+``(before, after)`` pair to the usual write hooks:
+
+* ``If-Match: "<version>"``, the ``ETag`` of the document the client last saw (e.g. from
+  ``GET /<collection>/{id}``), makes the update conditional on that version; a document
+  changed since then gets a 412.
+* ``Idempotency-Key: <any string>`` makes a retry of the same request replay the first
+  response instead of writing again. Only final outcomes are replayed (successes, 400s and
+  422s); after a 404, 409 or 412 the retry runs again. Keys are kept in the
+  ``idempotency_keys`` collection for ``RENTAL_IDEMPOTENCY_KEY_TTL_SECONDS``.
+"""
+import hashlib
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Type
+
+from bson import ObjectId
+from fastapi import HTTPException, Request, Response
+from pydantic import BaseModel
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from models import VERSION_FIELD
+from responses import document_response, dumps
+from settings import get_settings
+
+IDEMPOTENCY_COLLECTION = "idempotency_keys"
+
+# Server errors caused by the update itself, e.g. $inc of a string field
+_BAD_UPDATE_CODES = {2, 14, 40}
+# Errors a retry of the same request would get again: the body itself is invalid
+_FINAL_ERRORS = {400, 422}
+
+
+@dataclass
+class UpdateSpec:
+    set: Dict[str, Any] = field(default_factory=dict)
+    unset: List[str] = field(default_factory=list)
+    inc: Dict[str, Any] = field(default_factory=dict)
+
+    def __bool__(self) -> bool:
+        return bool(self.set or self.unset or self.inc)
+
+    def operations(self) -> Dict:
+        operations: Dict[str, Dict] = {"$inc": {**self.inc, VERSION_FIELD: 1}}
+        if self.set:
+            operations["$set"] = self.set
+        if self.unset:
+            operations["$unset"] = dict.fromkeys(self.unset, "")
+        return operations
+
+    def apply(self, document: Dict) -> Dict:
+        """
+        ``document`` as the update leaves it.
+        """
+        after = {**document, **self.set}
+        for key in self.unset:
+            after.pop(key, None)
+        for key, delta in {**self.inc, VERSION_FIELD: 1}.items():
+            after[key] = after.get(key, 0) + delta
+        return after
+
+
+def _check_key(key: str) -> None:
+    if key in ("_id", VERSION_FIELD) or key.startswith("$") or "." in key:
+        raise ValueError(f"{key!r} cannot be updated")
+
+
+def update_spec(update: BaseModel, model: Type[BaseModel]) -> UpdateSpec:
+    """
+    Turn a validated update body into an :class:`UpdateSpec` for documents of ``model``.
+
+    Raise ``ValueError`` for fields that cannot be written that way.
+    """
+    declared = {field.alias or name: field for name, field in model.model_fields.items()}
+    spec = UpdateSpec()
+    for key, value in update.model_dump(by_alias=True, exclude_unset=True).items():
+        if key == "$inc":
+            for name, delta in (value or {}).items():
+                _check_key(name)
+                if name in declared:
+                    raise ValueError(f"{name!r} cannot be incremented")
+                spec.inc[name] = delta
+            continue
+        _check_key(key)
+        if value is not None:
+            spec.set[key] = value
+        elif key in declared and declared[key].is_required():
+            raise ValueError(f"{key!r} cannot be removed")
+        else:
+            spec.unset.append(key)
+    if overlap := set(spec.inc) & (set(spec.set) | set(spec.unset)):
+        raise ValueError(f"{', '.join(map(repr, sorted(overlap)))} cannot be both incremented and set")
+    return spec
+
+
+def _expected_version(request: Request) -> Optional[Dict]:
+    """
+    The filter on ``_version`` requested by ``If-Match``, ``{}`` for ``*`` and ``None`` without one.
+    """
+    header = request.headers.get("if-match")
+    if header is None:
+        return None
+    if header.strip() == "*":
+        return {}
+    try:
+        version = int(header.strip().strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail='If-Match must be the ETag of the document, e.g. "3"')
+    # Documents that were never updated have no _version yet.
+    return {VERSION_FIELD: {"$in": [0, None]}} if version == 0 else {VERSION_FIELD: version}
+
+
+async def _missing(collection, _id, name: str, conditional: bool):
+    if conditional and await collection.count_documents({"_id": _id}, limit=1):
+        raise HTTPException(status_code=412, detail=f"{name} {_id} has changed since the version in If-Match")
+    raise HTTPException(status_code=404, detail=f"{name} {_id} not found")
+
+
+async def _apply(
+    collection,
+    request: Request,
+    id: str,
+    update: BaseModel,
+    model: Type[BaseModel],
+    name: str,
+    on_change: Optional[Callable],
+    before_write: Optional[Callable],
+    on_failure: Optional[Callable],
+) -> Response:
+    try:
+        spec = update_spec(update, model)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if not spec:
+        raise HTTPException(status_code=400, detail="No fields to update")
+    if not ObjectId.is_valid(id):
+        raise HTTPException(status_code=404, detail=f"{name} {id} not found")
+    _id = ObjectId(id)
+    expected = _expected_version(request)
+    query = {"_id": _id, **(expected or {})}
+
+    checked = None
+    if before_write is not None:
+        # The check needs the current document; the update then only applies to that version of it.
+        if (previous := await collection.find_one(query)) is None:
+            await _missing(collection, _id, name, expected is not None)
+        checked = (previous, spec.apply(previous))
+        if rejected := await before_write(collection, [checked]):
+            raise HTTPException(status_code=409, detail=rejected[0])
+        query = {"_id": _id, VERSION_FIELD: previous.get(VERSION_FIELD)}
+
+    try:
+        previous = await collection.find_one_and_update(query, spec.operations(), return_document=ReturnDocument.BEFORE)
+    except Exception as e:
+        if checked is not None and on_failure is not None:
+            await on_failure(collection, [checked])
+        if isinstance(e, OperationFailure) and e.code in _BAD_UPDATE_CODES:
+            raise HTTPException(status_code=422, detail=e.details.get("errmsg", str(e)) if e.details else str(e))
+        raise
+    if previous is None:
+        if checked is not None:
+            if on_failure is not None:
+                # Whoever changed it has written their own state: only undo ours.
+                await on_failure(collection, [(None, checked[1])])
+            raise HTTPException(status_code=409, detail=f"{name} {_id} was changed concurrently, please retry")
+        await _missing(collection, _id, name, expected is not None)
+
+    after = spec.apply(previous)
+    if on_change is not None:
+        await on_change(collection, [(previous, after)])
+    return document_response(model, after)
+
+
+def _fingerprint(request: Request, body: bytes) -> str:
+    return hashlib.sha256(request.method.encode() + b" " + request.url.path.encode() + b"\n" + body).hexdigest()
+
+
+async def idempotent(collection, request: Request, run: Callable[[], Awaitable[Response]]) -> Response:
+    """
+    Run ``run`` once per ``Idempotency-Key`` (if the request has one) and replay its response to retries.
+    """
+    key = request.headers.get("idempotency-key")
+    if key is None:
+        return await run()
+
+    keys = collection.database[IDEMPOTENCY_COLLECTION]
+    _id = f"{request.method} {request.url.path} {key}"
+    fingerprint = _fingerprint(request, await request.body())
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=get_settings().idempotency_key_ttl_seconds)
+    try:
+        await keys.insert_one({"_id": _id, "fingerprint": fingerprint, "expires_at": expires_at})
+    except DuplicateKeyError:
+        stored = await keys.find_one({"_id": _id})
+        if stored is None:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key has just expired, please retry")
+        if stored["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="This Idempotency-Key was used for a different request")
+        if "status" not in stored:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+        headers = {"Idempotent-Replayed": "true"}
+        if stored.get("etag") is not None:
+            headers["ETag"] = stored["etag"]
+        return Response(stored["body"], status_code=stored["status"], media_type="application/json", headers=headers)
+
+    try:
+        response = await run()
+    except HTTPException as e:
+        if e.status_code in _FINAL_ERRORS:
+            await keys.update_one({"_id": _id}, {"$set": {"status": e.status_code, "body": dumps({"detail": e.detail})}})
+        else:
+            # A conflict (409, 412) or a missing document may be gone when retried: let the retry run.
+            await keys.delete_one({"_id": _id})
+        raise
+    except BaseException:
+        await keys.delete_one({"_id": _id})
+        raise
+    stored = {"status": response.status_code, "body": bytes(response.body), "etag": response.headers.get("etag")}
+    await keys.update_one({"_id": _id}, {"$set": stored})
+    return response
+
+
+async def update_document(
+    collection,
+    request: Request,
+    id: str,
+    update: BaseModel,
+    model: Type[BaseModel],
+    name: str,
+    on_change: Optional[Callable] = None,
+    before_write: Optional[Callable] = None,
+    on_failure: Optional[Callable] = None,
+) -> Response:
+    """
+    Apply ``update`` to the document ``id`` of ``collection`` and return it as ``model``.
+
+    ``name`` is used in error messages (e.g. "Stock item"). The hooks are the ones of
+    :func:`bulk.bulk_update`; with ``before_write`` the document is read first and the
+    update only applies if it has not changed meanwhile (409 otherwise).
+    """
+    return await idempotent(
+        collection,
+        request,
+        lambda: _apply(collection, request, id, update, model, name, on_change, before_write, on_failure),
+    )